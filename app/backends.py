@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, TypeVar
+
+from werkzeug.local import LocalProxy
+
+from app.config import flask_app
+
+if TYPE_CHECKING:
+    from redis import Redis
+
+    import app.files.local
+    import app.files.s3
+    from app.database import Database
+    from app.database.connections import Replicas
+    from app.downloader import Downloader
+    from app.evictor import Evictor
+    from app.files.base import BaseFiles
+    from app.metrics import Metrics
+    from app.prefetcher import Prefetcher
+    from app.profiler import Profiler
+    from app.proxy import Proxy
+    from app.publisher import Publisher
+    from app.simple_index import SimpleIndex
+    from app.snapshot import Snapshot
+    from app.syncer import Syncer
+    from app.warmer import Warmer
+
+T = TypeVar("T")
+
+# the backends created by this process, by name
+_backends: Dict[str, Any] = {}
+# creating a backend creates the backends it depends on
+_lock = threading.RLock()
+
+
+def _reset_after_fork() -> None:
+    """
+    Forget the backends of the parent in a forked child. Connections,
+    threads and locks do not survive a fork, so each process makes its own.
+    """
+    global _lock
+
+    _backends.clear()
+    _lock = threading.RLock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def lazy(func: Callable[[], T]) -> T:
+    """
+    Turn a function that creates a backend into a proxy of the backend,
+    which is created on first use, once per process. Nothing is connected to
+    or imported until then, so the application can be set up once and forked.
+    """
+    name = func.__name__
+
+    def get() -> T:
+        try:
+            return _backends[name]
+        except KeyError:
+            pass
+
+        with _lock:
+            if name not in _backends:
+                _backends[name] = func()
+
+            return _backends[name]
+
+    return LocalProxy(get)  # type: ignore
+
+
+# =============================================================================
+# Storage
+# =============================================================================
+
+
+@lazy
+def redis_client() -> Redis:
+    from app.database.connections import create_client
+
+    return create_client()
+
+
+@lazy
+def redis_replicas() -> Replicas:
+    from app.database.connections import create_replicas
+
+    return create_replicas()
+
+
+@lazy
+def metrics() -> Metrics:
+    from app.metrics import Metrics
+
+    return Metrics(redis_client)
+
+
+@lazy
+def database_backend() -> Database:
+    from app.database import Database
+
+    if flask_app.config["REDIS_REPLICA_READS"]:
+        return Database(redis_client, redis_replicas)
+
+    return Database(redis_client)
+
+
+@lazy
+def proxy() -> Proxy:
+    from app.proxy import Proxy
+
+    return Proxy(database_backend)
+
+
+def create_local_files() -> app.files.local.LocalFiles:
+    import app.files.local
+
+    return app.files.local.LocalFiles(
+        database_backend,
+        os.path.join(
+            flask_app.config["FILE_STORAGE_DIRECTORY"],
+        ),
+    )
+
+
+def create_s3_files() -> app.files.s3.S3Files:
+    import app.files.s3
+
+    return app.files.s3.S3Files(
+        database_backend,
+        flask_app.config["S3_BUCKET"],
+        flask_app.config["S3_ACCESS_KEY"],
+        flask_app.config["S3_SECRET_KEY"],
+        endpoint_url=flask_app.config.get("S3_ENDPOINT_URL", None),
+        region_name=flask_app.config.get("S3_REGION", None),
+        public=flask_app.config["S3_PUBLIC"],
+        prefix=flask_app.config.get("S3_PREFIX", None),
+    )
+
+
+@lazy
+def files_backend() -> BaseFiles:
+    files: BaseFiles
+
+    if flask_app.config["FILE_STORAGE_DRIVER"].lower() == "local":
+        files = create_local_files()
+
+    elif flask_app.config["FILE_STORAGE_DRIVER"].lower() == "s3":
+        files = create_s3_files()
+
+    elif flask_app.config["FILE_STORAGE_DRIVER"].lower() == "tiered":
+        import app.files.tiered
+
+        files = app.files.tiered.TieredFiles(
+            database_backend,
+            create_local_files(),
+            create_s3_files(),
+            flask_app.config["TIERED_LOCAL_MAX_BYTES"],
+        )
+
+    else:
+        raise ValueError(
+            f"Unknown file storage driver: {flask_app.config['FILE_STORAGE_DRIVER']}"
+        )
+
+    # shard local storage across cluster nodes
+    if flask_app.config["CLUSTER_NODES"]:
+        if flask_app.config["FILE_STORAGE_DRIVER"].lower() != "local":
+            raise ValueError("Clustering requires the local file storage driver")
+
+        import app.files.sharded
+
+        files = app.files.sharded.ShardedFiles(
+            database_backend,
+            files,
+            flask_app.config["CLUSTER_NODES"],
+            flask_app.config["CLUSTER_SELF"],
+            flask_app.config["CLUSTER_SECRET"],
+            proxy=flask_app.config["CLUSTER_PROXY"],
+            replicas=flask_app.config["CLUSTER_REPLICAS"],
+            draining=flask_app.config["MODE"] == "rebalance",
+        )
+
+    return files
+
+
+# =============================================================================
+# Services
+# =============================================================================
+
+
+@lazy
+def prefetcher() -> Prefetcher:
+    from app.prefetcher import Prefetcher
+
+    return Prefetcher(files_backend)
+
+
+@lazy
+def publisher() -> Publisher:
+    from app.publisher import Publisher
+
+    return Publisher()
+
+
+@lazy
+def profiler() -> Profiler:
+    from app.profiler import Profiler
+
+    return Profiler()
+
+
+@lazy
+def downloader() -> Downloader:
+    from app.downloader import Downloader
+
+    return Downloader(database_backend, files_backend)
+
+
+@lazy
+def evictor() -> Evictor:
+    from app.evictor import Evictor
+
+    return Evictor(database_backend, files_backend)
+
+
+@lazy
+def simple_index() -> SimpleIndex:
+    from app.simple_index import SimpleIndex
+
+    return SimpleIndex(database_backend)
+
+
+@lazy
+def warmer() -> Warmer:
+    from app.warmer import Warmer
+
+    return Warmer(proxy, database_backend, files_backend)
+
+
+@lazy
+def syncer() -> Syncer:
+    from app.syncer import Syncer
+
+    return Syncer(proxy, database_backend, files_backend, simple_index)
+
+
+@lazy
+def snapshot() -> Snapshot:
+    from app.snapshot import Snapshot
+
+    return Snapshot(database_backend, files_backend)
@@ -0,0 +1,135 @@
+import os
+from typing import Any
+
+from dynaconf import FlaskDynaconf
+from flask import Flask
+
+flask_app = Flask(__name__)
+FlaskDynaconf(flask_app, ENVVAR_PREFIX="MYPYPI")
+
+# =============================================================================
+# Set up default values
+# =============================================================================
+
+
+def default_value(key: str, value: Any) -> None:
+    """
+    Set the default value of the flask config.
+    """
+    flask_app.config[key] = flask_app.config.get(key, value)
+
+
+default_value("MODE", "server")
+
+# upstream
+default_value("PACKAGE_TYPE", "pypi")
+
+if flask_app.config["PACKAGE_TYPE"] == "pypi":
+    default_value("UPSTREAM_URL", "https://pypi.org")
+elif flask_app.config["PACKAGE_TYPE"] == "npm":
+    default_value("UPSTREAM_URL", "https://registry.npmjs.org")
+else:
+    raise ValueError(f"Unknown mode: {flask_app.config['PACKAGE_TYPE']}")
+
+flask_app.config["UPSTREAM_URL"] = flask_app.config["UPSTREAM_URL"].rstrip("/")
+
+default_value("UPSTREAM_STRICT", False)
+
+# data
+default_value("DATA_DIRECTORY", "data")
+default_value("FILE_STORAGE_DRIVER", "local")
+default_value("FILE_STORAGE_DIRECTORY", os.path.join("data", "files"))
+default_value("FILE_STORAGE_LAYOUT", "path")
+default_value("S3_PUBLIC", False)
+default_value("S3_KEY_TTL", 10 * 60)  # 10 minutes
+default_value("TIERED_LOCAL_MAX_BYTES", 10 * 1024 * 1024 * 1024)  # 10 GB
+default_value("TIERED_WORKERS", 4)
+default_value("TIERED_TRIM_INTERVAL", 60)
+
+# clustering
+default_value("CLUSTER_NODES", [])
+default_value("CLUSTER_SELF", "")
+default_value("CLUSTER_SECRET", "")
+default_value("CLUSTER_PROXY", False)
+default_value("CLUSTER_REPLICAS", 100)
+
+# identifies the local disk of tiered storage, which a cluster node has one of
+default_value("TIERED_NODE_ID", flask_app.config["CLUSTER_SELF"])
+
+# determine how long file urls should be valid for, depending on file hosting type
+if (
+    flask_app.config["FILE_STORAGE_DRIVER"] in ("s3", "tiered")
+    and flask_app.config["S3_PUBLIC"] is False
+):
+    # non-public S3 storage will have a unique URL every time
+    # give a 60 second fudge factor
+    assert flask_app.config["S3_KEY_TTL"] > 60
+    flask_app.config["FILE_URL_EXPIRATION"] = flask_app.config["S3_KEY_TTL"] - 60
+else:
+    flask_app.config["FILE_URL_EXPIRATION"] = float("inf")
+
+# persistent storage
+default_value("REDIS_URL", "redis://localhost:6379")
+default_value("REDIS_PREFIX", "mypypi")
+default_value("REDIS_MODE", "standalone")
+default_value("REDIS_SENTINELS", [])
+default_value("REDIS_SENTINEL_SERVICE", "mymaster")
+default_value("REDIS_REPLICA_READS", False)
+default_value("REDIS_REPLICA_URLS", [])
+default_value("REDIS_REPLICA_MAX_LAG", 10)
+default_value("CACHE_TIME", 300)
+
+# eviction
+default_value("STORAGE_QUOTA", 0)  # unlimited
+default_value("EVICTION_POLICY", "lru")
+default_value("EVICTION_TARGET", 0.9)
+default_value("EVICTION_INTERVAL", 60)
+
+# prefetching
+default_value("PREFETCH", False)
+default_value("PREFETCH_TAGS", [])
+default_value("PREFETCH_PYTHON_VERSIONS", [])
+default_value("PREFETCH_VERSIONS", 1)
+default_value("PREFETCH_MAX_BYTES", 100 * 1024 * 1024)  # 100 MB
+default_value("PREFETCH_UNKNOWN_BYTES", 10 * 1024 * 1024)  # 10 MB
+default_value("PREFETCH_NPM_DIST_TAGS", ["latest"])
+
+# warming
+default_value("WARM_LOCKFILES", [])
+default_value("WARM_WORKERS", 8)
+
+# syncing
+default_value("SYNC_PROJECTS", [])
+default_value("SYNC_VERSIONS", 0)  # all
+default_value("SYNC_TAGS", [])
+default_value("SYNC_PYTHON_VERSIONS", [])
+default_value("SYNC_WORKERS", 8)
+
+# snapshots
+default_value(
+    "SNAPSHOT_PATH", os.path.join(flask_app.config["DATA_DIRECTORY"], "snapshot.tar")
+)
+default_value("SNAPSHOT_FILES", True)
+default_value("SNAPSHOT_WORKERS", 8)
+
+# static publishing
+default_value("PUBLISH_DIRECTORY", "")  # disabled
+default_value("PUBLISH_BASE_URL", "")
+
+# simple index
+default_value("SIMPLE_INDEX", False)
+default_value("SIMPLE_INDEX_INTERVAL", 300)
+
+# metrics
+default_value("METRICS", False)
+default_value("METRICS_FLUSH_INTERVAL", 10)
+
+# request timing
+default_value("SERVER_TIMING", False)
+default_value("PROFILE_THRESHOLD", 0)  # disabled
+default_value("PROFILE_INTERVAL", 0.005)
+default_value("PROFILE_RATE", 1.0)
+default_value(
+    "PROFILE_DIRECTORY",
+    os.path.join(flask_app.config["DATA_DIRECTORY"], "profiles"),
+)
@@ -1,24 +1,100 @@
 import datetime
-from typing import List, Optional, Tuple
+import functools
+import time
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, TypeVar
 
 import orjson
+from loguru import logger
 from redis import Redis
+from redis.exceptions import RedisError
+from redis.lock import Lock
 
-from app.main import flask_app
+from app.backends import metrics
+from app.config import flask_app
+from app.database.connections import Replicas
 from app.models.url_cache import URLCache
 
+F = TypeVar("F", bound=Callable[..., Any])
+T = TypeVar("T")
+
+# count a reference to content, and return how many there are
+ADD_BLOB_SCRIPT = """
+local refs = redis.call("HINCRBY", KEYS[1], "refs", 1)
+redis.call("HSET", KEYS[1], "size", ARGV[1])
+return refs
+"""
+
+# drop a reference to content, forgetting it once nothing references it, and
+# return how many references are left and the size of content that is forgotten
+RELEASE_BLOB_SCRIPT = """
+local refs = redis.call("HINCRBY", KEYS[1], "refs", -1)
+if refs > 0 then
+    return {refs, 0}
+end
+
+local size = redis.call("HGET", KEYS[1], "size")
+redis.call("DEL", KEYS[1])
+return {0, tonumber(size) or 0}
+"""
+
+
+def timed(func: F) -> F:
+    """
+    Record how long a database operation takes, including every
+    Redis round trip it makes.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with metrics.timer(
+            "mypypi_redis_seconds", phase="redis", operation=func.__name__
+        ):
+            return func(*args, **kwargs)
+
+    return wrapper  # type: ignore
+
 
 class Database:
-    def __init__(self, redis_client: Redis) -> None:
+    def __init__(
+        self, redis_client: Redis, replicas: Optional[Replicas] = None
+    ) -> None:
         self.redis_client = redis_client
+        # if set, read-only lookups are made from replicas when possible
+        self.replicas = replicas
 
         self._redis_prefix = (
             f"{flask_app.config['REDIS_PREFIX']}:{flask_app.config['PACKAGE_TYPE']}"
         )
+        # in a cluster, keys are only used together if they are in the same
+        # hash slot. Keys shared by the whole mirror are in one slot, and the
+        # keys of each URL in one slot of their own, spread across the cluster.
+        self._hash_tags = flask_app.config["REDIS_MODE"] == "cluster"
+        self._shared_prefix = (
+            f"{{{self._redis_prefix}}}" if self._hash_tags else self._redis_prefix
+        )
         self._data_sep = "data"
         self._time_sep = "time"
         self._file_url_sep = "file_url"
+        self._file_metadata_sep = "file_metadata"
         self._file_download_queue_name = "file_download_queue"
+        self._file_size_name = "file_size"
+        self._file_size_total_name = "file_size_total"
+        self._file_size_backfilled_name = "file_size_backfilled"
+        self._file_saved_name = "file_saved"
+        self._file_access_name = "file_access"
+        self._file_hits_name = "file_hits"
+        self._lock_sep = "lock"
+        self._file_blob_sep = "file_blob"
+        self._simple_index_name = "simple_index"
+        self._simple_index_serial_name = "simple_index_serial"
+        self._sync_name = "sync"
+        self._sync_serial_name = "sync_serial"
+        # content may be shared by mirrors of different package types
+        self._blob_prefix = f"{flask_app.config['REDIS_PREFIX']}:blob"
+
+        # the reference count and size of content are changed together
+        self._add_blob = self.redis_client.register_script(ADD_BLOB_SCRIPT)
+        self._release_blob = self.redis_client.register_script(RELEASE_BLOB_SCRIPT)
 
     @staticmethod
     def process_key(key: str) -> str:
@@ -27,91 +103,168 @@ class Database:
         """
         return key.replace(":", "_")
 
+    def _key(self, sep: str, key: str) -> str:
+        """
+        Get the name of a Redis key of one URL or file key.
+        """
+        if self._hash_tags:
+            return f"{self._redis_prefix}:{sep}:{{{self.process_key(key)}}}"
+
+        return f"{self._redis_prefix}:{sep}:{self.process_key(key)}"
+
+    def _read(self, read: Callable[[Redis], Optional[T]]) -> Optional[T]:
+        """
+        Make a read-only lookup, from a replica if possible. Replicas lag
+        behind, so if the replica fails or does not have the data yet, the
+        lookup is made from the primary instead.
+        """
+        client = self.replicas.client() if self.replicas is not None else None
+        if client is not None:
+            try:
+                result = read(client)
+            except RedisError as e:
+                logger.warning(f"Failed to read from Redis replica: {e}")
+                self.replicas.failed(client)  # type: ignore
+            else:
+                if result is not None:
+                    return result
+
+        return read(self.redis_client)
+
     # url cache
 
+    @timed
     def set_url_cache(self, url: str, data: URLCache) -> None:
         """
         Set URL cache data to the redis cache.
         """
+        pipe = self.redis_client.pipeline()
         # record the actual data
-        self.redis_client.set(
-            f"{self._redis_prefix}:{self._data_sep}:{self.process_key(url)}",
+        pipe.set(
+            self._key(self._data_sep, url),
             orjson.dumps(data).decode("utf-8"),
         )
         # record the time of the data
-        self.redis_client.set(
-            f"{self._redis_prefix}:{self._time_sep}:{self.process_key(url)}",
+        pipe.set(
+            self._key(self._time_sep, url),
             datetime.datetime.now().isoformat(),
         )
+        pipe.execute()
 
+    @timed
+    def get_url_cache_time(self, url: str) -> Optional[datetime.datetime]:
+        """
+        Get the time URL cache data was recorded, without fetching the data.
+        """
+        timestamp = self._read(
+            lambda client: client.get(self._key(self._time_sep, url))
+        )
+        if timestamp is None:
+            return None
+
+        return datetime.datetime.fromisoformat(timestamp)
+
+    @timed
     def get_url_cache(
         self, url: str
     ) -> Tuple[Optional[datetime.datetime], Optional[URLCache]]:
         """
         Get URL cache data from the redis cache.
         """
-        data = self.redis_client.get(
-            f"{self._redis_prefix}:{self._data_sep}:{self.process_key(url)}"
-        )
-        if data is None:
-            return (None, None)
 
-        timestamp = self.redis_client.get(
-            f"{self._redis_prefix}:{self._time_sep}:{self.process_key(url)}"
-        )
-        if timestamp is None:
+        def read(client: Redis) -> Optional[Tuple[str, str]]:
+            # both keys are in the same hash slot, so one round trip
+            pipe = client.pipeline(transaction=False)
+            pipe.get(self._key(self._data_sep, url))
+            pipe.get(self._key(self._time_sep, url))
+            data, timestamp = pipe.execute()
+            if data is None or timestamp is None:
+                return None
+
+            return data, timestamp
+
+        entry = self._read(read)
+        if entry is None:
             return (None, None)
 
+        data, timestamp = entry
         return datetime.datetime.fromisoformat(timestamp), orjson.loads(data)
 
     # file download jobs
 
+    @timed
     def add_file_download_job(self, url: str) -> None:
         """
         Add a file download job to the redis queue.
         """
         self.redis_client.rpush(
-            f"{self._redis_prefix}:{self._file_download_queue_name}", url
+            f"{self._shared_prefix}:{self._file_download_queue_name}", url
         )
 
+    @timed
     def check_file_download_job(self, url: str) -> bool:
         """
         Check if a file download job is in the redis queue.
         """
         return (
             self.redis_client.lrem(
-                f"{self._redis_prefix}:{self._file_download_queue_name}", 0, url
+                f"{self._shared_prefix}:{self._file_download_queue_name}", 0, url
             )
             > 0
         )
 
+    @timed
     def get_file_download_job(self) -> Optional[str]:
         """
         Get a file download job from the redis queue.
         """
         return self.redis_client.lpop(
-            f"{self._redis_prefix}:{self._file_download_queue_name}"
+            f"{self._shared_prefix}:{self._file_download_queue_name}"
         )
 
+    @timed
+    def has_file_download_job(self, url: str) -> bool:
+        """
+        Check if a file download job is in the redis queue, without removing it.
+        """
+        return (
+            self.redis_client.lpos(
+                f"{self._shared_prefix}:{self._file_download_queue_name}", url
+            )
+            is not None
+        )
+
+    @timed
+    def get_file_download_queue_length(self) -> int:
+        """
+        Get how many file download jobs are in the redis queue.
+        """
+        return self.redis_client.llen(
+            f"{self._shared_prefix}:{self._file_download_queue_name}"
+        )
+
+    @timed
     def del_file_download_job(self, url: str) -> None:
         """
         Delete a file download job from the redis queue.
         """
         self.redis_client.lrem(
-            f"{self._redis_prefix}:{self._file_download_queue_name}", 0, url
+            f"{self._shared_prefix}:{self._file_download_queue_name}", 0, url
         )
 
     # file url keys
 
+    @timed
     def add_file_url_key(self, filekey: str, url: str) -> None:
         """
         Add entry of a key that we can use to look up the source file URL later.
         """
         self.redis_client.set(
-            f"{self._redis_prefix}:{self._file_url_sep}:{self.process_key(filekey)}",
+            self._key(self._file_url_sep, filekey),
             url,
         )
 
+    @timed
     def bulk_add_file_url_keys(self, entries: List[Tuple[str, str]]) -> None:
         """
         Bulk add tuples of file key and URL to redis.
@@ -119,23 +272,480 @@ class Database:
         pipe = self.redis_client.pipeline()
         for filekey, url in entries:
             pipe.set(
-                f"{self._redis_prefix}:{self._file_url_sep}:{self.process_key(filekey)}",
+                self._key(self._file_url_sep, filekey),
                 url,
             )
 
             # if in pypi mode, also make duplicate without the anchor
             if flask_app.config["PACKAGE_TYPE"] == "pypi" and "#" in filekey:
                 pipe.set(
-                    f"{self._redis_prefix}:{self._file_url_sep}:{self.process_key(filekey.split('#')[0])}",
+                    self._key(self._file_url_sep, filekey.split("#")[0]),
                     url,
                 )
 
         pipe.execute()
 
+    @timed
     def get_file_url_from_key(self, filekey: str) -> Optional[str]:
         """
         Get the source file URL from a key.
         """
-        return self.redis_client.get(
-            f"{self._redis_prefix}:{self._file_url_sep}:{self.process_key(filekey)}"
+        return self._read(
+            lambda client: client.get(self._key(self._file_url_sep, filekey))
+        )
+
+    # file metadata
+
+    @timed
+    def set_file_metadata(self, url: str, metadata: str) -> None:
+        """
+        Set the core metadata of a file. File contents never change,
+        so this does not expire.
+        """
+        self.redis_client.set(
+            self._key(self._file_metadata_sep, url),
+            metadata,
+        )
+
+    @timed
+    def get_file_metadata(self, url: str) -> Optional[str]:
+        """
+        Get the core metadata of a file.
+        """
+        return self.redis_client.get(self._key(self._file_metadata_sep, url))
+
+    # stored files
+
+    @timed
+    def add_file(self, url: str, size: int, counted: bool = True) -> None:
+        """
+        Record that a file has been saved to our storage, and its size.
+        If not counted, the size is left out of the total, as it is counted
+        by its content instead.
+        """
+        now = time.time()
+        old_size = self.redis_client.hget(
+            f"{self._shared_prefix}:{self._file_size_name}", url
+        )
+
+        pipe = self.redis_client.pipeline()
+        pipe.hset(f"{self._shared_prefix}:{self._file_size_name}", url, size)
+        if counted:
+            pipe.incrby(
+                f"{self._shared_prefix}:{self._file_size_total_name}",
+                size - int(old_size or 0),
+            )
+        pipe.zadd(f"{self._shared_prefix}:{self._file_saved_name}", {url: now})
+        pipe.zadd(f"{self._shared_prefix}:{self._file_access_name}", {url: now})
+        pipe.zadd(f"{self._shared_prefix}:{self._file_hits_name}", {url: 0}, nx=True)
+        pipe.execute()
+
+    @timed
+    def record_file_access(self, url: str) -> None:
+        """
+        Record that a file in our storage has been accessed.
+        Files that are not being tracked are ignored.
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(
+            f"{self._shared_prefix}:{self._file_access_name}",
+            {url: time.time()},
+            xx=True,
+        )
+        pipe.zadd(
+            f"{self._shared_prefix}:{self._file_hits_name}",
+            {url: 1},
+            xx=True,
+            incr=True,
+        )
+        pipe.execute()
+
+    @timed
+    def remove_file(self, url: str, counted: bool = True) -> int:
+        """
+        Remove the record of a file in our storage. Returns the size it had.
+        If not counted, the size was left out of the total.
+        """
+        size = self.redis_client.hget(
+            f"{self._shared_prefix}:{self._file_size_name}", url
+        )
+
+        pipe = self.redis_client.pipeline()
+        pipe.hdel(f"{self._shared_prefix}:{self._file_size_name}", url)
+        if counted:
+            pipe.decrby(
+                f"{self._shared_prefix}:{self._file_size_total_name}", int(size or 0)
+            )
+        pipe.zrem(f"{self._shared_prefix}:{self._file_saved_name}", url)
+        pipe.zrem(f"{self._shared_prefix}:{self._file_access_name}", url)
+        pipe.zrem(f"{self._shared_prefix}:{self._file_hits_name}", url)
+        pipe.execute()
+
+        return int(size or 0)
+
+    @timed
+    def get_file_sizes(self, urls: List[str]) -> List[Optional[int]]:
+        """
+        Get the recorded sizes of files in our storage. Files that are not
+        being tracked have no size.
+        """
+        if not urls:
+            return []
+
+        return [
+            int(size) if size is not None else None
+            for size in self.redis_client.hmget(
+                f"{self._shared_prefix}:{self._file_size_name}", urls
+            )
+        ]
+
+    def scan_file_sizes(
+        self, count: int
+    ) -> Generator[List[Tuple[str, int]], None, None]:
+        """
+        Scan every file in our storage that is being tracked, in batches
+        of URL and size.
+        """
+        batch: List[Tuple[str, int]] = []
+        for url, size in self.redis_client.hscan_iter(
+            f"{self._shared_prefix}:{self._file_size_name}", count=count
+        ):
+            batch.append((url, int(size)))
+            if len(batch) >= count:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @timed
+    def get_files_size_total(self) -> int:
+        """
+        Get the total size of all files in our storage.
+        """
+        return int(
+            self.redis_client.get(f"{self._shared_prefix}:{self._file_size_total_name}")
+            or 0
+        )
+
+    def get_file_sizes_backfilled(self) -> bool:
+        """
+        Get whether the sizes of untracked files in our storage have been recorded.
+        """
+        return bool(
+            self.redis_client.exists(
+                f"{self._shared_prefix}:{self._file_size_backfilled_name}"
+            )
+        )
+
+    def set_file_sizes_backfilled(self) -> None:
+        """
+        Mark that the sizes of untracked files in our storage have been recorded.
+        """
+        self.redis_client.set(
+            f"{self._shared_prefix}:{self._file_size_backfilled_name}", int(time.time())
+        )
+
+    @timed
+    def get_file_eviction_candidates(
+        self, policy: str, start: int, count: int
+    ) -> List[str]:
+        """
+        Get the files in our storage that should be evicted first, by policy.
+        """
+        if policy == "lru":
+            name = self._file_access_name
+        elif policy == "lfu":
+            name = self._file_hits_name
+        elif policy == "age":
+            name = self._file_saved_name
+        else:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+
+        return self.redis_client.zrange(
+            f"{self._shared_prefix}:{name}", start, start + count - 1
+        )
+
+    # content addressed files
+
+    @timed
+    def add_file_blob(self, url: str, digest: str, size: int) -> None:
+        """
+        Record the sha256 hex digest of the content of a file, and count
+        the reference to the content. The size of the content counts towards
+        the total once, however many files reference it.
+        """
+        if self.get_file_blob(url) == digest:
+            return
+
+        # counted before the file points at it, so the reference is never
+        # dropped before it is counted
+        refs = self._add_blob(keys=[f"{self._blob_prefix}:{digest}"], args=[size])
+        if refs == 1:
+            # the first reference to the content
+            self.redis_client.incrby(
+                f"{self._shared_prefix}:{self._file_size_total_name}", size
+            )
+
+        old_digest = self.redis_client.set(
+            self._key(self._file_blob_sep, url), digest, get=True
+        )
+
+        # the content the file pointed at before, which may have been
+        # recorded by another worker meanwhile, loses its reference
+        if old_digest is not None:
+            self._release_file_blob(old_digest)
+
+    @timed
+    def get_file_blob(self, url: str) -> Optional[str]:
+        """
+        Get the sha256 hex digest of the content of a file.
+        """
+        return self.redis_client.get(self._key(self._file_blob_sep, url))
+
+    @timed
+    def get_file_blobs(self, urls: List[str]) -> List[Optional[str]]:
+        """
+        Get the sha256 hex digests of the content of files.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for url in urls:
+            pipe.get(self._key(self._file_blob_sep, url))
+        return pipe.execute()
+
+    def _release_file_blob(self, digest: str) -> int:
+        """
+        Drop a reference to content. Once nothing references it, its size no
+        longer counts towards the total. Returns how many references are left.
+        """
+        refs, size = self._release_blob(keys=[f"{self._blob_prefix}:{digest}"])
+        if refs > 0:
+            return refs
+
+        self.redis_client.decrby(
+            f"{self._shared_prefix}:{self._file_size_total_name}", size
+        )
+        return 0
+
+    @timed
+    def remove_file_blob(self, url: str) -> int:
+        """
+        Remove the record of the content of a file. Returns how many other
+        files still reference the same content.
+        """
+        # only one worker gets the digest, so the reference is dropped once
+        digest = self.redis_client.getdel(self._key(self._file_blob_sep, url))
+        if digest is None:
+            return 0
+
+        return self._release_file_blob(digest)
+
+    # simple index
+
+    @timed
+    def get_simple_index_serial(self) -> Optional[int]:
+        """
+        Get the upstream serial the simple index is current as of.
+        """
+        serial = self.redis_client.get(
+            f"{self._shared_prefix}:{self._simple_index_serial_name}"
+        )
+        if serial is None:
+            return None
+
+        return int(serial)
+
+    @timed
+    def get_simple_index_bucket_names(self) -> List[str]:
+        """
+        Get the names of every bucket of the simple index, in order.
+        """
+        return sorted(
+            self.redis_client.hkeys(f"{self._shared_prefix}:{self._simple_index_name}")
+        )
+
+    @timed
+    def get_simple_index_buckets(self, names: List[str]) -> List[str]:
+        """
+        Get buckets of the simple index. Missing buckets are empty.
+        """
+        if not names:
+            return []
+
+        return [
+            bucket or ""
+            for bucket in self.redis_client.hmget(
+                f"{self._shared_prefix}:{self._simple_index_name}", names
+            )
+        ]
+
+    @timed
+    def set_simple_index_buckets(
+        self, buckets: Dict[str, str], serial: int, replace: bool = False
+    ) -> None:
+        """
+        Set buckets of the simple index, and the serial they are current as of.
+        Empty buckets are deleted. Optionally, replace every bucket.
+        """
+        name = f"{self._shared_prefix}:{self._simple_index_name}"
+
+        pipe = self.redis_client.pipeline()
+        if replace:
+            pipe.delete(name)
+
+        filled = {key: value for key, value in buckets.items() if value}
+        if filled:
+            pipe.hset(name, mapping=filled)
+
+        empty = [key for key, value in buckets.items() if not value]
+        if empty:
+            pipe.hdel(name, *empty)
+
+        pipe.set(f"{self._shared_prefix}:{self._simple_index_serial_name}", serial)
+        pipe.execute()
+
+    # sync
+
+    @timed
+    def get_sync_serial(self) -> Optional[int]:
+        """
+        Get the upstream serial the last complete sync is current as of.
+        """
+        serial = self.redis_client.get(
+            f"{self._shared_prefix}:{self._sync_serial_name}"
+        )
+        if serial is None:
+            return None
+
+        return int(serial)
+
+    @timed
+    def set_sync_serial(self, serial: int) -> None:
+        """
+        Set the upstream serial the last complete sync is current as of.
+        """
+        self.redis_client.set(f"{self._shared_prefix}:{self._sync_serial_name}", serial)
+
+    @timed
+    def get_sync_markers(self, names: List[str]) -> List[Optional[str]]:
+        """
+        Get the markers of the upstream state projects were last fully synced at.
+        Projects that were never synced have no marker.
+        """
+        if not names:
+            return []
+
+        return self.redis_client.hmget(
+            f"{self._shared_prefix}:{self._sync_name}", names
+        )
+
+    @timed
+    def set_sync_marker(self, name: str, marker: Optional[str]) -> None:
+        """
+        Set the marker of the upstream state a project was fully synced at.
+        A marker of None forces the project to be synced again.
+        """
+        if marker is None:
+            self.redis_client.hdel(f"{self._shared_prefix}:{self._sync_name}", name)
+        else:
+            self.redis_client.hset(
+                f"{self._shared_prefix}:{self._sync_name}", name, marker
+            )
+
+    # snapshots
+
+    def _scan(
+        self, sep: str, count: int
+    ) -> Generator[List[Tuple[str, Optional[str]]], None, None]:
+        """
+        Scan every URL or file key of a kind, in batches of key and value.
+        Keys are returned as processed.
+        """
+        prefix = f"{self._redis_prefix}:{sep}:"
+
+        def values(keys: List[str]) -> List[Tuple[str, Optional[str]]]:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(self._key(sep, key))
+            return list(zip(keys, pipe.execute()))
+
+        keys: List[str] = []
+        for name in self.redis_client.scan_iter(match=f"{prefix}*", count=count):
+            key = name.removeprefix(prefix)
+            if self._hash_tags:
+                key = key.removeprefix("{").removesuffix("}")
+
+            keys.append(key)
+            if len(keys) >= count:
+                yield values(keys)
+                keys = []
+
+        if keys:
+            yield values(keys)
+
+    def scan_url_cache(
+        self, count: int
+    ) -> Generator[List[Tuple[str, str, str]], None, None]:
+        """
+        Scan every URL cache entry, in batches of key, time and data as stored.
+        """
+        for batch in self._scan(self._data_sep, count):
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, _ in batch:
+                pipe.get(self._key(self._time_sep, key))
+
+            yield [
+                (key, timestamp, data)
+                for (key, data), timestamp in zip(batch, pipe.execute())
+                if data is not None and timestamp is not None
+            ]
+
+    def scan_file_url_keys(
+        self, count: int
+    ) -> Generator[List[Tuple[str, str]], None, None]:
+        """
+        Scan every file key, in batches of file key and URL.
+        """
+        for batch in self._scan(self._file_url_sep, count):
+            yield [(key, url) for key, url in batch if url is not None]
+
+    def scan_file_metadata(
+        self, count: int
+    ) -> Generator[List[Tuple[str, str]], None, None]:
+        """
+        Scan the core metadata of every file, in batches of key and metadata.
+        """
+        for batch in self._scan(self._file_metadata_sep, count):
+            yield [(key, metadata) for key, metadata in batch if metadata is not None]
+
+    @timed
+    def bulk_set_url_cache(self, entries: List[Tuple[str, str, str]]) -> None:
+        """
+        Bulk set tuples of key, time and data of URL cache entries as stored,
+        so they keep the time they were recorded.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, timestamp, data in entries:
+            pipe.set(self._key(self._data_sep, key), data)
+            pipe.set(self._key(self._time_sep, key), timestamp)
+        pipe.execute()
+
+    @timed
+    def bulk_set_file_metadata(self, entries: List[Tuple[str, str]]) -> None:
+        """
+        Bulk set tuples of key and core metadata of files.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, metadata in entries:
+            pipe.set(self._key(self._file_metadata_sep, key), metadata)
+        pipe.execute()
+
+    # locks
+
+    def lock(self, name: str, timeout: float) -> Lock:
+        """
+        Get a lock shared between all servers and workers.
+        """
+        return self.redis_client.lock(
+            f"{self._redis_prefix}:{self._lock_sep}:{name}", timeout=timeout
         )
@@ -0,0 +1,305 @@
+import collections
+import itertools
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+from redis import Redis
+from redis.cluster import RedisCluster
+from redis.connection import SSLConnection, parse_url
+from redis.exceptions import RedisError
+from redis.sentinel import Sentinel
+
+from app.config import flask_app
+
+REDIS_MODES = ("standalone", "sentinel", "cluster")
+
+# how often to check how far replicas lag behind, in seconds
+REPLICA_CHECK_INTERVAL = 1
+
+# the key replication offsets of a standalone or Sentinel primary are kept under
+PRIMARY = "primary"
+
+
+def connection_kwargs() -> Dict[str, Any]:
+    """
+    Get the options of connections to Redis servers found through Sentinel,
+    such as the credentials and database, from the Redis URL.
+    """
+    kwargs = parse_url(flask_app.config["REDIS_URL"])
+    kwargs.pop("host", None)
+    kwargs.pop("port", None)
+    if kwargs.pop("connection_class", None) is SSLConnection:
+        kwargs["ssl"] = True
+
+    return {**kwargs, "decode_responses": True}
+
+
+def create_sentinel() -> Sentinel:
+    """
+    Connect to the Sentinels of the primary.
+    """
+    sentinels = []
+    for address in flask_app.config["REDIS_SENTINELS"]:
+        host, _, port = address.rpartition(":")
+        sentinels.append((host, int(port)))
+
+    return Sentinel(
+        sentinels,
+        sentinel_kwargs={"password": flask_app.config.get("REDIS_SENTINEL_PASSWORD")},
+        **connection_kwargs(),
+    )
+
+
+def create_client() -> Redis:
+    """
+    Connect to the Redis primary, for the configured mode.
+    """
+    mode = flask_app.config["REDIS_MODE"]
+
+    if mode == "standalone":
+        return Redis.from_url(flask_app.config["REDIS_URL"], decode_responses=True)
+
+    elif mode == "sentinel":
+        # the primary is found through Sentinel again after a failover
+        return create_sentinel().master_for(flask_app.config["REDIS_SENTINEL_SERVICE"])
+
+    elif mode == "cluster":
+        return RedisCluster.from_url(  # type: ignore
+            flask_app.config["REDIS_URL"], decode_responses=True
+        )
+
+    raise ValueError(f"Unknown Redis mode: {mode}")
+
+
+def replication_offset(info: Dict[str, Any]) -> Optional[int]:
+    """
+    Get how much of its primary's replication stream a replica has processed,
+    from its replication info. Replicas that are not connected to their
+    primary have no offset, as they may be arbitrarily stale.
+    """
+    if info.get("role") != "slave" or info.get("master_link_status") != "up":
+        return None
+
+    return info.get("slave_repl_offset")
+
+
+class Replicas:
+    """
+    Read-only clients of Redis replicas. Reads are spread between the replicas
+    that are behind the primary by no more than the staleness tolerance. While
+    none are, reads go to the primary. For a cluster, the client routes each
+    read to a replica of the slot itself, so it is only used while every
+    replica is within the tolerance.
+
+    Staleness is measured by sampling the replication offset of the primary
+    every check. A replica that has processed the stream up to a sample has
+    everything the primary had when the sample was taken.
+    """
+
+    def __init__(
+        self, primary: Redis, discover: Callable[[], List[Redis]], max_lag: float
+    ) -> None:
+        self.primary = primary
+        # returns the current replicas
+        self.discover = discover
+        self.max_lag = max_lag
+
+        self._healthy: List[Redis] = []
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._counter = itertools.count()
+
+        # recent times and replication offsets of each primary, oldest first
+        self._offsets: Dict[str, Deque[Tuple[float, int]]] = {}
+
+        logger.debug("Initializing Replicas")
+
+    def _sample_primaries(self) -> None:
+        """
+        Record the current replication offset of each primary.
+        """
+        try:
+            if isinstance(self.primary, RedisCluster):
+                infos = {
+                    node.name: self.primary.info("replication", target_nodes=node)
+                    for node in self.primary.get_primaries()
+                }
+            else:
+                infos = {PRIMARY: self.primary.info("replication")}
+        except RedisError as e:
+            logger.warning(f"Failed to check Redis primary: {e}")
+            return
+
+        now = time.monotonic()
+        for name, info in infos.items():
+            samples = self._offsets.setdefault(name, collections.deque())
+            samples.append((now, info["master_repl_offset"]))
+
+            # a replica behind every sample left is too stale anyway
+            while now - samples[0][0] > self.max_lag:
+                samples.popleft()
+
+    def _staleness(self, primary: str, offset: int) -> float:
+        """
+        Get how long ago a primary had no more than a replication offset,
+        in seconds.
+        """
+        now = time.monotonic()
+        for sampled, primary_offset in reversed(self._offsets.get(primary, ())):
+            if offset >= primary_offset:
+                return now - sampled
+
+        return math.inf
+
+    def _lag(self, client: Redis) -> Optional[float]:
+        """
+        Get how far a replica lags behind, or None if it cannot be read from.
+        """
+        try:
+            if isinstance(client, RedisCluster):
+                infos: Iterable[Dict[str, Any]] = [
+                    client.info("replication", target_nodes=node)
+                    for node in client.get_replicas()
+                ]
+            else:
+                infos = [client.info("replication")]
+        except RedisError as e:
+            logger.warning(f"Failed to check Redis replica: {e}")
+            return None
+
+        lags = []
+        for info in infos:
+            offset = replication_offset(info)
+            if offset is None:
+                return None
+
+            # cluster replicas are matched to the primary they replicate
+            primary = (
+                f"{info['master_host']}:{info['master_port']}"
+                if isinstance(client, RedisCluster)
+                else PRIMARY
+            )
+            lags.append(self._staleness(primary, offset))
+
+        if not lags:
+            return None
+
+        return max(lags)
+
+    def _check(self) -> None:
+        """
+        Find the replicas within the staleness tolerance.
+        """
+        # sampled first, so replicas are compared against an offset no newer
+        # than what they had when read
+        self._sample_primaries()
+
+        try:
+            replicas = self.discover()
+        except RedisError as e:
+            logger.warning(f"Failed to find Redis replicas: {e}")
+            replicas = []
+
+        healthy = []
+        for client in replicas:
+            lag = self._lag(client)
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(client)
+
+        if len(healthy) != len(self._healthy):
+            logger.info(
+                f"Reading from {len(healthy)} of {len(replicas)} Redis replicas"
+            )
+
+        self._healthy = healthy
+
+    def _run(self) -> None:
+        """
+        Check the replicas forever.
+        """
+        while True:
+            try:
+                self._check()
+            except Exception:
+                logger.exception("Failed to check Redis replicas")
+
+            time.sleep(REPLICA_CHECK_INTERVAL)
+
+    def client(self) -> Optional[Redis]:
+        """
+        Get a replica to read from, or None to read from the primary.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                # started lazily, so the thread is created after gunicorn forks
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._run, daemon=True).start()
+                    self._pid = os.getpid()
+
+        healthy = self._healthy
+        if not healthy:
+            return None
+
+        return healthy[next(self._counter) % len(healthy)]
+
+    def failed(self, client: Redis) -> None:
+        """
+        Stop reading from a replica that failed, until it is checked again.
+        """
+        self._healthy = [replica for replica in self._healthy if replica is not client]
+
+
+def create_replicas() -> Replicas:
+    """
+    Connect to the Redis replicas, for the configured mode.
+    """
+    mode = flask_app.config["REDIS_MODE"]
+
+    if mode == "standalone":
+        if not flask_app.config["REDIS_REPLICA_URLS"]:
+            raise ValueError("Reading from replicas requires REDIS_REPLICA_URLS")
+
+        primary = create_client()
+        clients = [
+            Redis.from_url(url, decode_responses=True)
+            for url in flask_app.config["REDIS_REPLICA_URLS"]
+        ]
+
+        def discover() -> List[Redis]:
+            return clients
+
+    elif mode == "sentinel":
+        sentinel = create_sentinel()
+        service = flask_app.config["REDIS_SENTINEL_SERVICE"]
+        primary = sentinel.master_for(service)
+        kwargs = connection_kwargs()
+        by_address: Dict[Any, Redis] = {}
+
+        def discover() -> List[Redis]:
+            # replicas come and go with failovers
+            addresses = sentinel.discover_slaves(service)
+            for host, port in addresses:
+                if (host, port) not in by_address:
+                    by_address[(host, port)] = Redis(host=host, port=port, **kwargs)
+
+            return [by_address[address] for address in addresses]
+
+    elif mode == "cluster":
+        client = RedisCluster.from_url(
+            flask_app.config["REDIS_URL"],
+            decode_responses=True,
+            read_from_replicas=True,
+        )
+        primary = client  # type: ignore
+
+        def discover() -> List[Redis]:
+            return [client]  # type: ignore
+
+    else:
+        raise ValueError(f"Unknown Redis mode: {mode}")
+
+    return Replicas(primary, discover, flask_app.config["REDIS_REPLICA_MAX_LAG"])
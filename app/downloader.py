@@ -5,6 +5,8 @@ from typing import TYPE_CHECKING
 
 from loguru import logger
 
+from app.backends import metrics
+
 if TYPE_CHECKING:
     from app.database import Database
     from app.files.base import BaseFiles
@@ -27,10 +29,22 @@ class Downloader:
             time.sleep(1)
             return
 
+        start = time.perf_counter()
         try:
+            # prefetched files are queued without checking if we have them
+            if self.files_backend.check(url):
+                metrics.inc("mypypi_downloads_total", result="skipped")
+                return
+
             self.files_backend.save(url)
+            size = self.files_backend.record(url)
         except Exception:
             logger.exception(f"Failed to save {url}")
+            metrics.inc("mypypi_downloads_total", result="failed")
+        else:
+            metrics.inc("mypypi_downloads_total", result="ok")
+            metrics.inc("mypypi_download_bytes_total", size)
+            metrics.observe("mypypi_download_seconds", time.perf_counter() - start)
         finally:
             self.database.del_file_download_job(url)
 
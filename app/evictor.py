@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING, Optional
+
+from loguru import logger
+from redis.exceptions import LockError
+from redis.lock import Lock
+
+from app.config import flask_app
+
+if TYPE_CHECKING:
+    from app.database import Database
+    from app.files.base import BaseFiles
+
+
+class Evictor:
+    def __init__(self, database: Database, files_backend: BaseFiles) -> None:
+        self.database = database
+        self.files_backend = files_backend
+
+        self.quota: int = flask_app.config["STORAGE_QUOTA"]
+        self.policy: str = flask_app.config["EVICTION_POLICY"]
+        self.target: int = int(self.quota * flask_app.config["EVICTION_TARGET"])
+        self.interval: int = flask_app.config["EVICTION_INTERVAL"]
+
+        logger.debug("Initializing Evictor")
+
+    def evict(self, url: str) -> None:
+        """
+        Delete a file from our storage and stop tracking it.
+        """
+        try:
+            self.files_backend.delete(url)
+        except FileNotFoundError:
+            # already gone, just stop tracking it
+            pass
+
+        self.database.remove_file(url, counted=not self.files_backend.content_addressed)
+
+    def backfill(self, lock: Optional[Lock] = None) -> int:
+        """
+        Record the size of every file in our storage that is not being tracked,
+        such as files saved by earlier versions. Returns how many were recorded.
+        If given, the lock is renewed as backfilling goes on.
+        """
+        recorded = 0
+
+        for urls in self.files_backend.candidate_urls():
+            # raises if the lock expired, so two workers never backfill at once
+            if lock is not None:
+                lock.reacquire()
+
+            batch = list(dict.fromkeys(urls))
+            for url, size in zip(batch, self.database.get_file_sizes(batch)):
+                if size is not None:
+                    continue
+
+                try:
+                    self.files_backend.record(url)
+                    recorded += 1
+                except (FileNotFoundError, ValueError):
+                    # most recorded urls were never stored, or were evicted
+                    pass
+                except Exception:
+                    logger.exception(f"Failed to record {url}")
+
+        logger.info(f"Recorded the size of {recorded} untracked files")
+        return recorded
+
+    def backfill_once(self, lock: Optional[Lock] = None) -> None:
+        """
+        Backfill, unless any worker has already done so.
+        """
+        if self.database.get_file_sizes_backfilled():
+            return
+
+        self.backfill(lock)
+        self.database.set_file_sizes_backfilled()
+
+    def execute(self, lock: Optional[Lock] = None) -> None:
+        """
+        If our storage is over quota, evict files until it is under the target size.
+        If given, the lock is renewed as eviction goes on.
+        """
+        total = self.database.get_files_size_total()
+        if total <= self.quota:
+            return
+
+        logger.info(
+            f"Storage is over quota ({total} > {self.quota} bytes), "
+            f"evicting with {self.policy} policy"
+        )
+
+        # files with download jobs are about to be written again, so skip them
+        skipped = 0
+        while total > self.target:
+            candidates = self.database.get_file_eviction_candidates(
+                self.policy, skipped, 100
+            )
+            if not candidates:
+                break
+
+            # raises if the lock expired, so two workers never evict at once
+            if lock is not None:
+                lock.reacquire()
+
+            for url in candidates:
+                if total <= self.target:
+                    break
+
+                if self.database.has_file_download_job(url):
+                    skipped += 1
+                    continue
+
+                try:
+                    self.evict(url)
+                    # content shared with other files frees nothing
+                    total = self.database.get_files_size_total()
+                except Exception:
+                    logger.exception(f"Failed to evict {url}")
+                    skipped += 1
+
+        logger.info(f"Storage is now {total} bytes")
+
+    def run(self) -> None:
+        """
+        Run the Evictor infinitely. Only one Evictor across all workers
+        runs at a time. Untracked files are backfilled first, once.
+        """
+        while True:
+            lock = self.database.lock("evictor", timeout=self.interval * 10)
+            if lock.acquire(blocking=False):
+                try:
+                    self.backfill_once(lock)
+                    self.execute(lock)
+                except Exception:
+                    logger.exception("Evictor failed")
+                finally:
+                    try:
+                        lock.release()
+                    except LockError:
+                        # expired, and may be held by another worker by now
+                        logger.warning("Evictor lock expired before it was released")
+
+            time.sleep(self.interval)
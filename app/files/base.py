@@ -1,7 +1,10 @@
 import abc
+import hashlib
+import itertools
 import os
+import urllib.parse
 from http import HTTPStatus
-from typing import Generator
+from typing import IO, Any, Dict, Generator, Iterable, List, Optional, Tuple
 
 import flask
 import requests
@@ -9,15 +12,26 @@ import requests.auth
 import werkzeug
 from loguru import logger
 
+import app.libraries.hashing
+import app.libraries.packument
 import app.libraries.url
+import app.libraries.wheel
+from app.backends import metrics
+from app.config import flask_app
 from app.database import Database
-from app.main import flask_app
+from app.proxy import Proxy
+
+# how many records to read from the database at once, when scanning
+scan_chunk_size = 1000
 
 
 class BaseFiles(abc.ABC):
     def __init__(self, database: Database) -> None:
         self.database = database
 
+        # store files by the hash of their contents, rather than by name
+        self.content_addressed = flask_app.config["FILE_STORAGE_LAYOUT"] == "content"
+
     def build_path(self, file_url: str) -> str:
         """
         Given a remote file url, return the path to save/load the file.
@@ -31,11 +45,11 @@ class BaseFiles(abc.ABC):
                 package, version, app.libraries.url.url_filename(file_url)
             )
 
-    def download(self, file_url: str) -> Generator[bytes, None, None]:
+    def _request_kwargs(self) -> Dict[str, Any]:
         """
-        Download a remote file and return a generator of bytes.
+        Build the keyword arguments for requests made to the upstream.
         """
-        kwargs = {}
+        kwargs: Dict[str, Any] = {"headers": {"User-Agent": "mypypi 1.0"}}
 
         # add credentials if they are configured
         if (
@@ -47,14 +61,137 @@ class BaseFiles(abc.ABC):
                 flask_app.config["UPSTREAM_PASSWORD"],
             )
 
-        response = requests.get(
-            file_url, stream=True, headers={"User-Agent": "mypypi 1.0"}, **kwargs
-        )
+        return kwargs
+
+    def build_blob_path(self, digest: str) -> str:
+        """
+        Given a sha256 hex digest, return the path to save/load the content.
+        """
+        return os.path.join("blobs", digest[:2], digest[2:4], digest)
+
+    def storage_path(self, file_url: str) -> Optional[str]:
+        """
+        Given a remote file url, return the path the file is stored at.
+        Returns None if we don't know where the file would be yet.
+        """
+        if self.content_addressed:
+            digest = self.database.get_file_blob(file_url)
+            if digest is None:
+                return None
+
+            return self.build_blob_path(digest)
+
+        return self.build_path(file_url)
+
+    def _cached_npm_dist(self, package: str, version: str) -> Optional[Dict[str, Any]]:
+        """
+        Given an npm package name and version, return the dist object of the
+        version from a packument we have cached, in either representation.
+        """
+        url = f"{flask_app.config['UPSTREAM_URL']}/{package}"
+
+        # the abbreviated representation is much smaller, so is searched first
+        for accept in (app.libraries.packument.ABBREVIATED_MIMETYPE, None):
+            _, url_cache = self.database.get_url_cache(Proxy.cache_key(url, accept))
+            if url_cache is None or url_cache["status_code"] != HTTPStatus.OK:
+                continue
+
+            manifest = app.libraries.packument.find_version(
+                url_cache["content"], version
+            )
+            if manifest is None:
+                continue
+
+            dist = manifest["dist"]
+            if "integrity" in dist or "shasum" in dist:
+                return dist
+
+        return None
+
+    def expected_hash(self, file_url: str) -> Optional[Tuple[str, str]]:
+        """
+        Given a remote file url, return the algorithm and hex digest
+        the upstream says the file has, if known.
+        """
+        if flask_app.config["PACKAGE_TYPE"] == "pypi":
+            return app.libraries.hashing.parse_url_hash(file_url)
+
+        # npm tarball hashes are listed in the packument
+        package, filename = app.libraries.url.parse_npm_file_url(file_url)
+        package = package.strip("/")
+        version = app.libraries.url.npm_tarball_version(package, filename)
+
+        dist = self._cached_npm_dist(package, version)
+        if dist is None:
+            # only ask the upstream for the version document if we must
+            try:
+                response = requests.get(
+                    f"{flask_app.config['UPSTREAM_URL']}/{package}/{version}",
+                    **self._request_kwargs(),
+                )
+                response.raise_for_status()
+                dist = response.json()["dist"]
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.warning(f"Could not get the hash of {file_url}: {e}")
+                return None
+
+        if "integrity" in dist:
+            return app.libraries.hashing.parse_integrity(dist["integrity"])
+        if "shasum" in dist:
+            return "sha1", dist["shasum"].lower()
+
+        return None
+
+    def download(
+        self, file_url: str, hasher: Optional["hashlib._Hash"] = None
+    ) -> Generator[bytes, None, None]:
+        """
+        Download a remote file and return a generator of bytes.
+        The content is verified against the upstream hash as it streams, and
+        IntegrityError is raised at the end if it does not match. Optionally,
+        the content is also fed to the given hash object.
+        """
+        expected = self.expected_hash(file_url)
+        verifier = hashlib.new(expected[0]) if expected is not None else None
+
+        response = requests.get(file_url, stream=True, **self._request_kwargs())
 
         # don't save 404 data for example
         response.raise_for_status()
 
-        yield from response.iter_content(chunk_size=1024)
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            if verifier is not None:
+                verifier.update(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+
+            yield chunk
+
+        if expected is not None and verifier is not None:
+            if verifier.hexdigest() != expected[1]:
+                raise app.libraries.hashing.IntegrityError(
+                    f"{expected[0]} of {file_url} is {verifier.hexdigest()}, expected {expected[1]}"
+                )
+        else:
+            logger.debug(f"No hash to verify {file_url} with")
+
+    def record(self, file_url: str) -> int:
+        """
+        Given a remote file url that was just saved, record it for eviction
+        and size accounting. Returns the size of the file.
+        """
+        size = self.size(file_url)
+        # content shared by several files is counted once, by its digest
+        self.database.add_file(file_url, size, counted=not self.content_addressed)
+        return size
+
+    def queue(self, file_url: str) -> None:
+        """
+        Given a remote file url, add a job to download it, if there is not one already.
+        """
+        # if a task is not already queued
+        if not self.database.has_file_download_job(file_url):
+            self.database.add_file_download_job(file_url)
 
     def get(self, file_url: str) -> werkzeug.wrappers.Response:
         """
@@ -62,47 +199,325 @@ class BaseFiles(abc.ABC):
         Will download the file if it does not exist.
         """
         # if we already have the file
-        if self.check(file_url):
-            return self.retrieve(file_url)
+        with metrics.phase("storage"):
+            exists = self.check(file_url)
 
-        # if a task not in progress
-        if not self.database.check_file_download_job(file_url):
-            self.database.add_file_download_job(file_url)
+        if exists:
+            try:
+                with metrics.phase("storage"):
+                    response = self.retrieve(file_url)
+            except FileNotFoundError as e:
+                # removed since it was checked, or its storage can't be reached
+                logger.warning(e)
+            else:
+                # track access for eviction
+                if flask_app.config["STORAGE_QUOTA"]:
+                    self.database.record_file_access(file_url)
+
+                metrics.inc("mypypi_file_requests_total", result="hit")
+                return response
+
+        self.queue(file_url)
 
         # if strict about not sending to upstream
         if flask_app.config["UPSTREAM_STRICT"]:
+            metrics.inc("mypypi_file_requests_total", result="unavailable")
             return flask.abort(HTTPStatus.SERVICE_UNAVAILABLE)
 
+        metrics.inc("mypypi_file_requests_total", result="redirect")
+
         # redirect to original url
         logger.debug(f"Redirecting to {file_url}")
         # temporary redirect
         return flask.redirect(file_url, code=HTTPStatus.FOUND)
 
-    @abc.abstractmethod
+    def fetch_metadata(self, file_url: str) -> Optional[bytes]:
+        """
+        Given a remote wheel url, return its core metadata. Tries the upstream
+        PEP 658 metadata file first, then the wheel in our storage, and finally
+        the upstream wheel itself. Only the needed byte ranges of wheels are read.
+        """
+        # the url may still have the hash anchor attached
+        upstream_url = urllib.parse.urldefrag(file_url).url
+
+        response = requests.get(f"{upstream_url}.metadata", **self._request_kwargs())
+        if response.status_code == HTTPStatus.OK:
+            return response.content
+
+        if not upstream_url.endswith(".whl"):
+            return None
+
+        # read from our own copy of the wheel if we have it
+        if self.check(file_url):
+            logger.debug(f"Extracting metadata from stored {file_url}")
+            with self.open(file_url) as f:
+                return app.libraries.wheel.extract_metadata(f)
+
+        # otherwise, read only what is needed from the upstream wheel
+        logger.debug(f"Extracting metadata from upstream {file_url}")
+        upstream_file = app.libraries.wheel.RangedHTTPFile.open(
+            upstream_url, **self._request_kwargs()
+        )
+        if upstream_file is None:
+            return None
+
+        with upstream_file as f:
+            return app.libraries.wheel.extract_metadata(f)
+
+    def get_metadata(self, file_url: str) -> werkzeug.wrappers.Response:
+        """
+        Given a remote wheel url, return a flask response of its core metadata.
+        """
+        metadata = self.database.get_file_metadata(file_url)
+
+        if metadata is None:
+            try:
+                metadata_bytes = self.fetch_metadata(file_url)
+            except requests.exceptions.RequestException as e:
+                logger.error(e)
+                return flask.abort(HTTPStatus.SERVICE_UNAVAILABLE)
+
+            if metadata_bytes is None:
+                return flask.abort(HTTPStatus.NOT_FOUND)
+
+            metadata = metadata_bytes.decode("utf-8")
+            self.database.set_file_metadata(file_url, metadata)
+
+        return flask.Response(metadata, mimetype="text/plain")
+
     def check(self, file_url: str) -> bool:
         """
         Given a remote file url, return whether or not we have the file already.
         """
-        raise NotImplementedError
+        path = self.storage_path(file_url)
+        return path is not None and self._exists(path)
+
+    def _recorded_urls(self) -> Generator[List[str], None, None]:
+        """
+        Yield batches of the remote urls of files we have a record of, whether
+        or not we have them. Urls may be repeated.
+        """
+        # files served through a file key, and files that are being tracked
+        for batch in self.database.scan_file_url_keys(scan_chunk_size):
+            yield [url for _, url in batch]
+        for sizes in self.database.scan_file_sizes(scan_chunk_size):
+            yield [url for url, _ in sizes]
+
+    def _npm_path_url(self, path: str) -> str:
+        """
+        Given the path of an npm tarball stored by name, return its remote url.
+        """
+        package, filename = path.rsplit("/", 1)
+        return f"{flask_app.config['UPSTREAM_URL']}/{package}/-/{filename}"
+
+    def candidate_urls(self) -> Generator[List[str], None, None]:
+        """
+        Yield batches of the remote urls of files that may be in our storage,
+        without holding them all at once. Urls may be repeated.
+        """
+        yield from self._recorded_urls()
+
+        if flask_app.config["PACKAGE_TYPE"] == "npm" and not self.content_addressed:
+            # tarballs are stored by package name, so the path is reversible
+            paths = (path.replace("\\", "/") for path in self._walk())
+            urls = (self._npm_path_url(path) for path in paths if "/" in path)
+
+            while True:
+                batch = list(itertools.islice(urls, scan_chunk_size))
+                if not batch:
+                    break
+
+                yield batch
+
+    def stored_urls(self) -> Generator[str, None, None]:
+        """
+        Walk our storage, and yield the remote url of every file in it that
+        can be identified. npm tarballs stored by name are identified by their
+        path. Other files are identified by the urls we have a record of, so
+        files we know nothing about are skipped.
+        """
+        if self.content_addressed:
+            digests = {os.path.basename(path) for path in self._walk()}
+            seen = set()
+            for urls in self._recorded_urls():
+                for url, digest in zip(urls, self.database.get_file_blobs(urls)):
+                    if digest in digests and url not in seen:
+                        seen.add(url)
+                        yield url
+            return
+
+        known: Dict[str, str] = {}
+        for urls in self._recorded_urls():
+            for url in urls:
+                try:
+                    known[self.build_path(url).replace("\\", "/")] = url
+                except ValueError:
+                    pass
+
+        for path in self._walk():
+            path = path.replace("\\", "/")
+            if path in known:
+                yield known[path]
+            elif flask_app.config["PACKAGE_TYPE"] == "npm" and "/" in path:
+                # tarballs are stored by package name, so the path is reversible
+                yield self._npm_path_url(path)
 
-    @abc.abstractmethod
     def save(self, file_url: str) -> str:
         """
         Given a remote file url, download and save the file to our storage.
+        Returns the path the file was saved to.
         """
-        raise NotImplementedError
+        return self.store(file_url, self.download(file_url))
 
-    @abc.abstractmethod
-    def retrieve(self, file_url: str) -> flask.Response:
+    def store(self, file_url: str, chunks: Iterable[bytes]) -> str:
+        """
+        Given a remote file url and chunks of bytes of its content, save the
+        file to our storage. Returns the path the file was saved to.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+
+        def hashed() -> Generator[bytes, None, None]:
+            nonlocal size
+            for chunk in chunks:
+                hasher.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+        # write to a temporary location first, so partial or corrupt
+        # downloads are never visible
+        temp = self._write_temp(hashed())
+
+        if not self.content_addressed:
+            path = self.build_path(file_url)
+            logger.info(f"Saving {file_url} to {path}")
+            self._commit(temp, path)
+            return path
+
+        digest = hasher.hexdigest()
+        path = self.build_blob_path(digest)
+
+        # reference the content before checking it exists, so it is not
+        # deleted out from under us
+        self.database.add_file_blob(file_url, digest, size)
+
+        if self._exists(path):
+            logger.info(f"Already have {file_url} as {path}")
+            self._discard(temp)
+        else:
+            logger.info(f"Saving {file_url} to {path}")
+            self._commit(temp, path)
+
+        return path
+
+    def retrieve(self, file_url: str) -> werkzeug.wrappers.Response:
         """
         Given a remote file url, return a flask response.
         We must have the file already.
         """
-        raise NotImplementedError
+        return self._send(self._stored_path(file_url))
+
+    def open(self, file_url: str) -> IO[bytes]:
+        """
+        Given a remote file url, return a seekable binary file object.
+        We must have the file already.
+        """
+        return self._open(self._stored_path(file_url))
+
+    def size(self, file_url: str) -> int:
+        """
+        Given a remote file url, return the size of the file in bytes.
+        We must have the file already.
+        """
+        return self._size(self._stored_path(file_url))
 
-    @abc.abstractmethod
     def delete(self, file_url: str) -> None:
         """
         Given a remote file url, delete the file from our storage.
         """
+        path = self._stored_path(file_url)
+
+        # content may be shared by multiple urls
+        if self.content_addressed and self.database.remove_file_blob(file_url) > 0:
+            logger.info(f"Keeping {path}, as it is used by other files")
+            return
+
+        logger.info(f"Deleting file {path}")
+        self._remove(path)
+
+    def _stored_path(self, file_url: str) -> str:
+        """
+        Given a remote file url, return the path the file is stored at.
+        We must have the file already.
+        """
+        path = self.storage_path(file_url)
+        if path is None:
+            raise FileNotFoundError(f"{file_url} is not stored")
+
+        return path
+
+    # storage primitives, by storage path
+
+    @abc.abstractmethod
+    def _exists(self, path: str) -> bool:
+        """
+        Return whether or not a path exists in our storage.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _write_temp(self, chunks: Iterable[bytes]) -> str:
+        """
+        Write chunks of bytes to a temporary location in our storage,
+        and return that location.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _commit(self, temp: str, path: str) -> None:
+        """
+        Move a temporary location to a path in our storage.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _discard(self, temp: str) -> None:
+        """
+        Delete a temporary location from our storage.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _send(self, path: str) -> werkzeug.wrappers.Response:
+        """
+        Return a flask response for a path in our storage.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _open(self, path: str) -> IO[bytes]:
+        """
+        Return a seekable binary file object for a path in our storage.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _size(self, path: str) -> int:
+        """
+        Return the size in bytes of a path in our storage.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _walk(self) -> Iterable[str]:
+        """
+        Yield every path in our storage, not including temporary locations.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _remove(self, path: str) -> None:
+        """
+        Delete a path from our storage.
+        """
         raise NotImplementedError
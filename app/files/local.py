@@ -1,7 +1,8 @@
 import os
+import tempfile
+from typing import IO, Iterable
 
 import flask
-from loguru import logger
 
 from app.database import Database
 from app.files.base import BaseFiles
@@ -15,52 +16,60 @@ class LocalFiles(BaseFiles):
         # create the the directory to save files to
         os.makedirs(self.directory, exist_ok=True)
 
-    def build_path(self, file_url: str) -> str:
-        return os.path.join(self.directory, super().build_path(file_url))
-
-    def check(self, file_url: str) -> bool:
-        # checks if the file exists
-        file_path = self.build_path(file_url)
-        lock_file = f"{file_path}.lock"
-
-        result = os.path.exists(file_path)
-
-        # check if lock file exists, means we're still downloading
-        if os.path.exists(lock_file):
-            result = False
-
-        return result
-
-    def save(self, file_url: str) -> str:
-        # build path to save file to
-        file_path = self.build_path(file_url)
-        lock_file = f"{file_path}.lock"
-
+        # create the directory to download files to before they are complete
+        self.temp_directory = os.path.join(self.directory, ".incoming")
+        os.makedirs(self.temp_directory, exist_ok=True)
+
+    def full_path(self, path: str) -> str:
+        """
+        Given a storage path, return the absolute path on disk.
+        """
+        return os.path.join(self.directory, path)
+
+    def _exists(self, path: str) -> bool:
+        return os.path.exists(self.full_path(path))
+
+    def _write_temp(self, chunks: Iterable[bytes]) -> str:
+        with tempfile.NamedTemporaryFile(dir=self.temp_directory, delete=False) as f:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+
+        return f.name
+
+    def _commit(self, temp: str, path: str) -> None:
+        file_path = self.full_path(path)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        logger.info(f"Saving {file_url} to {file_path}")
-
-        # create a lock file to denote download is in progress
-        with open(lock_file, "w") as f:
-            f.write("")
+        # atomic, so the file is never seen partially written
+        os.replace(temp, file_path)
 
-        # save the file
-        with open(file_path, "wb") as f:
-            for chunk in self.download(file_url):
-                f.write(chunk)
+    def _discard(self, temp: str) -> None:
+        os.remove(temp)
 
-        # remove lock file
-        os.remove(lock_file)
-
-        return file_path
-
-    def retrieve(self, file_url: str) -> flask.Response:
+    def _send(self, path: str) -> flask.Response:
         # make response to send the file
-        file_path = self.build_path(file_url)
+        file_path = self.full_path(path)
         return flask.send_from_directory(
             os.path.dirname(file_path), os.path.basename(file_path), as_attachment=True
         )
 
-    def delete(self, file_url: str) -> None:
-        file_path = self.build_path(file_url)
-        logger.info(f"Deleting file {file_path}")
-        os.remove(file_path)
+    def _open(self, path: str) -> IO[bytes]:
+        return open(self.full_path(path), "rb")
+
+    def _size(self, path: str) -> int:
+        return os.path.getsize(self.full_path(path))
+
+    def _walk(self) -> Iterable[str]:
+        for root, _, filenames in os.walk(self.directory):
+            if root.startswith(self.temp_directory):
+                continue
+
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(root, filename), self.directory)
+
+    def _remove(self, path: str) -> None:
+        os.remove(self.full_path(path))
@@ -1,6 +1,7 @@
 import http
 import urllib.parse
-from typing import Optional
+import uuid
+from typing import IO, Iterable, Optional
 
 import cachetools.func
 import flask
@@ -8,9 +9,9 @@ import s3fs
 import werkzeug
 from loguru import logger
 
+from app.config import flask_app
 from app.database import Database
 from app.files.base import BaseFiles
-from app.main import flask_app
 
 
 class S3Files(BaseFiles):
@@ -42,9 +43,12 @@ class S3Files(BaseFiles):
         self._is_public = public
         self.prefix = prefix
 
-    def build_path(self, file_url: str) -> str:
+    def full_path(self, path: str) -> str:
+        """
+        Given a storage path, return the path in the bucket.
+        """
         # normalize the url from filesystem paths
-        path = super().build_path(file_url).replace("\\", "/")
+        path = path.replace("\\", "/")
 
         # add prefix
         if self.prefix:
@@ -52,26 +56,38 @@ class S3Files(BaseFiles):
 
         return f"{self.bucket}/{path}"
 
-    def check(self, file_url: str) -> bool:
-        file_path = self.build_path(file_url)
-        return self.fs.exists(file_path)
+    def _exists(self, path: str) -> bool:
+        return self.fs.exists(self.full_path(path))
 
-    def save(self, file_url: str) -> str:
-        file_path = self.build_path(file_url)
-        logger.info(f"Uploading {file_url} to {file_path}")
+    def _write_temp(self, chunks: Iterable[bytes]) -> str:
+        temp = self.full_path(f".incoming/{uuid.uuid4().hex}")
 
-        with self.fs.open(file_path, "wb") as f:
-            for chunk in self.download(file_url):
-                f.write(chunk)
+        try:
+            with self.fs.open(temp, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except BaseException:
+            # the upload may have been completed when the file was closed
+            if self.fs.exists(temp):
+                self.fs.rm_file(temp)
+            raise
 
-        return self.fs.url(file_path, expires=flask_app.config["S3_KEY_TTL"])
+        return temp
+
+    def _commit(self, temp: str, path: str) -> None:
+        # copies within the bucket, so the object is never seen partially written
+        self.fs.mv(temp, self.full_path(path))
+
+    def _discard(self, temp: str) -> None:
+        self.fs.rm_file(temp)
 
     @cachetools.func.ttl_cache(
         maxsize=None, ttl=flask_app.config["FILE_URL_EXPIRATION"]
     )
-    def retrieve(self, file_url: str) -> werkzeug.wrappers.Response:
-        file_path = self.build_path(file_url)
-        return_url: str = self.fs.url(file_path, expires=flask_app.config["S3_KEY_TTL"])
+    def _send(self, path: str) -> werkzeug.wrappers.Response:
+        return_url: str = self.fs.url(
+            self.full_path(path), expires=flask_app.config["S3_KEY_TTL"]
+        )
 
         if self._is_public:
             # remove the query parameters from the url, so pip
@@ -86,7 +102,19 @@ class S3Files(BaseFiles):
         logger.info(f"Redirecting to {return_url} with code {redirect_code}")
         return flask.redirect(return_url, code=redirect_code)
 
-    def delete(self, file_url: str) -> None:
-        file_path = self.build_path(file_url)
-        logger.info(f"Deleting file {file_path}")
-        self.fs.rm_file(file_path)
+    def _open(self, path: str) -> IO[bytes]:
+        # s3fs files are seekable and fetch byte ranges on demand
+        return self.fs.open(self.full_path(path), "rb")
+
+    def _size(self, path: str) -> int:
+        return self.fs.size(self.full_path(path))
+
+    def _walk(self) -> Iterable[str]:
+        root = self.full_path("")
+        for key in self.fs.find(root):
+            path = key.removeprefix(root)
+            if not path.startswith(".incoming/"):
+                yield path
+
+    def _remove(self, path: str) -> None:
+        self.fs.rm_file(self.full_path(path))
@@ -0,0 +1,334 @@
+import hashlib
+import hmac
+import os
+import time
+import urllib.parse
+from http import HTTPStatus
+from typing import IO, Any, Dict, Iterable, List
+
+import flask
+import requests
+import werkzeug
+from loguru import logger
+
+import app.libraries.hashing
+import app.libraries.wheel
+from app.database import Database
+from app.files.base import BaseFiles
+from app.files.local import LocalFiles
+from app.libraries.hashring import HashRing
+
+# header internal cluster requests are authenticated with
+SECRET_HEADER = "X-Mypypi-Cluster-Secret"
+# header to verify files pushed between nodes with
+SHA256_HEADER = "X-Mypypi-Content-SHA256"
+# connect and read timeouts of requests to other nodes, in seconds
+NODE_TIMEOUT = (3, 10)
+# how long links to other nodes that clients are redirected to work for, in seconds
+SIGNED_URL_TTL = 10 * 60
+
+
+class ShardedFiles(BaseFiles):
+    """
+    Local file storage sharded across cluster nodes by consistent hashing of
+    the storage path. Paths owned by other nodes are accessed through their
+    internal cluster routes.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        local: LocalFiles,
+        nodes: List[str],
+        node: str,
+        secret: str,
+        proxy: bool = False,
+        replicas: int = 100,
+        draining: bool = False,
+    ) -> None:
+        super().__init__(database)
+
+        # a node being removed from the cluster is outside the ring, so it
+        # owns nothing and rebalancing sends all of its files away
+        if node not in nodes and not draining:
+            raise ValueError(f"Cluster node {node} is not one of {nodes}")
+        if not secret:
+            raise ValueError("A cluster secret is required")
+
+        self.local = local
+        self.node = node
+        self.secret = secret
+        self.proxy = proxy
+        self.ring = HashRing(nodes, replicas)
+
+    def owner(self, path: str) -> str:
+        """
+        Return the node that owns a storage path.
+        """
+        return self.ring.get_node(path.replace("\\", "/"))
+
+    def _node_url(self, node: str, path: str) -> str:
+        """
+        Return the URL of a storage path on a node's internal cluster route.
+        """
+        quoted = urllib.parse.quote(path.replace("\\", "/"))
+        return f"{node.rstrip('/')}/_cluster/files/{quoted}"
+
+    def _node_kwargs(self) -> Dict[str, Any]:
+        """
+        Build the keyword arguments for requests made to other nodes.
+        """
+        return {"headers": {SECRET_HEADER: self.secret}, "timeout": NODE_TIMEOUT}
+
+    def authorized(self, secret: str) -> bool:
+        """
+        Whether or not an internal cluster request carries our secret.
+        """
+        return hmac.compare_digest(secret, self.secret)
+
+    def sign(self, path: str, expires: int) -> str:
+        """
+        Sign a storage path until a time, so it can be read without our secret.
+        """
+        path = path.replace("\\", "/")
+        message = f"{path}\n{expires}".encode("utf-8")
+        return hmac.new(
+            self.secret.encode("utf-8"), message, hashlib.sha256
+        ).hexdigest()
+
+    def authorized_url(self, path: str, expires: str, signature: str) -> bool:
+        """
+        Whether or not a request for a storage path carries a current signature.
+        """
+        try:
+            expires_at = int(expires)
+        except ValueError:
+            return False
+
+        if expires_at < time.time():
+            return False
+
+        return hmac.compare_digest(signature, self.sign(path, expires_at))
+
+    def _signed_node_url(self, node: str, path: str) -> str:
+        """
+        Return a URL of a storage path on a node's internal cluster route
+        that clients can read from for a while.
+        """
+        expires = int(time.time()) + SIGNED_URL_TTL
+        query = urllib.parse.urlencode(
+            {"expires": expires, "signature": self.sign(path, expires)}
+        )
+        return f"{self._node_url(node, path)}?{query}"
+
+    def _push(self, node: str, path: str, file_path: str) -> None:
+        """
+        Upload a local file to the node that owns its storage path.
+        """
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+
+        kwargs = self._node_kwargs()
+        kwargs["headers"][SHA256_HEADER] = hasher.hexdigest()
+
+        with open(file_path, "rb") as f:
+            response = requests.put(self._node_url(node, path), data=f, **kwargs)
+        response.raise_for_status()
+
+    # internal cluster routes
+
+    def serve_local(self, path: str) -> werkzeug.wrappers.Response:
+        """
+        Send a storage path we own. Supports range requests.
+        """
+        if not self.local._exists(path):
+            return flask.abort(HTTPStatus.NOT_FOUND)
+
+        return self.local._send(path)
+
+    def receive_local(self, path: str, chunks: Iterable[bytes], sha256: str) -> None:
+        """
+        Save a storage path pushed to us by another node.
+        """
+        hasher = hashlib.sha256()
+
+        def verified() -> Iterable[bytes]:
+            for chunk in chunks:
+                hasher.update(chunk)
+                yield chunk
+
+        temp = self.local._write_temp(verified())
+        if hasher.hexdigest() != sha256:
+            self.local._discard(temp)
+            raise app.libraries.hashing.IntegrityError(
+                f"sha256 of pushed {path} is {hasher.hexdigest()}, expected {sha256}"
+            )
+
+        self.local._commit(temp, path)
+
+    def remove_local(self, path: str) -> None:
+        """
+        Delete a storage path we own.
+        """
+        self.local._remove(path)
+
+    # rebalancing
+
+    def rebalance(self) -> int:
+        """
+        Move every local file that this node no longer owns to its owner.
+        Only files whose owner changed are moved. Returns how many files moved.
+        """
+        moved = 0
+
+        for root, _, filenames in os.walk(self.local.directory):
+            if root.startswith(self.local.temp_directory):
+                continue
+
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                path = os.path.relpath(file_path, self.local.directory)
+
+                owner = self.owner(path)
+                if owner == self.node:
+                    continue
+
+                try:
+                    logger.info(f"Moving {path} to {owner}")
+                    self._push(owner, path, file_path)
+                    os.remove(file_path)
+                    moved += 1
+                except Exception:
+                    logger.exception(f"Failed to move {path} to {owner}")
+
+        logger.info(f"Moved {moved} files")
+        return moved
+
+    # storage primitives
+
+    def _exists(self, path: str) -> bool:
+        owner = self.owner(path)
+        if owner == self.node:
+            return self.local._exists(path)
+
+        try:
+            response = requests.head(self._node_url(owner, path), **self._node_kwargs())
+        except requests.exceptions.RequestException as e:
+            # so the file is fetched from the upstream instead
+            logger.warning(f"Could not reach {owner} to check {path}: {e}")
+            return False
+
+        return response.status_code == HTTPStatus.OK
+
+    def _write_temp(self, chunks: Iterable[bytes]) -> str:
+        return self.local._write_temp(chunks)
+
+    def _commit(self, temp: str, path: str) -> None:
+        owner = self.owner(path)
+        if owner == self.node:
+            self.local._commit(temp, path)
+            return
+
+        try:
+            self._push(owner, path, temp)
+        finally:
+            self.local._discard(temp)
+
+    def _discard(self, temp: str) -> None:
+        self.local._discard(temp)
+
+    def _send(self, path: str) -> werkzeug.wrappers.Response:
+        owner = self.owner(path)
+        if owner == self.node:
+            return self.local._send(path)
+
+        if not self.proxy:
+            url = self._signed_node_url(owner, path)
+            logger.debug(f"Redirecting to {url}")
+            return flask.redirect(url, code=HTTPStatus.FOUND)
+
+        # stream the file through from the owner
+        try:
+            response = requests.get(
+                self._node_url(owner, path), stream=True, **self._node_kwargs()
+            )
+        except requests.exceptions.RequestException as e:
+            raise FileNotFoundError(
+                f"Could not reach {owner} to send {path}: {e}"
+            ) from e
+
+        if response.status_code != HTTPStatus.OK:
+            response.close()
+            raise FileNotFoundError(f"{owner} does not have {path}")
+
+        return flask.Response(
+            response.iter_content(chunk_size=64 * 1024),
+            response.status_code,
+            [
+                (name, value)
+                for name, value in response.headers.items()
+                if name.lower()
+                in ("content-type", "content-length", "content-disposition")
+            ],
+        )
+
+    def _open(self, path: str) -> IO[bytes]:
+        owner = self.owner(path)
+        if owner == self.node:
+            return self.local._open(path)
+
+        try:
+            remote_file = app.libraries.wheel.RangedHTTPFile.open(
+                self._node_url(owner, path), **self._node_kwargs()
+            )
+        except requests.exceptions.RequestException as e:
+            raise FileNotFoundError(
+                f"Could not reach {owner} to open {path}: {e}"
+            ) from e
+
+        if remote_file is None:
+            raise FileNotFoundError(path)
+
+        return remote_file
+
+    def _size(self, path: str) -> int:
+        owner = self.owner(path)
+        if owner == self.node:
+            return self.local._size(path)
+
+        try:
+            response = requests.head(self._node_url(owner, path), **self._node_kwargs())
+        except requests.exceptions.RequestException as e:
+            raise FileNotFoundError(
+                f"Could not reach {owner} to size {path}: {e}"
+            ) from e
+
+        if response.status_code != HTTPStatus.OK:
+            raise FileNotFoundError(f"{owner} does not have {path}")
+
+        return int(response.headers["Content-Length"])
+
+    def _walk(self) -> Iterable[str]:
+        # every node walks the files it holds itself
+        return self.local._walk()
+
+    def _remove(self, path: str) -> None:
+        owner = self.owner(path)
+        if owner == self.node:
+            self.local._remove(path)
+            return
+
+        # an unreachable owner still has the file, so this is not treated
+        # as missing, and the file stays tracked to be removed later
+        try:
+            response = requests.delete(
+                self._node_url(owner, path), **self._node_kwargs()
+            )
+        except requests.exceptions.RequestException as e:
+            raise OSError(f"Could not reach {owner} to remove {path}: {e}") from e
+
+        if response.status_code == HTTPStatus.NOT_FOUND:
+            raise FileNotFoundError(path)
+        response.raise_for_status()
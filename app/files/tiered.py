@@ -0,0 +1,197 @@
+import concurrent.futures
+import os
+import threading
+import time
+from typing import IO, Iterable, Set
+
+import werkzeug
+from loguru import logger
+from redis.exceptions import LockError
+
+from app.config import flask_app
+from app.database import Database
+from app.files.base import BaseFiles
+from app.files.local import LocalFiles
+from app.files.s3 import S3Files
+
+
+class TieredFiles(BaseFiles):
+    """
+    Local disk as a bounded hot tier in front of S3 as the durable tier.
+    Files are served from local disk when possible. Otherwise, clients are
+    redirected to S3 while the file is promoted to local disk in the background.
+    Saved files are written to local disk, and through to S3 in the background.
+    """
+
+    def __init__(
+        self, database: Database, local: LocalFiles, remote: S3Files, max_bytes: int
+    ) -> None:
+        super().__init__(database)
+
+        self.local = local
+        self.remote = remote
+        self.max_bytes = max_bytes
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=flask_app.config["TIERED_WORKERS"]
+        )
+        self._in_progress: Set[str] = set()
+        self._in_progress_lock = threading.Lock()
+        self._last_trim = 0.0
+
+    def _submit(self, name: str, path: str) -> None:
+        """
+        Run a background task for a path, unless one is already running.
+        """
+        key = f"{name}:{path}"
+        with self._in_progress_lock:
+            if key in self._in_progress:
+                return
+            self._in_progress.add(key)
+
+        def task() -> None:
+            try:
+                getattr(self, name)(path)
+                self._trim()
+            except Exception:
+                logger.exception(f"Failed to {name.strip('_')} {path}")
+            finally:
+                with self._in_progress_lock:
+                    self._in_progress.discard(key)
+
+        self._executor.submit(task)
+
+    def _upload(self, path: str) -> None:
+        """
+        Write a file through from local disk to S3.
+        """
+        logger.info(f"Uploading {path} to S3")
+        self.remote.fs.put(self.local.full_path(path), self.remote.full_path(path))
+
+    def _promote(self, path: str) -> None:
+        """
+        Copy a file from S3 to local disk.
+        """
+        if self.local._exists(path):
+            return
+
+        logger.info(f"Promoting {path} to local disk")
+        with self.remote._open(path) as f:
+            temp = self.local._write_temp(iter(lambda: f.read(1024 * 1024), b""))
+        self.local._commit(temp, path)
+
+    def _trim(self) -> None:
+        """
+        If local disk is over its size limit, remove the least recently
+        used files that are safely in S3.
+        """
+        now = time.time()
+        if now - self._last_trim < flask_app.config["TIERED_TRIM_INTERVAL"]:
+            return
+        self._last_trim = now
+
+        # only one process per local disk trims it, and without a node id
+        # only one process at all does
+        lock = self.database.lock(
+            f"tiered_trim:{flask_app.config['TIERED_NODE_ID']}:{self.local.directory}",
+            timeout=flask_app.config["TIERED_TRIM_INTERVAL"] * 10,
+        )
+        if not lock.acquire(blocking=False):
+            return
+
+        try:
+            files = []
+            total = 0
+            for root, _, filenames in os.walk(self.local.directory):
+                if root.startswith(self.local.temp_directory):
+                    continue
+
+                for filename in filenames:
+                    stat = os.stat(os.path.join(root, filename))
+                    files.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(root, filename))
+                    )
+                    total += stat.st_size
+
+            if total <= self.max_bytes:
+                return
+
+            # the modified time is bumped on every local hit
+            target = int(self.max_bytes * 0.9)
+            for _, size, file_path in sorted(files):
+                if total <= target:
+                    break
+
+                path = os.path.relpath(file_path, self.local.directory)
+                if not self.remote._exists(path):
+                    # never lose the only copy
+                    self._submit("_upload", path)
+                    continue
+
+                logger.info(f"Removing {path} from local disk")
+                self.local._remove(path)
+                total -= size
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                # expired, and may be held by another node by now
+                logger.warning("Local disk trim lock expired before it was released")
+
+    def _exists(self, path: str) -> bool:
+        return self.local._exists(path) or self.remote._exists(path)
+
+    def _write_temp(self, chunks: Iterable[bytes]) -> str:
+        return self.local._write_temp(chunks)
+
+    def _commit(self, temp: str, path: str) -> None:
+        self.local._commit(temp, path)
+        self._submit("_upload", path)
+
+    def _discard(self, temp: str) -> None:
+        self.local._discard(temp)
+
+    def _send(self, path: str) -> werkzeug.wrappers.Response:
+        try:
+            # mark as recently used
+            os.utime(self.local.full_path(path))
+        except FileNotFoundError:
+            pass
+        else:
+            return self.local._send(path)
+
+        self._submit("_promote", path)
+        return self.remote._send(path)
+
+    def _open(self, path: str) -> IO[bytes]:
+        if self.local._exists(path):
+            return self.local._open(path)
+
+        return self.remote._open(path)
+
+    def _size(self, path: str) -> int:
+        if self.local._exists(path):
+            return self.local._size(path)
+
+        return self.remote._size(path)
+
+    def _walk(self) -> Iterable[str]:
+        # files may not have been written through yet
+        local = set()
+        for path in self.local._walk():
+            local.add(path.replace("\\", "/"))
+            yield path
+
+        for path in self.remote._walk():
+            if path not in local:
+                yield path
+
+    def _remove(self, path: str) -> None:
+        if self.local._exists(path):
+            self.local._remove(path)
+
+        try:
+            self.remote._remove(path)
+        except FileNotFoundError:
+            # was never written through
+            pass
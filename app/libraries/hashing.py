@@ -0,0 +1,44 @@
+import base64
+import urllib.parse
+from typing import Optional, Tuple
+
+# hash algorithms we are willing to verify files with
+ALGORITHMS = ["sha512", "sha384", "sha256", "sha1", "md5"]
+
+
+class IntegrityError(ValueError):
+    """
+    Raised when downloaded content does not match its expected hash.
+    """
+
+
+def parse_url_hash(url: str) -> Optional[Tuple[str, str]]:
+    """
+    Given a url with a `#<algorithm>=<hex digest>` anchor, as used on
+    simple pages, return the algorithm and hex digest.
+    """
+    fragment = urllib.parse.urlparse(url).fragment
+    algorithm, _, digest = fragment.partition("=")
+
+    if algorithm not in ALGORITHMS or not digest:
+        return None
+
+    return algorithm, digest.lower()
+
+
+def parse_integrity(integrity: str) -> Optional[Tuple[str, str]]:
+    """
+    Given a subresource integrity string, as used by npm, return the strongest
+    algorithm and its hex digest.
+    """
+    hashes = {}
+    for entry in integrity.split():
+        algorithm, _, digest = entry.partition("-")
+        if algorithm in ALGORITHMS and digest:
+            hashes[algorithm] = base64.b64decode(digest).hex()
+
+    for algorithm in ALGORITHMS:
+        if algorithm in hashes:
+            return algorithm, hashes[algorithm]
+
+    return None
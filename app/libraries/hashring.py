@@ -0,0 +1,32 @@
+import bisect
+import hashlib
+from typing import List
+
+
+class HashRing:
+    """
+    Consistent hash ring. Adding or removing a node only moves the keys
+    between it and its neighbors on the ring.
+    """
+
+    def __init__(self, nodes: List[str], replicas: int = 100) -> None:
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+
+        # each node is placed on the ring many times, to spread keys evenly
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def get_node(self, key: str) -> str:
+        """
+        Return the node that owns a key.
+        """
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
@@ -0,0 +1,136 @@
+import os
+from typing import Dict, List
+
+import orjson
+import packaging.requirements
+import packaging.utils
+
+from app.models.lockfile import LockedPackage
+
+# lockfile names that describe npm packages
+NPM_LOCKFILES = ["package-lock.json", "npm-shrinkwrap.json"]
+
+
+def parse_poetry_lock(text: str) -> List[LockedPackage]:
+    """
+    Given the text of a `poetry.lock` file, return the locked packages.
+    """
+    # only needed for this format, and only in the standard library from 3.11
+    try:
+        import tomllib
+    except ModuleNotFoundError:
+        import tomli as tomllib  # type: ignore
+
+    data = tomllib.loads(text)
+
+    # lock files before version 2 list files separately
+    metadata_files: Dict[str, List[Dict[str, str]]] = data.get("metadata", {}).get(
+        "files", {}
+    )
+
+    packages = []
+    for package in data.get("package", []):
+        # skip things like path and git dependencies
+        if package.get("source", {}).get("type") not in (None, "legacy"):
+            continue
+
+        files = package.get("files", metadata_files.get(package["name"], []))
+        packages.append(
+            LockedPackage(
+                name=packaging.utils.canonicalize_name(package["name"]),
+                version=package["version"],
+                filenames=[f["file"] for f in files],
+                hashes=[
+                    f["hash"].removeprefix("sha256:")
+                    for f in files
+                    if f.get("hash", "").startswith("sha256:")
+                ],
+            )
+        )
+
+    return packages
+
+
+def parse_requirements(text: str) -> List[LockedPackage]:
+    """
+    Given the text of a `requirements.txt` file, return the pinned packages.
+    Requirements that are not pinned with `==` are ignored.
+    """
+    # join continued lines
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+
+    packages = []
+    for line in text.splitlines():
+        # remove comments
+        line = line.split(" #")[0].strip()
+        if not line or line.startswith(("#", "-")):
+            continue
+
+        # split off options, such as hashes
+        requirement_string, *options = line.split(" --")
+
+        try:
+            requirement = packaging.requirements.Requirement(requirement_string)
+        except packaging.requirements.InvalidRequirement:
+            continue
+
+        specifiers = list(requirement.specifier)
+        if len(specifiers) != 1 or specifiers[0].operator not in ("==", "==="):
+            continue
+
+        packages.append(
+            LockedPackage(
+                name=packaging.utils.canonicalize_name(requirement.name),
+                version=specifiers[0].version,
+                filenames=[],
+                hashes=[
+                    option.strip().removeprefix("hash=").removeprefix("sha256:")
+                    for option in options
+                    if option.strip().startswith("hash=sha256:")
+                ],
+            )
+        )
+
+    return packages
+
+
+def parse_package_lock(text: str) -> List[str]:
+    """
+    Given the text of a `package-lock.json` file, return the tarball URLs.
+    """
+    data = orjson.loads(text)
+    urls = []
+
+    # lockfile version 2 and later
+    for path, package in data.get("packages", {}).items():
+        if path and "resolved" in package and not package.get("link", False):
+            urls.append(package["resolved"])
+
+    # lockfile version 1 has nested dependencies
+    if not urls:
+        dependencies = list(data.get("dependencies", {}).values())
+        while dependencies:
+            dependency = dependencies.pop()
+            if "resolved" in dependency:
+                urls.append(dependency["resolved"])
+            dependencies.extend(dependency.get("dependencies", {}).values())
+
+    # only registry tarballs
+    return [url for url in urls if url.startswith("http") and "/-/" in url]
+
+
+def is_npm_lockfile(path: str) -> bool:
+    """
+    Whether or not a lockfile path describes npm packages.
+    """
+    return os.path.basename(path) in NPM_LOCKFILES
+
+
+def parse_pypi_lockfile(path: str, text: str) -> List[LockedPackage]:
+    """
+    Parse a PyPI lockfile based on its name.
+    """
+    if os.path.basename(path) == "poetry.lock":
+        return parse_poetry_lock(text)
+
+    return parse_requirements(text)
@@ -0,0 +1,106 @@
+import codecs
+import json
+import re
+from typing import IO, Any, Callable, Dict, Generator, Optional, Tuple
+
+import orjson
+
+# abbreviated package metadata, which is all that installs need
+ABBREVIATED_MIMETYPE = "application/vnd.npm.install-v1+json"
+
+# "tarball" only appears as a key inside of `versions.*.dist`. Quotes inside
+# of other string values are always escaped, so this cannot match within them.
+TARBALL_PATTERN = re.compile(r'"tarball"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def rewrite_tarballs(
+    content: str, rewrite: Callable[[str], str]
+) -> Generator[str, None, None]:
+    """
+    Given the text of an npm packument, rewrite all of the `dist.tarball` URLs
+    without parsing the document. The result is yielded in pieces, so no
+    second copy of the document is built, but the text itself is in memory.
+    """
+    position = 0
+
+    for match in TARBALL_PATTERN.finditer(content):
+        start, end = match.span(1)
+        yield content[position:start]
+
+        # decode and re-encode as JSON strings to handle escapes
+        url = orjson.loads(f'"{match.group(1)}"')
+        yield orjson.dumps(rewrite(url)).decode("utf-8")[1:-1]
+
+        position = end
+
+    yield content[position:]
+
+
+# "dist-tags" is a top level key, and "dist" only appears as a key of versions
+DIST_PATTERN = re.compile(r'"(dist-tags|dist)"\s*:\s*\{')
+
+
+def iter_dists(
+    f: IO[bytes], chunk_size: int = 64 * 1024
+) -> Generator[Tuple[str, Dict[str, Any]], None, None]:
+    """
+    Given a file of an npm packument, yield its `dist-tags` object and the
+    `dist` object of every version, in order, as a tuple of key and object.
+    Only these small objects are parsed, and the file is read in chunks,
+    so memory use stays bounded regardless of the document size.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    eof = False
+
+    def read() -> str:
+        nonlocal eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        return text_decoder.decode(chunk, final=eof)
+
+    while True:
+        match = DIST_PATTERN.search(buffer)
+        if match is None:
+            if eof:
+                return
+
+            # keep enough to match a key split between chunks
+            buffer = buffer[-32:] + read()
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buffer, match.end() - 1)
+        except json.JSONDecodeError:
+            if eof:
+                # the object is malformed, move on
+                buffer = buffer[match.end() :]
+            else:
+                # the object is split between chunks
+                buffer += read()
+            continue
+
+        yield match.group(1), value
+        buffer = buffer[end:]
+
+
+def find_version(content: str, version: str) -> Optional[Dict[str, Any]]:
+    """
+    Given the text of an npm packument, return the manifest of a version.
+    Only the manifest is parsed, rather than the whole document.
+    """
+    # versions are the only keys whose values are objects with a `dist`
+    pattern = re.compile(rf'"{re.escape(version)}"\s*:\s*\{{')
+    decoder = json.JSONDecoder()
+
+    for match in pattern.finditer(content):
+        try:
+            value, _ = decoder.raw_decode(content, match.end() - 1)
+        except json.JSONDecodeError:
+            continue
+
+        if isinstance(value, dict) and isinstance(value.get("dist"), dict):
+            return value
+
+    return None
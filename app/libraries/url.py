@@ -60,3 +60,12 @@ def parse_pypi_file_url(url: str) -> Tuple[str, str]:
         raise ValueError(f"Invalid filename: {filename}") from e
 
     return name, str(version)
+
+
+def npm_tarball_version(package: str, filename: str) -> str:
+    """
+    Given the package name and filename of an npm tarball, return its version.
+    """
+    # for example, @zzzen/pyright-internal and pyright-internal-1.1.254.tgz
+    name = package.strip("/").split("/")[-1]
+    return filename.removeprefix(f"{name}-").removesuffix(".tgz")
@@ -0,0 +1,105 @@
+import io
+import posixpath
+import zipfile
+from http import HTTPStatus
+from typing import IO, Any, Dict, Optional
+
+import requests
+
+
+def extract_metadata(fileobj: IO[bytes]) -> Optional[bytes]:
+    """
+    Given a seekable wheel file object, return the contents of the
+    `.dist-info/METADATA` file. Only the zip central directory and the
+    METADATA member are read, so this works efficiently over ranged reads.
+    Returns None if the wheel does not contain a METADATA file.
+    """
+    try:
+        with zipfile.ZipFile(fileobj) as zip_file:
+            for name in zip_file.namelist():
+                directory, filename = posixpath.split(name)
+                # METADATA must live in the top-level .dist-info directory
+                if (
+                    filename == "METADATA"
+                    and directory.endswith(".dist-info")
+                    and "/" not in directory
+                ):
+                    return zip_file.read(name)
+    except zipfile.BadZipFile:
+        return None
+
+    return None
+
+
+class RangedHTTPFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over HTTP using range requests.
+    """
+
+    def __init__(self, url: str, length: int, **kwargs: Any) -> None:
+        self.url = url
+        self.length = length
+        self._position = 0
+        self._kwargs = kwargs
+
+    @classmethod
+    def open(cls, url: str, **kwargs: Any) -> Optional[IO[bytes]]:
+        """
+        Open a remote file for ranged reading. Returns None if the server
+        does not support range requests.
+        """
+        response = requests.head(url, allow_redirects=True, **kwargs)
+        response.raise_for_status()
+
+        if (
+            response.headers.get("Accept-Ranges", "").lower() != "bytes"
+            or "Content-Length" not in response.headers
+        ):
+            return None
+
+        raw = cls(response.url, int(response.headers["Content-Length"]), **kwargs)
+        return io.BufferedReader(raw, buffer_size=64 * 1024)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        self._position = max(0, min(self._position, self.length))
+        return self._position
+
+    def readinto(self, buffer: Any) -> int:
+        size = min(len(buffer), self.length - self._position)
+        if size <= 0:
+            return 0
+
+        headers: Dict[str, str] = dict(self._kwargs.get("headers", {}))
+        headers["Range"] = f"bytes={self._position}-{self._position + size - 1}"
+        kwargs = {**self._kwargs, "headers": headers}
+
+        response = requests.get(self.url, **kwargs)
+        response.raise_for_status()
+
+        # a server may ignore the range and send the whole file
+        if response.status_code == HTTPStatus.PARTIAL_CONTENT:
+            data = response.content[:size]
+        else:
+            data = response.content[self._position : self._position + size]
+
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
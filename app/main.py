@@ -1,164 +1,192 @@
-import os
-from typing import Any
+import time
+from typing import Optional
 
-from dynaconf import FlaskDynaconf
-from flask import Flask, request
+from flask import Flask, g, request
 from loguru import logger
-from redis import Redis
 from werkzeug.wrappers.response import Response
 
-flask_app = Flask(__name__)
-FlaskDynaconf(flask_app, ENVVAR_PREFIX="MYPYPI")
+from app.backends import profiler
+from app.config import flask_app
+from app.database.connections import REDIS_MODES
+
+MODES = ("server", "worker", "warm", "sync", "export", "import", "rebalance")
 
 # =============================================================================
-# Set up default values
+# Routes
 # =============================================================================
 
 
-def default_value(key: str, value: Any) -> None:
+def register_pypi_routes() -> None:
     """
-    Set the default value of the flask config.
+    Register the routes of a PyPI mirror.
     """
-    flask_app.config[key] = flask_app.config.get(key, value)
-
-
-default_value("MODE", "server")
-
-# upstream
-default_value("PACKAGE_TYPE", "pypi")
+    from app.routes.pypi.files import files_bp
+    from app.routes.pypi.json import json_bp
+    from app.routes.pypi.simple import simple_bp
 
-if flask_app.config["PACKAGE_TYPE"] == "pypi":
-    default_value("UPSTREAM_URL", "https://pypi.org")
-elif flask_app.config["PACKAGE_TYPE"] == "npm":
-    default_value("UPSTREAM_URL", "https://registry.npmjs.org")
-else:
-    raise ValueError(f"Unknown mode: {flask_app.config['PACKAGE_TYPE']}")
+    # pypi routes
+    flask_app.register_blueprint(simple_bp)
+    flask_app.register_blueprint(json_bp)
 
-flask_app.config["UPSTREAM_URL"] = flask_app.config["UPSTREAM_URL"].rstrip("/")
+    # our internal routes
+    flask_app.register_blueprint(files_bp)
 
-default_value("UPSTREAM_STRICT", False)
 
-# data
-default_value("DATA_DIRECTORY", "data")
-default_value("FILE_STORAGE_DRIVER", "local")
-default_value("FILE_STORAGE_DIRECTORY", os.path.join("data", "files"))
-default_value("S3_PUBLIC", False)
-default_value("S3_KEY_TTL", 10 * 60)  # 10 minutes
-
-# determine how long file urls should be valid for, depending on file hosting type
-if (
-    flask_app.config["FILE_STORAGE_DRIVER"] == "s3"
-    and flask_app.config["S3_PUBLIC"] is False
-):
-    # non-public S3 storage will have a unique URL every time
-    # give a 60 second fudge factor
-    assert flask_app.config["S3_KEY_TTL"] > 60
-    flask_app.config["FILE_URL_EXPIRATION"] = flask_app.config["S3_KEY_TTL"] - 60
-else:
-    flask_app.config["FILE_URL_EXPIRATION"] = float("inf")
+def register_npm_routes() -> None:
+    """
+    Register the routes of an npm mirror.
+    """
+    from app.routes.npm.files import files_bp
+    from app.routes.npm.keys import keys_bp
+    from app.routes.npm.packages import packages_bp
 
-# persistent storage
-default_value("REDIS_URL", "redis://localhost:6379")
-default_value("REDIS_PREFIX", "mypypi")
-default_value("CACHE_TIME", 300)
+    # npm routes
+    flask_app.register_blueprint(keys_bp)
+    flask_app.register_blueprint(files_bp)
+    flask_app.register_blueprint(packages_bp)
 
 
 # =============================================================================
-# Set up backends
+# Hooks
 # =============================================================================
 
-# create Redis client
-redis_client = Redis.from_url(flask_app.config["REDIS_URL"], decode_responses=True)
-
-# create database
-from app.database import Database
 
-database_backend = Database(redis_client)
-
-# create proxy service
-from app.proxy import Proxy
-
-proxy = Proxy(database_backend)
+def _start_request() -> None:
+    """
+    Before each request, start timing it, and profiling it if enabled.
+    """
+    g.start = time.perf_counter()
+    g.phases = {}
 
-# setup file storage
-if flask_app.config["FILE_STORAGE_DRIVER"].lower() == "local":
-    import app.files.local
+    if flask_app.config["PROFILE_THRESHOLD"]:
+        g.profiling = profiler.start()
 
-    files_backend = app.files.local.LocalFiles(
-        database_backend,
-        os.path.join(
-            flask_app.config["FILE_STORAGE_DIRECTORY"],
-        ),
-    )
 
-elif flask_app.config["FILE_STORAGE_DRIVER"].lower() == "s3":
-    import app.files.s3
-
-    files_backend = app.files.s3.S3Files(
-        database_backend,
-        flask_app.config["S3_BUCKET"],
-        flask_app.config["S3_ACCESS_KEY"],
-        flask_app.config["S3_SECRET_KEY"],
-        endpoint_url=flask_app.config.get("S3_ENDPOINT_URL", None),
-        region_name=flask_app.config.get("S3_REGION", None),
-        public=flask_app.config["S3_PUBLIC"],
-        prefix=flask_app.config.get("S3_PREFIX", None),
-    )
+def _log_request(response: Response) -> Response:
+    """
+    After each request, log the path, response code and timing.
+    """
+    # the request may have been rejected before it started
+    if "start" not in g:
+        logger.info(f"{request.method} {request.full_path} {response.status_code}")
+        return response
 
-else:
-    raise ValueError(
-        f"Unknown file storage driver: {flask_app.config['FILE_STORAGE_DRIVER']}"
+    duration = time.perf_counter() - g.start
+    phases = {
+        name: (round(phase_duration * 1000, 1), count)
+        for name, (phase_duration, count) in g.phases.items()
+    }
+
+    if flask_app.config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = ", ".join(
+            [
+                f'{name};dur={phase_duration};desc="{count}x"'
+                for name, (phase_duration, count) in phases.items()
+            ]
+            + [f"total;dur={round(duration * 1000, 1)}"]
+        )
+
+    logger.bind(duration=duration, phases=phases).info(
+        f"{request.method} {request.full_path} {response.status_code} "
+        f"{duration * 1000:.1f}ms"
+        + "".join(
+            f" {name}={phase_duration}ms/{count}"
+            for name, (phase_duration, count) in phases.items()
+        )
     )
 
+    return response
 
-# =============================================================================
-# Run
-# =============================================================================
-
-if flask_app.config["MODE"] == "worker":
-    # create downloader
-    from app.downloader import Downloader
-
-    downloader = Downloader(database_backend, files_backend)
-
-elif flask_app.config["MODE"] == "server":
-    # =============================================================================
-    # Routes
-    # =============================================================================
-
-    if flask_app.config["PACKAGE_TYPE"] == "pypi":
-        from app.routes.pypi.files import files_bp
-        from app.routes.pypi.json import json_bp
-        from app.routes.pypi.simple import simple_bp
 
-        # pypi routes
-        flask_app.register_blueprint(simple_bp)
-        flask_app.register_blueprint(json_bp)
+def _stop_profiling(_: Optional[BaseException]) -> None:
+    """
+    After each request, even failed ones, stop profiling it, and
+    save the profile if it was slow.
+    """
+    if not g.get("profiling", False):
+        return
 
-        # our internal routes
-        flask_app.register_blueprint(files_bp)
+    duration = time.perf_counter() - g.start
+    path = profiler.stop(f"{request.method} {request.path}", duration)
+    if path is not None:
+        logger.warning(
+            f"Slow request {request.method} {request.full_path} took "
+            f"{duration * 1000:.1f}ms, saved profile to {path}"
+        )
 
-    else:
-        from app.routes.npm.files import files_bp
-        from app.routes.npm.keys import keys_bp
-        from app.routes.npm.packages import packages_bp
 
-        # npm routes
-        flask_app.register_blueprint(keys_bp)
-        flask_app.register_blueprint(files_bp)
-        flask_app.register_blueprint(packages_bp)
+# =============================================================================
+# Application
+# =============================================================================
 
-    # =============================================================================
-    # Hooks
-    # =============================================================================
+_created = False
 
-    @flask_app.after_request
-    def _log_request(response: Response) -> Response:
-        """
-        After each request, log the path and response code.
-        """
-        logger.info(f"{request.method} {request.full_path} {response.status_code}")
-        return response
 
-else:
-    raise ValueError(f"Unknown mode: {flask_app.config['MODE']}")
+def create_app() -> Flask:
+    """
+    Set up the application for its mode and return it. Only the routes are
+    imported here. Backends are created on first use in each process, so the
+    application can be created once, such as with gunicorn's --preload,
+    and then forked into workers.
+    """
+    global _created
+
+    if _created:
+        return flask_app
+
+    if flask_app.config["MODE"] not in MODES:
+        raise ValueError(f"Unknown mode: {flask_app.config['MODE']}")
+
+    if flask_app.config["REDIS_MODE"] not in REDIS_MODES:
+        raise ValueError(f"Unknown Redis mode: {flask_app.config['REDIS_MODE']}")
+
+    if (
+        flask_app.config["REDIS_MODE"] == "sentinel"
+        and not flask_app.config["REDIS_SENTINELS"]
+    ):
+        raise ValueError("Sentinel mode requires REDIS_SENTINELS")
+
+    if (
+        flask_app.config["PUBLISH_DIRECTORY"]
+        and flask_app.config["PACKAGE_TYPE"] == "pypi"
+        and not flask_app.config["PUBLISH_BASE_URL"]
+    ):
+        # published pages are not tied to the Host of any one request
+        raise ValueError("Publishing requires PUBLISH_BASE_URL")
+
+    if flask_app.config["MODE"] == "sync":
+        if (
+            flask_app.config["PUBLISH_DIRECTORY"]
+            and flask_app.config["PACKAGE_TYPE"] == "pypi"
+        ):
+            # pages are published by rendering them with their routes
+            register_pypi_routes()
+
+    elif flask_app.config["MODE"] == "rebalance":
+        if not flask_app.config["CLUSTER_NODES"]:
+            raise ValueError("Rebalancing requires CLUSTER_NODES")
+
+    elif flask_app.config["MODE"] == "server":
+        if flask_app.config["PACKAGE_TYPE"] == "pypi":
+            register_pypi_routes()
+        else:
+            register_npm_routes()
+
+        if flask_app.config["METRICS"]:
+            from app.routes.metrics import metrics_bp
+
+            # our internal routes
+            flask_app.register_blueprint(metrics_bp)
+
+        if flask_app.config["CLUSTER_NODES"]:
+            from app.routes.cluster import cluster_bp
+
+            # internal routes between cluster nodes
+            flask_app.register_blueprint(cluster_bp)
+
+        flask_app.before_request(_start_request)
+        flask_app.after_request(_log_request)
+        flask_app.teardown_request(_stop_profiling)
+
+    _created = True
+    return flask_app
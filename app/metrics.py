@@ -0,0 +1,304 @@
+import atexit
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+import flask
+from loguru import logger
+from redis import Redis
+from redis.exceptions import RedisError
+
+from app.config import flask_app
+
+# bucket upper bounds, in seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# bucket upper bounds, in bytes
+SIZE_BUCKETS = (
+    1024,
+    4 * 1024,
+    16 * 1024,
+    64 * 1024,
+    256 * 1024,
+    1024 * 1024,
+    4 * 1024 * 1024,
+    16 * 1024 * 1024,
+)
+
+# name: (type, help, histogram buckets)
+DEFINITIONS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "mypypi_proxy_requests_total": (
+        "counter",
+        "Upstream pages asked of the cache, by whether the cached copy was fresh (hit), stale or missing (miss).",
+        (),
+    ),
+    "mypypi_upstream_requests_total": (
+        "counter",
+        "Requests made to the upstream, by whether they succeeded.",
+        (),
+    ),
+    "mypypi_upstream_request_seconds": (
+        "histogram",
+        "Time taken by requests made to the upstream.",
+        LATENCY_BUCKETS,
+    ),
+    "mypypi_redis_seconds": (
+        "histogram",
+        "Time taken by database operations, including every Redis round trip they make.",
+        LATENCY_BUCKETS,
+    ),
+    "mypypi_rewrite_cpu_seconds": (
+        "histogram",
+        "CPU time taken to rewrite an upstream page.",
+        LATENCY_BUCKETS,
+    ),
+    "mypypi_rewrite_bytes": (
+        "histogram",
+        "Size of rewritten pages.",
+        SIZE_BUCKETS,
+    ),
+    "mypypi_file_requests_total": (
+        "counter",
+        "File requests, by whether the file was served (hit), redirected to the upstream or unavailable.",
+        (),
+    ),
+    "mypypi_downloads_total": (
+        "counter",
+        "Downloads run by the worker, by whether they succeeded or were skipped because the file was already stored.",
+        (),
+    ),
+    "mypypi_download_bytes_total": (
+        "counter",
+        "Bytes downloaded by the worker.",
+        (),
+    ),
+    "mypypi_download_seconds": (
+        "histogram",
+        "Time taken by successful downloads run by the worker.",
+        LATENCY_BUCKETS,
+    ),
+}
+
+
+def escape_label(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_series(name: str, labels: Dict[str, str]) -> str:
+    """
+    Format a metric name and labels in the Prometheus text format.
+    """
+    if not labels:
+        return name
+
+    # the bucket bound goes last, so buckets sort together
+    pairs = ",".join(
+        f'{key}="{escape_label(str(value))}"'
+        for key, value in sorted(labels.items(), key=lambda item: item[0] == "le")
+    )
+    return f"{name}{{{pairs}}}"
+
+
+def series_sort_key(series: str) -> Tuple[str, float]:
+    """
+    Sort series by name and labels, and histogram buckets by their bound.
+    """
+    head, sep, le = series.rpartition(',le="')
+    if not sep:
+        head, sep, le = series.rpartition('{le="')
+    if not sep:
+        return series, 0
+
+    return head, float(le.rstrip('"}'))
+
+
+def format_value(value: float) -> str:
+    """
+    Format a metric value in the Prometheus text format.
+    """
+    if value == int(value):
+        return str(int(value))
+
+    return repr(value)
+
+
+class Metrics:
+    """
+    Counters and histograms shared between every server and worker process.
+    Each process adds up its own changes in memory, and periodically adds them
+    to a Redis hash, so metrics can be scraped from any server.
+    """
+
+    def __init__(self, redis_client: Redis) -> None:
+        self.redis_client = redis_client
+
+        self.enabled: bool = flask_app.config["METRICS"]
+        self.flush_interval: float = flask_app.config["METRICS_FLUSH_INTERVAL"]
+        self._redis_name = f"{flask_app.config['REDIS_PREFIX']}:{flask_app.config['PACKAGE_TYPE']}:metrics"
+
+        self._pending: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def _add(self, changes: List[Tuple[str, float]]) -> None:
+        """
+        Add changes to series, and flush them if it is time to.
+        """
+        with self._lock:
+            for series, amount in changes:
+                self._pending[series] = self._pending.get(series, 0) + amount
+
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """
+        Increment a counter.
+        """
+        if not self.enabled:
+            return
+
+        self._add([(format_series(name, labels), amount)])
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """
+        Observe a value of a histogram.
+        """
+        if not self.enabled:
+            return
+
+        # buckets are cumulative. Every bucket is written, so they all exist.
+        changes = [
+            (
+                format_series(f"{name}_bucket", {**labels, "le": format_value(le)}),
+                1 if value <= le else 0,
+            )
+            for le in DEFINITIONS[name][2]
+        ]
+        changes.append((format_series(f"{name}_bucket", {**labels, "le": "+Inf"}), 1))
+        changes.append((format_series(f"{name}_sum", labels), value))
+        changes.append((format_series(f"{name}_count", labels), 1))
+
+        self._add(changes)
+
+    @contextlib.contextmanager
+    def timer(
+        self,
+        name: str,
+        clock: Callable[[], float] = time.perf_counter,
+        phase: Optional[str] = None,
+        **labels: str,
+    ) -> Generator[None, None, None]:
+        """
+        Observe how long a block takes in a histogram.
+        Optionally, also add the time to a phase of the current request.
+        """
+        start = clock()
+        try:
+            if phase is None:
+                yield
+            else:
+                with self.phase(phase):
+                    yield
+        finally:
+            self.observe(name, clock() - start, **labels)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        """
+        Add how long a block takes to a phase of the current request.
+        Phases may overlap, and are summed when entered more than once.
+        """
+        if not flask.has_request_context():
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = flask.g.setdefault("phases", {})
+            duration, count = phases.get(name, (0.0, 0))
+            phases[name] = (duration + time.perf_counter() - start, count + 1)
+
+    def flush(self) -> None:
+        """
+        Add the changes from this process to Redis.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._last_flush = time.monotonic()
+
+        if not pending:
+            return
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for series, amount in pending.items():
+            pipe.hincrbyfloat(self._redis_name, series, amount)
+        try:
+            pipe.execute()
+        except RedisError as e:
+            # metrics should never break requests
+            logger.warning(f"Failed to flush metrics: {e}")
+
+    def render(self, gauges: Optional[Dict[str, Tuple[str, float]]] = None) -> str:
+        """
+        Render the metrics of every process in the Prometheus text format,
+        along with gauges measured at scrape time, given as name: (help, value).
+        """
+        self.flush()
+
+        families: Dict[str, List[Tuple[str, float]]] = {}
+        for series, value in sorted(
+            self.redis_client.hgetall(self._redis_name).items(),
+            key=lambda item: series_sort_key(item[0]),
+        ):
+            name = series.split("{", 1)[0]
+            for suffix in ("_bucket", "_sum", "_count"):
+                family = name.removesuffix(suffix)
+                if family != name and DEFINITIONS.get(family, ("",))[0] == "histogram":
+                    name = family
+                    break
+
+            families.setdefault(name, []).append((series, float(value)))
+
+        lines = []
+        for name, (metric_type, help_text, _) in DEFINITIONS.items():
+            if name not in families:
+                continue
+
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for series, value in families[name]:
+                lines.append(f"{series} {format_value(value)}")
+
+        for name, (help_text, value) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
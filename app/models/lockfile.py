@@ -0,0 +1,10 @@
+from typing import List, TypedDict
+
+
+class LockedPackage(TypedDict):
+    name: str
+    version: str
+    # filenames and sha256 hashes of the locked files. If both are empty,
+    # every file of the version is locked.
+    filenames: List[str]
+    hashes: List[str]
@@ -0,0 +1,9 @@
+from typing import Optional, TypedDict
+
+
+class PrefetchCandidate(TypedDict):
+    url: str
+    filename: str
+    requires_python: Optional[str]
+    yanked: bool
+    size: Optional[int]
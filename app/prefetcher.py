@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import collections
+from typing import IO, TYPE_CHECKING, Dict, FrozenSet, List, Optional
+
+import packaging.specifiers
+import packaging.tags
+import packaging.utils
+import packaging.version
+from loguru import logger
+
+import app.libraries.packument
+import app.libraries.url
+from app.config import flask_app
+from app.models.prefetch import PrefetchCandidate
+
+if TYPE_CHECKING:
+    from app.files.base import BaseFiles
+
+
+def parse_tags(tag_strings: List[str]) -> FrozenSet[packaging.tags.Tag]:
+    """
+    Parse wheel tag strings, which may be compressed tag sets, into tags.
+    """
+    return frozenset(
+        tag
+        for tag_string in tag_strings
+        for tag in packaging.tags.parse_tag(tag_string)
+    )
+
+
+def parse_python_versions(
+    python_versions: List[str],
+) -> List[packaging.version.Version]:
+    """
+    Parse Python version strings into versions.
+    """
+    return [
+        packaging.version.Version(python_version) for python_version in python_versions
+    ]
+
+
+def python_compatible(
+    requires_python: Optional[str], python_versions: List[packaging.version.Version]
+) -> bool:
+    """
+    Whether or not a file is compatible with any of the given Python versions.
+    No versions means any version.
+    """
+    if not python_versions or not requires_python:
+        return True
+
+    try:
+        specifier = packaging.specifiers.SpecifierSet(requires_python)
+    except packaging.specifiers.InvalidSpecifier:
+        return True
+
+    return any(
+        specifier.contains(python_version, prereleases=True)
+        for python_version in python_versions
+    )
+
+
+def tags_compatible(
+    tags: FrozenSet[packaging.tags.Tag], allowed: FrozenSet[packaging.tags.Tag]
+) -> bool:
+    """
+    Whether or not a wheel is compatible with any of the allowed tags.
+    No allowed tags means any tag.
+    """
+    return not allowed or not allowed.isdisjoint(tags)
+
+
+class Prefetcher:
+    def __init__(self, files_backend: BaseFiles) -> None:
+        self.files_backend = files_backend
+
+        self.enabled: bool = flask_app.config["PREFETCH"]
+        self.max_versions: int = flask_app.config["PREFETCH_VERSIONS"]
+        self.max_bytes: int = flask_app.config["PREFETCH_MAX_BYTES"]
+        self.unknown_bytes: int = flask_app.config["PREFETCH_UNKNOWN_BYTES"]
+        self.npm_dist_tags: List[str] = flask_app.config["PREFETCH_NPM_DIST_TAGS"]
+
+        self.tags = parse_tags(flask_app.config["PREFETCH_TAGS"])
+        self.python_versions = parse_python_versions(
+            flask_app.config["PREFETCH_PYTHON_VERSIONS"]
+        )
+
+    def select_pypi(self, candidates: List[PrefetchCandidate]) -> List[str]:
+        """
+        Select the file URLs of a PyPI project that clients are most likely
+        to ask for next.
+        """
+        wheels: Dict[
+            packaging.version.Version, List[PrefetchCandidate]
+        ] = collections.defaultdict(list)
+        sdists: Dict[
+            packaging.version.Version, List[PrefetchCandidate]
+        ] = collections.defaultdict(list)
+
+        for candidate in candidates:
+            if candidate["yanked"] or not python_compatible(
+                candidate["requires_python"], self.python_versions
+            ):
+                continue
+
+            try:
+                if candidate["filename"].endswith(".whl"):
+                    _, version, _, tags = packaging.utils.parse_wheel_filename(
+                        candidate["filename"]
+                    )
+                    if version.is_prerelease or not tags_compatible(tags, self.tags):
+                        continue
+
+                    wheels[version].append(candidate)
+                else:
+                    _, version = packaging.utils.parse_sdist_filename(
+                        candidate["filename"]
+                    )
+                    if version.is_prerelease:
+                        continue
+
+                    sdists[version].append(candidate)
+            except (
+                packaging.utils.InvalidSdistFilename,
+                packaging.utils.InvalidWheelFilename,
+                packaging.version.InvalidVersion,
+            ):
+                continue
+
+        # newest versions first. Prefer wheels, and fall back to the sdist.
+        selected = []
+        versions = sorted(set(wheels) | set(sdists), reverse=True)
+        for version in versions[: self.max_versions]:
+            selected.extend(wheels[version] or sdists[version])
+
+        return self._apply_budget(selected)
+
+    def select_npm(self, f: IO[bytes], base_url: str) -> List[str]:
+        """
+        Select the tarball URLs of an npm package that clients are most likely
+        to ask for next, given a file of its rewritten packument, and the base
+        URL its tarball URLs were rewritten to.
+        """
+        dist_tags: Dict[str, str] = {}
+        # versions are listed oldest to newest
+        versions: Dict[str, PrefetchCandidate] = {}
+
+        for key, value in app.libraries.packument.iter_dists(f):
+            if key == "dist-tags":
+                dist_tags = value
+                continue
+
+            if not isinstance(value.get("tarball"), str):
+                continue
+
+            package, filename = app.libraries.url.parse_npm_file_url(
+                value["tarball"].removeprefix(base_url)
+            )
+            versions[
+                app.libraries.url.npm_tarball_version(package, filename)
+            ] = PrefetchCandidate(
+                # the same URL the tarball route stores the file under
+                url=f"{flask_app.config['UPSTREAM_URL']}/{package.strip('/')}/-/{filename}",
+                filename=filename,
+                requires_python=None,
+                yanked=False,
+                # the unpacked size is an upper bound of the tarball size
+                size=value.get("unpackedSize"),
+            )
+
+        version_names = [name for name in versions if "-" not in name]
+
+        selected_names: List[str] = []
+        for dist_tag in self.npm_dist_tags:
+            name = dist_tags.get(dist_tag)
+            if name not in versions:
+                continue
+
+            # include the versions released before the tagged one
+            if name in version_names:
+                index = version_names.index(name)
+                names = version_names[max(0, index - self.max_versions + 1) : index + 1]
+            else:
+                names = [name]
+
+            selected_names.extend(n for n in reversed(names) if n not in selected_names)
+
+        return self._apply_budget([versions[name] for name in selected_names])
+
+    def _apply_budget(self, candidates: List[PrefetchCandidate]) -> List[str]:
+        """
+        Limit candidates to the byte budget, in order. Files with an
+        unknown size are counted at an estimate.
+        """
+        urls = []
+        total = 0
+
+        for candidate in candidates:
+            size = candidate["size"]
+            if size is None:
+                size = self.unknown_bytes
+
+            if total + size > self.max_bytes:
+                continue
+
+            total += size
+            urls.append(candidate["url"])
+
+        return urls
+
+    def prefetch(self, urls: List[str]) -> None:
+        """
+        Add download jobs for file URLs. Storage is not checked here, so the
+        request is not held up. Downloaders skip the files we already have.
+        """
+        for url in urls:
+            logger.debug(f"Prefetching {url}")
+            self.files_backend.queue(url)
+
+    def prefetch_pypi(self, candidates: List[PrefetchCandidate]) -> None:
+        """
+        Prefetch the likely-needed files of a PyPI project, if enabled.
+        """
+        if self.enabled:
+            self.prefetch(self.select_pypi(candidates))
+
+    def prefetch_npm(self, f: IO[bytes], base_url: str) -> None:
+        """
+        Prefetch the likely-needed tarballs of an npm package, if enabled,
+        given a file of its rewritten packument.
+        """
+        if self.enabled:
+            self.prefetch(self.select_npm(f, base_url))
@@ -0,0 +1,107 @@
+import collections
+import os
+import random
+import re
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Counter, Dict, Optional, Tuple
+
+from loguru import logger
+
+from app.config import flask_app
+
+
+def frame_stack(frame: Optional[FrameType]) -> Tuple[str, ...]:
+    """
+    Return the stack of a frame, outermost call first.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+
+    return tuple(reversed(stack))
+
+
+class Profiler:
+    """
+    Sampling profiler for slow requests. While a request runs, the stack of
+    its thread is sampled at an interval. If the request turns out to be
+    slower than the threshold, the samples are saved in the collapsed stack
+    format, which flame graph tools such as speedscope and flamegraph.pl read.
+    """
+
+    def __init__(self) -> None:
+        self.threshold: float = flask_app.config["PROFILE_THRESHOLD"]
+        self.interval: float = flask_app.config["PROFILE_INTERVAL"]
+        self.rate: float = flask_app.config["PROFILE_RATE"]
+        self.directory: str = flask_app.config["PROFILE_DIRECTORY"]
+
+        # thread id: stack samples
+        self._samples: Dict[int, Counter[Tuple[str, ...]]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        logger.debug("Initializing Profiler")
+
+    def _run(self) -> None:
+        """
+        Sample the stacks of the threads being profiled, forever.
+        """
+        while True:
+            time.sleep(self.interval)
+
+            with self._lock:
+                if not self._samples:
+                    continue
+
+                frames = sys._current_frames()
+                for thread_id, samples in self._samples.items():
+                    samples[frame_stack(frames.get(thread_id))] += 1
+
+    def start(self) -> bool:
+        """
+        Start profiling the current thread, if it is sampled.
+        Returns whether or not it is being profiled.
+        """
+        if random.random() >= self.rate:
+            return False
+
+        with self._lock:
+            # started lazily, so the thread is created after gunicorn forks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            self._samples[threading.get_ident()] = collections.Counter()
+
+        return True
+
+    def stop(self, name: str, duration: float) -> Optional[str]:
+        """
+        Stop profiling the current thread. If the duration was over the
+        threshold, save the samples and return the path they were saved to.
+        """
+        with self._lock:
+            samples = self._samples.pop(threading.get_ident(), None)
+
+        if samples is None or duration < self.threshold or not samples:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_")[:100]
+        path = os.path.join(
+            self.directory,
+            f"{time.strftime('%Y%m%dT%H%M%S')}-{int(duration * 1000)}ms-{os.getpid()}-{slug}.txt",
+        )
+
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        return path
@@ -6,8 +6,9 @@ import requests
 import requests.auth
 from loguru import logger
 
+from app.backends import metrics
+from app.config import flask_app
 from app.database import Database
-from app.main import flask_app
 from app.models.url_cache import URLCache
 
 
@@ -15,7 +16,20 @@ class Proxy:
     def __init__(self, database: Database) -> None:
         self.database = database
 
-    def _reverse_proxy(self, url: str) -> Optional[URLCache]:
+    @staticmethod
+    def cache_key(url: str, accept: Optional[str]) -> str:
+        """
+        Build the key to cache an upstream URL under. Different representations
+        of the same URL are cached separately.
+        """
+        if accept is None:
+            return url
+
+        return f"{url}|{accept}"
+
+    def _reverse_proxy(
+        self, url: str, accept: Optional[str] = None
+    ) -> Optional[URLCache]:
         """
         Reverse proxy the request to the upstream server and return the response.
         Returns None if the request failed.
@@ -23,6 +37,11 @@ class Proxy:
         logger.debug(f"Proxying request to {url}")
 
         kwargs = {}
+        headers = {"User-Agent": "mypypi 1.0"}
+
+        # request a specific representation if asked for
+        if accept is not None:
+            headers["Accept"] = accept
 
         # add credentials if they are configured
         if (
@@ -36,18 +55,23 @@ class Proxy:
 
         # make request to upstream
         try:
-            resp = requests.get(url, headers={"User-Agent": "mypypi 1.0"}, **kwargs)
+            with metrics.timer("mypypi_upstream_request_seconds", phase="upstream"):
+                resp = requests.get(url, headers=headers, **kwargs)
         except requests.exceptions.RequestException as e:
             # if request fails
             logger.error(e)
+            metrics.inc("mypypi_upstream_requests_total", result="error")
             return
 
         # if the request had a bad request or other error,
         # use cache
         if resp.status_code >= HTTPStatus.BAD_REQUEST:
             logger.error(f"Response had bad status code {resp.status_code}")
+            metrics.inc("mypypi_upstream_requests_total", result="error")
             return None
 
+        metrics.inc("mypypi_upstream_requests_total", result="ok")
+
         # otherwise, cache what we have
 
         # exclude certain headers
@@ -73,19 +97,41 @@ class Proxy:
         )
 
         # if we got to here, put the cache entry in the database
-        self.database.set_url_cache(url, url_cache)
+        self.database.set_url_cache(self.cache_key(url, accept), url_cache)
 
         return url_cache
 
-    def get(self, url: str, max_age: int = flask_app.config["CACHE_TIME"]) -> URLCache:
+    def get_timestamp(
+        self, url: str, accept: Optional[str] = None
+    ) -> Optional[datetime.datetime]:
+        """
+        Get the time an upstream URL was last cached, if ever.
+        """
+        return self.database.get_url_cache_time(self.cache_key(url, accept))
+
+    def refresh(self, url: str, accept: Optional[str] = None) -> Optional[URLCache]:
+        """
+        Fetch an upstream URL into the cache, no matter how fresh the cache is.
+        Returns None if the upstream could not be reached.
+        """
+        return self._reverse_proxy(url, accept)
+
+    def get(
+        self,
+        url: str,
+        max_age: int = flask_app.config["CACHE_TIME"],
+        accept: Optional[str] = None,
+    ) -> URLCache:
         """
         Get an upstream URL from the cache or from the upstream server.
+        Optionally, request a specific representation with an Accept header.
         """
-        timestamp, url_cache = self.database.get_url_cache(url)
+        timestamp, url_cache = self.database.get_url_cache(self.cache_key(url, accept))
 
         # if there is no cache entry, try to reach the upstream server
         if timestamp is None or url_cache is None:
-            url_cache2 = self._reverse_proxy(url)
+            metrics.inc("mypypi_proxy_requests_total", result="miss")
+            url_cache2 = self._reverse_proxy(url, accept)
 
             # couldn't reach upstream, return error
             if url_cache2 is None:
@@ -98,11 +144,16 @@ class Proxy:
 
         # if the cache entry is stale, try to reach the upstream server
         if (datetime.datetime.now() - timestamp).total_seconds() >= max_age:
-            url_cache2 = self._reverse_proxy(url)
+            metrics.inc("mypypi_proxy_requests_total", result="stale")
+            url_cache2 = self._reverse_proxy(url, accept)
 
             # couldn't reach upstream, return what we have
             if url_cache2 is None:
                 return url_cache
 
+            # return the refreshed entry
+            return url_cache2
+
         # return original cache entry
+        metrics.inc("mypypi_proxy_requests_total", result="hit")
         return url_cache
@@ -0,0 +1,90 @@
+import datetime
+import gzip
+import os
+import tempfile
+from typing import Callable, ContextManager, Optional
+
+from loguru import logger
+
+from app.config import flask_app
+
+
+class Publisher:
+    """
+    Writes rewritten index pages into a static tree, along with a gzipped copy,
+    so a plain web server can serve them without us. Each page is given the
+    modification time of the upstream data it was rewritten from, so a page is
+    only written again once the upstream data has been refreshed.
+    """
+
+    def __init__(self) -> None:
+        self.directory: str = flask_app.config["PUBLISH_DIRECTORY"]
+        self.base_url: str = flask_app.config["PUBLISH_BASE_URL"]
+
+        logger.debug("Initializing Publisher")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def request_context(self) -> ContextManager:
+        """
+        Return a request context to render pages in, so their links use the
+        published base URL rather than the Host of whoever asked first.
+        """
+        return flask_app.test_request_context(base_url=self.base_url)
+
+    def _write(self, path: str, data: bytes, mtime: float) -> None:
+        """
+        Write a file atomically, with a modification time.
+        """
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=os.path.dirname(path), delete=False
+        ) as f:
+            f.write(data)
+
+        os.utime(f.name, (mtime, mtime))
+        os.replace(f.name, path)
+
+    def publish(
+        self,
+        path: str,
+        render: Callable[[], str],
+        timestamp: Optional[datetime.datetime],
+    ) -> None:
+        """
+        Publish a page at a path of the static tree, given a function to render
+        it and the time its upstream data was cached. The page is only rendered
+        if it is not current. Failures are logged, as the page can still be
+        served by us.
+        """
+        if not self.enabled or timestamp is None:
+            return
+
+        directory = os.path.abspath(self.directory)
+        full_path = os.path.abspath(os.path.join(directory, path))
+        if not full_path.startswith(f"{directory}{os.sep}"):
+            logger.warning(f"Not publishing {path} outside of {directory}")
+            return
+
+        mtime = timestamp.timestamp()
+
+        try:
+            if os.path.getmtime(full_path) == mtime:
+                return
+        except FileNotFoundError:
+            pass
+
+        logger.debug(f"Publishing {path}")
+        with self.request_context():
+            data = render().encode("utf-8")
+
+        try:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            # the uncompressed page is written last, as it marks the page as current
+            self._write(
+                f"{full_path}.gz", gzip.compress(data, 9, mtime=int(mtime)), mtime
+            )
+            self._write(full_path, data, mtime)
+        except OSError:
+            logger.exception(f"Failed to publish {path}")
@@ -0,0 +1,73 @@
+from http import HTTPStatus
+
+import flask
+import werkzeug
+import werkzeug.security
+
+import app.files.sharded
+from app.backends import files_backend
+
+cluster_bp = flask.Blueprint("cluster", __name__, url_prefix="/_cluster")
+
+
+def check_path(path: str) -> None:
+    """
+    Abort if a storage path would escape the storage directory.
+    """
+    if werkzeug.security.safe_join(files_backend.local.directory, path) is None:
+        flask.abort(HTTPStatus.NOT_FOUND)
+
+
+def check_secret() -> None:
+    """
+    Abort if the request does not carry the cluster secret.
+    """
+    secret = flask.request.headers.get(app.files.sharded.SECRET_HEADER, "")
+    if not files_backend.authorized(secret):
+        flask.abort(HTTPStatus.FORBIDDEN)
+
+
+@cluster_bp.route("/files/<path:path>", methods=["GET"])
+def get_file(path: str) -> werkzeug.wrappers.Response:
+    check_path(path)
+
+    # clients redirected here carry a signature instead of the secret
+    if not files_backend.authorized_url(
+        path,
+        flask.request.args.get("expires", ""),
+        flask.request.args.get("signature", ""),
+    ):
+        check_secret()
+
+    return files_backend.serve_local(path)
+
+
+@cluster_bp.route("/files/<path:path>", methods=["PUT"])
+def put_file(path: str) -> werkzeug.wrappers.Response:
+    check_path(path)
+    check_secret()
+
+    sha256 = flask.request.headers.get(app.files.sharded.SHA256_HEADER, "")
+    try:
+        files_backend.receive_local(
+            path,
+            iter(lambda: flask.request.stream.read(64 * 1024), b""),
+            sha256,
+        )
+    except ValueError:
+        return flask.abort(HTTPStatus.BAD_REQUEST)
+
+    return flask.Response(status=HTTPStatus.CREATED)
+
+
+@cluster_bp.route("/files/<path:path>", methods=["DELETE"])
+def delete_file(path: str) -> werkzeug.wrappers.Response:
+    check_path(path)
+    check_secret()
+
+    try:
+        files_backend.remove_local(path)
+    except FileNotFoundError:
+        return flask.abort(HTTPStatus.NOT_FOUND)
+
+    return flask.Response(status=HTTPStatus.NO_CONTENT)
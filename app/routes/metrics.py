@@ -0,0 +1,24 @@
+import flask
+
+from app.backends import database_backend, metrics
+
+# npm package names can't start with an underscore
+metrics_bp = flask.Blueprint("metrics", __name__)
+
+
+@metrics_bp.route("/_metrics")
+def index() -> flask.Response:
+    gauges = {
+        "mypypi_download_queue_length": (
+            "Files waiting to be downloaded by the worker.",
+            database_backend.get_file_download_queue_length(),
+        ),
+        "mypypi_storage_bytes": (
+            "Bytes of package files in storage, if a storage quota is set.",
+            database_backend.get_files_size_total(),
+        ),
+    }
+
+    return flask.Response(
+        metrics.render(gauges), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,7 +1,8 @@
 import flask
 import werkzeug
 
-from app.main import files_backend, flask_app
+from app.backends import files_backend
+from app.config import flask_app
 
 files_bp = flask.Blueprint("files", __name__)
 
@@ -1,7 +1,8 @@
 import flask
 import werkzeug
 
-from app.main import flask_app, proxy
+from app.backends import proxy
+from app.config import flask_app
 
 keys_bp = flask.Blueprint("keys", __name__)
 
@@ -1,19 +1,194 @@
+import datetime
+import hashlib
 import http
+import os
+import tempfile
+import time
 import urllib.parse
+from typing import IO, List, Optional, Tuple
 
 import flask
 import orjson
+import werkzeug.wsgi
+from werkzeug.datastructures import MIMEAccept
 
+import app.libraries.packument
 import app.libraries.url
-from app.main import flask_app, proxy
+from app.backends import metrics, prefetcher, proxy
+from app.config import flask_app
 
 packages_bp = flask.Blueprint("packages", __name__)
 
+abbreviated_mimetype = app.libraries.packument.ABBREVIATED_MIMETYPE
+full_mimetype = "application/json"
+
+# rewritten packuments are cached on disk, so they can be sent as-is
+rewrite_directory = os.path.join(flask_app.config["DATA_DIRECTORY"], "packages")
+os.makedirs(rewrite_directory, exist_ok=True)
+
+
+def tarball_base_url() -> str:
+    """
+    Return the external base URL that tarball URLs are rewritten to.
+    """
+    placeholder = flask.url_for(
+        "files.proxy", package="_", filename="_", _external=True
+    )
+    return placeholder.removesuffix("/_/-/_")
+
+
+def rewrite_tarball_url(base_url: str, tarball_url: str) -> str:
+    """
+    Rewrite an upstream tarball URL to our file proxy.
+    """
+    package, filename = app.libraries.url.parse_npm_file_url(tarball_url)
+    return urllib.parse.unquote(f"{base_url}/{package.strip('/')}/-/{filename}")
+
+
+def rewrite_path(url: str, accept: Optional[str]) -> str:
+    """
+    Return the path of the cached rewrite of a packument. There is one per
+    upstream URL and representation, so the cache stays bounded whatever
+    Host headers clients send.
+    """
+    digest = hashlib.sha256(f"{url}|{accept}".encode("utf-8")).hexdigest()
+    return os.path.join(rewrite_directory, digest)
+
+
+def open_rewrite(
+    path: str, timestamp: Optional[datetime.datetime], base_url: str
+) -> Optional[Tuple[IO[bytes], List[Tuple[str, str]]]]:
+    """
+    Open a cached rewrite, positioned after its info line, and return it with
+    its headers, if it was made from the upstream data cached at the given
+    time for the given base URL.
+    """
+    if timestamp is None:
+        return None
+
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    # the info and the rewrite are in the same file, so they are replaced together
+    try:
+        info = orjson.loads(f.readline())
+        current = (
+            info["timestamp"] == timestamp.isoformat() and info["base_url"] == base_url
+        )
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        current = False
+
+    if not current:
+        f.close()
+        return None
+
+    return f, info["headers"]
+
+
+def save_rewrite(
+    path: str,
+    timestamp: datetime.datetime,
+    content: str,
+    headers: List[Tuple[str, str]],
+    base_url: str,
+) -> IO[bytes]:
+    """
+    Stream a rewrite of a packument to disk, after a line of info about it.
+    Returns the rewrite opened, positioned after its info line.
+    """
+    start = time.thread_time()
+    size = 0
+
+    # write to a temporary file and move it in place, so concurrent
+    # workers never see partial files
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=rewrite_directory, delete=False
+    ) as f:
+        f.write(
+            orjson.dumps(
+                {
+                    "timestamp": timestamp.isoformat(),
+                    "headers": headers,
+                    "base_url": base_url,
+                }
+            ).decode("utf-8")
+            + "\n"
+        )
+        for piece in app.libraries.packument.rewrite_tarballs(
+            content, lambda url: rewrite_tarball_url(base_url, url)
+        ):
+            f.write(piece)
+            size += len(piece)
+
+    # opened before it is moved, so it cannot be replaced in between
+    rewrite = open(f.name, "rb")
+    rewrite.readline()
+    os.replace(f.name, path)
+
+    metrics.observe(
+        "mypypi_rewrite_cpu_seconds", time.thread_time() - start, page="npm"
+    )
+    metrics.observe("mypypi_rewrite_bytes", size, page="npm")
+
+    return rewrite
+
+
+def send_rewrite(f: IO[bytes], headers: List[Tuple[str, str]]) -> flask.Response:
+    """
+    Send a cached rewrite of a packument, from the current position of its file.
+    """
+    offset = f.tell()
+    response = flask.Response(
+        werkzeug.wsgi.wrap_file(flask.request.environ, f), direct_passthrough=True
+    )
+
+    # use the upstream headers over our own
+    for name, _ in headers:
+        del response.headers[name]
+    response.headers.extend(headers)
+
+    response.content_length = os.fstat(f.fileno()).st_size - offset
+    response.vary.add("Accept")
+    return response
+
+
+def requested_mimetype(accept_mimetypes: MIMEAccept) -> Optional[str]:
+    """
+    Return the abbreviated mimetype if the client explicitly ranks it above
+    the full document, or None for the full document. Clients that accept
+    anything, such as browsers or curl, get the full document.
+    """
+    if accept_mimetypes[abbreviated_mimetype] > accept_mimetypes[full_mimetype]:
+        return abbreviated_mimetype
+
+    return None
+
 
 @packages_bp.route("/<path:package>")
 def package(package: str) -> flask.Response:
+    # serve the abbreviated document if the client prefers it
+    accept = requested_mimetype(flask.request.accept_mimetypes)
+
+    url = f"{flask_app.config['UPSTREAM_URL']}/{package}"
+    base_url = tarball_base_url()
+    path = rewrite_path(url, accept)
+
+    # if the upstream data is fresh and we've already rewritten it,
+    # send it without touching the upstream data at all
+    timestamp = proxy.get_timestamp(url, accept=accept)
+    if (
+        timestamp is not None
+        and (datetime.datetime.now() - timestamp).total_seconds()
+        < flask_app.config["CACHE_TIME"]
+    ):
+        rewrite = open_rewrite(path, timestamp, base_url)
+        if rewrite is not None:
+            return send_rewrite(*rewrite)
+
     # get the cached data from the upstream
-    url_cache = proxy.get(f"{flask_app.config['UPSTREAM_URL']}/{package}")
+    url_cache = proxy.get(url, accept=accept)
 
     # if the response is bad, return as-is
     if url_cache["status_code"] != http.HTTPStatus.OK:
@@ -23,25 +198,30 @@ def package(package: str) -> flask.Response:
             url_cache["headers"],
         )
 
-    # rewrite urls
-    package_data = orjson.loads(url_cache["content"])
-    for version_data in package_data["versions"].values():
-        # parse the filename
-        package, filename = app.libraries.url.parse_npm_file_url(
-            version_data["dist"]["tarball"]
-        )
+    # the upstream data may not have changed
+    timestamp = proxy.get_timestamp(url, accept=accept)
+    rewrite = open_rewrite(path, timestamp, base_url)
+    if rewrite is not None:
+        return send_rewrite(*rewrite)
 
-        # rebuild the URL
-        version_data["dist"]["tarball"] = urllib.parse.unquote(
-            flask.url_for(
-                "files.proxy",
-                filename=filename,
-                package=package,
-                _external=True,
-            )
+    # rewrite urls. If the upstream data was somehow not recorded, the rewrite
+    # will never match and will be redone next time.
+    headers = url_cache["headers"]
+    with metrics.phase("rewrite"):
+        f = save_rewrite(
+            path,
+            timestamp or datetime.datetime.now(),
+            url_cache["content"],
+            headers,
+            base_url,
         )
 
-    # craft response
-    return flask.Response(
-        orjson.dumps(package_data), url_cache["status_code"], url_cache["headers"]
-    )
+    # the document is only read from disk from now on
+    del url_cache
+
+    # queue up the tarballs clients will likely ask for next
+    offset = f.tell()
+    prefetcher.prefetch_npm(f, base_url)
+    f.seek(offset)
+
+    return send_rewrite(f, headers)
@@ -1,4 +1,5 @@
 from http import HTTPStatus
+from typing import Optional
 
 import flask
 import werkzeug
@@ -6,23 +7,23 @@ from loguru import logger
 
 import app.libraries.url
 import app.routes.pypi.simple
-from app.main import database_backend, files_backend
+from app.backends import database_backend, files_backend
 
 files_bp = flask.Blueprint("files", __name__, url_prefix="/file")
 
+metadata_suffix = ".metadata"
 
-@files_bp.route("/<string:filekey>")
-def proxy(filekey: str, recursed: bool = False) -> werkzeug.wrappers.Response:
+
+def lookup_url(filekey: str) -> Optional[str]:
+    """
+    Look up the source file URL of a file key. If it is not known yet,
+    refresh the project page once to discover it.
+    """
     # lookup file key in database
     url = database_backend.get_file_url_from_key(filekey)
 
     if url is not None:
-        # get the file
-        return files_backend.get(url)
-
-    if recursed:
-        # if this is not the first time running this, return a 404
-        return flask.abort(HTTPStatus.NOT_FOUND)
+        return url
 
     # attempt to get the file url from the package page
     logger.warning(f"URL key {filekey} not found in database")
@@ -30,10 +31,34 @@ def proxy(filekey: str, recursed: bool = False) -> werkzeug.wrappers.Response:
     try:
         project = app.libraries.url.parse_pypi_file_url(filekey)[0]
     except ValueError:
-        # if the file key is improperly formatted, return a 404
-        return flask.abort(HTTPStatus.NOT_FOUND)
+        # if the file key is improperly formatted, give up
+        return None
 
     app.routes.pypi.simple.project(project)
 
-    # re-run this route
-    return proxy(filekey, recursed=True)
+    return database_backend.get_file_url_from_key(filekey)
+
+
+@files_bp.route("/<string:filekey>")
+def proxy(filekey: str) -> werkzeug.wrappers.Response:
+    # PEP 658 metadata files live next to the file itself
+    if filekey.endswith(metadata_suffix):
+        return metadata(filekey.removesuffix(metadata_suffix))
+
+    url = lookup_url(filekey)
+
+    if url is None:
+        return flask.abort(HTTPStatus.NOT_FOUND)
+
+    # get the file
+    return files_backend.get(url)
+
+
+def metadata(filekey: str) -> werkzeug.wrappers.Response:
+    url = lookup_url(filekey)
+
+    if url is None:
+        return flask.abort(HTTPStatus.NOT_FOUND)
+
+    # get the file metadata
+    return files_backend.get_metadata(url)
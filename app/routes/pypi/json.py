@@ -1,4 +1,5 @@
 import http
+import time
 from urllib.parse import unquote
 
 import cachetools.func
@@ -6,7 +7,9 @@ import flask
 import orjson
 
 import app.libraries.url
-from app.main import database_backend, flask_app, proxy
+from app.backends import database_backend, metrics, prefetcher, proxy, publisher
+from app.config import flask_app
+from app.models.prefetch import PrefetchCandidate
 
 url_prefix = "pypi"
 url_postfix = "json"
@@ -18,6 +21,8 @@ def process_json(json_data: str) -> str:
     """
     Rewrite all file URLs in a json page with our file proxy.
     """
+    start = time.thread_time()
+
     data = orjson.loads(json_data)
 
     # ===================================
@@ -26,15 +31,38 @@ def process_json(json_data: str) -> str:
     for rd in data["releases"].values():
         release_datas.extend(rd)
 
+    # add the hash anchor simple pages have, so files can be verified
+    file_urls = [
+        f"{release_data['url']}#sha256={release_data['digests']['sha256']}"
+        if "sha256" in release_data.get("digests", {})
+        and "#" not in release_data["url"]
+        else release_data["url"]
+        for release_data in release_datas
+    ]
+
     # make list of all filekey, url pairs
     filekey_url_pairs = [
-        (app.libraries.url.url_filename(release_data["url"], True), release_data["url"])
-        for release_data in release_datas
+        (app.libraries.url.url_filename(release_data["url"], True), file_url)
+        for file_url, release_data in zip(file_urls, release_datas)
     ]
 
     # bulk insert
     database_backend.bulk_add_file_url_keys(filekey_url_pairs)
 
+    # queue up the files clients will likely ask for next
+    prefetcher.prefetch_pypi(
+        [
+            PrefetchCandidate(
+                url=file_url,
+                filename=release_data["filename"],
+                requires_python=release_data.get("requires_python", None),
+                yanked=release_data.get("yanked", False),
+                size=release_data.get("size", None),
+            )
+            for file_url, release_data in zip(file_urls, release_datas)
+        ]
+    )
+
     # rewrite the release urls
     for filekey_url_pair, release_data in zip(filekey_url_pairs, release_datas):
         release_data["url"] = unquote(
@@ -57,15 +85,20 @@ def process_json(json_data: str) -> str:
             )
         )
 
-    return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode("utf-8")
+    processed = orjson.dumps(data, option=orjson.OPT_INDENT_2).decode("utf-8")
+
+    metrics.observe(
+        "mypypi_rewrite_cpu_seconds", time.thread_time() - start, page="json"
+    )
+    metrics.observe("mypypi_rewrite_bytes", len(processed), page="json")
+    return processed
 
 
 @json_bp.route(f"/<string:projectname>/{url_postfix}")
 def project(projectname: str) -> flask.Response:
     # get the cached data from the upstream
-    url_cache = proxy.get(
-        f"{flask_app.config['UPSTREAM_URL']}/{url_prefix}/{projectname}/{url_postfix}"
-    )
+    url = f"{flask_app.config['UPSTREAM_URL']}/{url_prefix}/{projectname}/{url_postfix}"
+    url_cache = proxy.get(url)
 
     # if the response is bad, return as-is
     if url_cache["status_code"] != http.HTTPStatus.OK:
@@ -75,9 +108,21 @@ def project(projectname: str) -> flask.Response:
             url_cache["headers"],
         )
 
+    with metrics.phase("rewrite"):
+        content = process_json(url_cache["content"])
+
+    # publish the page for a static web server, if the upstream data is new
+    if publisher.enabled:
+        publisher.publish(
+            f"{url_prefix}/{projectname}/{url_postfix}",
+            # not cached, as the cache is keyed on the upstream page alone
+            lambda: process_json.__wrapped__(url_cache["content"]),  # type: ignore
+            proxy.get_timestamp(url),
+        )
+
     # craft response
     return flask.Response(
-        process_json(url_cache["content"]),
+        content,
         url_cache["status_code"],
         url_cache["headers"],
     )
@@ -98,9 +143,12 @@ def project_version(projectname: str, version: str) -> flask.Response:
             url_cache["headers"],
         )
 
+    with metrics.phase("rewrite"):
+        content = process_json(url_cache["content"])
+
     # craft response
     return flask.Response(
-        process_json(url_cache["content"]),
+        content,
         url_cache["status_code"],
         url_cache["headers"],
     )
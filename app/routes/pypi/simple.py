@@ -1,4 +1,5 @@
 import http
+import time
 from urllib.parse import unquote
 
 import bs4
@@ -6,14 +7,22 @@ import cachetools.func
 import flask
 
 import app.libraries.url
-from app.main import database_backend, flask_app, proxy
+import app.simple_index
+from app.backends import database_backend, metrics, prefetcher, proxy, publisher
+from app.config import flask_app
+from app.models.prefetch import PrefetchCandidate
 
 url_prefix = "simple"
 simple_bp = flask.Blueprint("simple", __name__, url_prefix=f"/{url_prefix}")
 
+core_metadata_attr = "data-core-metadata"
+dist_info_metadata_attr = "data-dist-info-metadata"
+
 
 @cachetools.func.ttl_cache(maxsize=None, ttl=flask_app.config["FILE_URL_EXPIRATION"])
 def process_html(html: str) -> str:
+    start = time.thread_time()
+
     # parse the html
     soup = bs4.BeautifulSoup(html, "html.parser")
 
@@ -29,6 +38,20 @@ def process_html(html: str) -> str:
     # bulk insert
     database_backend.bulk_add_file_url_keys(filekey_url_pairs)
 
+    # queue up the files clients will likely ask for next
+    prefetcher.prefetch_pypi(
+        [
+            PrefetchCandidate(
+                url=a_tag["href"],
+                filename=filekey_url_pair[0].split("#")[0],
+                requires_python=a_tag.get("data-requires-python", None),
+                yanked=a_tag.has_attr("data-yanked"),
+                size=None,
+            )
+            for filekey_url_pair, a_tag in zip(filekey_url_pairs, a_tags)
+        ]
+    )
+
     # rewrite the anchor tags
     for filekey_url_pair, a_tag in zip(filekey_url_pairs, a_tags):
         a_tag["href"] = unquote(
@@ -39,15 +62,51 @@ def process_html(html: str) -> str:
             )
         )
 
-    return soup.prettify()
+        # advertise PEP 658/714 metadata. If the upstream does not provide it
+        # for a wheel, we can still extract it ourselves.
+        metadata = a_tag.get(
+            core_metadata_attr, a_tag.get(dist_info_metadata_attr, None)
+        )
+        if metadata is None and filekey_url_pair[0].split("#")[0].endswith(".whl"):
+            metadata = "true"
+
+        if metadata is not None:
+            a_tag[core_metadata_attr] = metadata
+            a_tag[dist_info_metadata_attr] = metadata
+
+    processed = soup.prettify()
+
+    metrics.observe(
+        "mypypi_rewrite_cpu_seconds", time.thread_time() - start, page="simple"
+    )
+    metrics.observe("mypypi_rewrite_bytes", len(processed), page="simple")
+    return processed
+
+
+@simple_bp.route("/")
+def index() -> flask.Response:
+    if not flask_app.config["SIMPLE_INDEX"]:
+        return flask.abort(http.HTTPStatus.NOT_FOUND)
+
+    serial = database_backend.get_simple_index_serial()
+    if serial is None:
+        # the worker has not built it yet
+        return flask.abort(http.HTTPStatus.SERVICE_UNAVAILABLE)
+
+    # stream the page, as it lists every project
+    return flask.Response(
+        app.simple_index.render(database_backend),
+        http.HTTPStatus.OK,
+        {"X-PyPI-Last-Serial": str(serial)},
+        mimetype="text/html",
+    )
 
 
 @simple_bp.route("/<string:projectname>/")
 def project(projectname: str) -> flask.Response:
     # get the cached data from the upstream
-    url_cache = proxy.get(
-        f"{flask_app.config['UPSTREAM_URL']}/{url_prefix}/{projectname}"
-    )
+    url = f"{flask_app.config['UPSTREAM_URL']}/{url_prefix}/{projectname}"
+    url_cache = proxy.get(url)
 
     # if the response is bad, return as-is
     if url_cache["status_code"] != http.HTTPStatus.OK:
@@ -57,9 +116,21 @@ def project(projectname: str) -> flask.Response:
             url_cache["headers"],
         )
 
+    with metrics.phase("rewrite"):
+        content = process_html(url_cache["content"])
+
+    # publish the page for a static web server, if the upstream data is new
+    if publisher.enabled:
+        publisher.publish(
+            f"{url_prefix}/{projectname}/index.html",
+            # not cached, as the cache is keyed on the upstream page alone
+            lambda: process_html.__wrapped__(url_cache["content"]),  # type: ignore
+            proxy.get_timestamp(url),
+        )
+
     # craft response
     return flask.Response(
-        process_html(url_cache["content"]),
+        content,
         url_cache["status_code"],
         url_cache["headers"],
     )
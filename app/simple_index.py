@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import re
+import time
+import xmlrpc.client
+from typing import TYPE_CHECKING, Any, Dict, Generator, List, Optional, Tuple
+
+import orjson
+import packaging.utils
+import requests
+import requests.auth
+from loguru import logger
+from redis.exceptions import LockError
+
+from app.config import flask_app
+
+if TYPE_CHECKING:
+    from app.database import Database
+
+# simple API JSON representation, falling back to HTML
+simple_json_mimetype = "application/vnd.pypi.simple.v1+json"
+anchor_pattern = re.compile(r"<a\b[^>]*>([^<]+)</a>", re.IGNORECASE)
+# changelog action of a project being deleted
+remove_project_action = "remove project"
+# how many buckets to read from Redis at a time when rendering
+render_batch_size = 64
+
+
+def bucket_name(normalized: str) -> str:
+    """
+    Return the bucket a normalized project name is stored in.
+    """
+    return normalized[:2]
+
+
+def decode_bucket(bucket: str) -> Dict[str, str]:
+    """
+    Decode a bucket into a dictionary of normalized: display project names.
+    """
+    projects = {}
+    for line in bucket.splitlines():
+        normalized, _, display = line.partition(" ")
+        projects[normalized] = display or normalized
+
+    return projects
+
+
+def encode_bucket(projects: Dict[str, str]) -> str:
+    """
+    Encode a dictionary of normalized: display project names into a bucket,
+    one project per line, sorted. The display name is only stored if it differs.
+    """
+    return "\n".join(
+        normalized if display == normalized else f"{normalized} {display}"
+        for normalized, display in sorted(projects.items())
+    )
+
+
+class SimpleIndex:
+    """
+    Keeps a copy of the upstream /simple/ root index, the list of every project.
+    It is built once, then kept current from the upstream changelog by serial,
+    rather than refetching every project each time.
+    """
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.interval: int = flask_app.config["SIMPLE_INDEX_INTERVAL"]
+
+        logger.debug("Initializing SimpleIndex")
+
+    def _request_kwargs(self) -> Dict[str, Any]:
+        """
+        Build the keyword arguments for requests made to the upstream.
+        """
+        kwargs: Dict[str, Any] = {"headers": {"User-Agent": "mypypi 1.0"}}
+
+        # add credentials if they are configured
+        if (
+            "UPSTREAM_USERNAME" in flask_app.config
+            and "UPSTREAM_PASSWORD" in flask_app.config
+        ):
+            kwargs["auth"] = requests.auth.HTTPBasicAuth(
+                flask_app.config["UPSTREAM_USERNAME"],
+                flask_app.config["UPSTREAM_PASSWORD"],
+            )
+
+        return kwargs
+
+    def fetch_projects(self) -> Tuple[List[str], Optional[int]]:
+        """
+        Fetch the name of every project from the upstream, along with the
+        serial of the list, if the upstream has one.
+        """
+        kwargs = self._request_kwargs()
+        kwargs["headers"]["Accept"] = f"{simple_json_mimetype}, text/html;q=0.1"
+
+        response = requests.get(
+            f"{flask_app.config['UPSTREAM_URL']}/simple/", timeout=300, **kwargs
+        )
+        response.raise_for_status()
+
+        serial = response.headers.get("X-PyPI-Last-Serial", None)
+
+        if response.headers.get("Content-Type", "").startswith(simple_json_mimetype):
+            data = orjson.loads(response.content)
+            names = [project["name"] for project in data["projects"]]
+            serial = data.get("meta", {}).get("_last-serial", serial)
+        else:
+            names = anchor_pattern.findall(response.text)
+
+        return names, int(serial) if serial is not None else None
+
+    def _call(self, method: str, *params: Any) -> Any:
+        """
+        Call a method of the upstream XML-RPC API.
+        """
+        kwargs = self._request_kwargs()
+        kwargs["headers"]["Content-Type"] = "text/xml"
+
+        response = requests.post(
+            f"{flask_app.config['UPSTREAM_URL']}/pypi",
+            data=xmlrpc.client.dumps(params, method),
+            timeout=300,
+            **kwargs,
+        )
+        response.raise_for_status()
+
+        # raises a Fault if the call failed
+        (result,), _ = xmlrpc.client.loads(response.content)
+        return result
+
+    def fetch_last_serial(self) -> int:
+        """
+        Fetch the serial of the latest change from the upstream changelog.
+        """
+        return int(self._call("changelog_last_serial"))
+
+    def fetch_changelog(self, serial: int) -> List[Tuple[str, str, int]]:
+        """
+        Fetch the project changes since a serial from the upstream changelog,
+        as name, action, serial.
+        """
+        events = self._call("changelog_since_serial", serial)
+
+        # each event is name, version, timestamp, action, serial
+        return [(event[0], event[3], int(event[4])) for event in events]
+
+    def build(self) -> None:
+        """
+        Build the index from the full list of upstream projects.
+        """
+        logger.info("Building the simple index")
+        names, serial = self.fetch_projects()
+
+        buckets: Dict[str, Dict[str, str]] = {}
+        for name in names:
+            normalized = packaging.utils.canonicalize_name(name)
+            buckets.setdefault(bucket_name(normalized), {})[normalized] = name
+
+        self.database.set_simple_index_buckets(
+            {key: encode_bucket(projects) for key, projects in buckets.items()},
+            # without a serial, the index is rebuilt every time
+            serial if serial is not None else 0,
+            replace=True,
+        )
+        logger.info(f"Built the simple index of {len(names)} projects at {serial}")
+
+    def update(self, serial: int) -> None:
+        """
+        Update the index with the upstream changes since a serial.
+        """
+        while True:
+            events = self.fetch_changelog(serial)
+            if not events:
+                return
+
+            # only the last change of each project matters
+            changes: Dict[str, Tuple[str, str]] = {}
+            for name, action, event_serial in events:
+                changes[packaging.utils.canonicalize_name(name)] = (name, action)
+                serial = max(serial, event_serial)
+
+            keys = sorted({bucket_name(normalized) for normalized in changes})
+            buckets = {
+                key: decode_bucket(bucket)
+                for key, bucket in zip(
+                    keys, self.database.get_simple_index_buckets(keys)
+                )
+            }
+
+            for normalized, (name, action) in changes.items():
+                projects = buckets[bucket_name(normalized)]
+                if action == remove_project_action:
+                    projects.pop(normalized, None)
+                else:
+                    projects[normalized] = name
+
+            self.database.set_simple_index_buckets(
+                {key: encode_bucket(projects) for key, projects in buckets.items()},
+                serial,
+            )
+            logger.info(
+                f"Updated {len(changes)} projects in the simple index to {serial}"
+            )
+
+    def execute(self) -> None:
+        """
+        Bring the index up to date with the upstream.
+        """
+        serial = self.database.get_simple_index_serial()
+        if not serial:
+            self.build()
+            return
+
+        try:
+            self.update(serial)
+        except (
+            requests.exceptions.RequestException,
+            xmlrpc.client.Error,
+            ValueError,
+        ) as e:
+            # not every upstream has a changelog
+            logger.warning(f"Could not update the simple index from the changelog: {e}")
+            self.build()
+
+    def run(self) -> None:
+        """
+        Run the SimpleIndex infinitely. Only one SimpleIndex across all
+        workers runs at a time.
+        """
+        while True:
+            lock = self.database.lock("simple_index", timeout=self.interval * 10)
+            if lock.acquire(blocking=False):
+                try:
+                    self.execute()
+                except Exception:
+                    logger.exception("SimpleIndex failed")
+                finally:
+                    try:
+                        lock.release()
+                    except LockError:
+                        # expired, and may be held by another worker by now
+                        logger.warning(
+                            "SimpleIndex lock expired before it was released"
+                        )
+
+            time.sleep(self.interval)
+
+
+def render(database: Database) -> Generator[str, None, None]:
+    """
+    Render the index as a simple API HTML page, a few buckets at a time,
+    so the whole page is never in memory.
+    """
+    yield (
+        "<!DOCTYPE html>\n<html>\n  <head>\n"
+        '    <meta name="pypi:repository-version" content="1.0">\n'
+        "    <title>Simple index</title>\n  </head>\n  <body>\n"
+    )
+
+    names = database.get_simple_index_bucket_names()
+    for i in range(0, len(names), render_batch_size):
+        for bucket in database.get_simple_index_buckets(
+            names[i : i + render_batch_size]
+        ):
+            yield "".join(
+                f'    <a href="/simple/{normalized}/">{display}</a>\n'
+                for normalized, display in decode_bucket(bucket).items()
+            )
+
+    yield "  </body>\n</html>\n"
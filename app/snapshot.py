@@ -0,0 +1,422 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import io
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import orjson
+from loguru import logger
+
+from app.config import flask_app
+
+if TYPE_CHECKING:
+    from app.database import Database
+    from app.files.base import BaseFiles
+
+# version of the snapshot format
+snapshot_version = 1
+# how many Redis entries each chunk of a snapshot holds
+snapshot_chunk_size = 10000
+# files smaller than this are copied through memory rather than disk
+spool_max_size = 16 * 1024 * 1024
+copy_chunk_size = 64 * 1024
+
+# sections of Redis entries, in the order they are written
+SECTIONS = ("url_cache", "file_urls", "file_metadata")
+
+URLS_HEADER = "MYPYPI.urls"
+SHA256_HEADER = "MYPYPI.sha256"
+
+
+class Snapshot:
+    """
+    Exports the state of a mirror to a snapshot, and imports it into another,
+    so a new node starts warm. A snapshot is a tar stream, so it can be piped
+    from one node to another without being stored. It holds a header, then
+    cached upstream pages, file keys and file metadata, as chunks of JSON
+    lines, then every stored file, with its URLs and sha256 digest in its
+    tar headers.
+    """
+
+    def __init__(self, database: Database, files_backend: BaseFiles) -> None:
+        self.database = database
+        self.files_backend = files_backend
+
+        self.workers: int = flask_app.config["SNAPSHOT_WORKERS"]
+        self.include_files: bool = flask_app.config["SNAPSHOT_FILES"]
+
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = collections.Counter()
+
+        logger.debug("Initializing Snapshot")
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        """
+        Add to a statistic of the export or import.
+        """
+        with self._lock:
+            self._stats[name] += amount
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _open(path: str, mode: str) -> Generator[IO[bytes], None, None]:
+        """
+        Open a snapshot file, or stdin/stdout if the path is "-".
+        """
+        if path == "-":
+            yield sys.stdin.buffer if mode == "rb" else sys.stdout.buffer
+            return
+
+        with open(path, mode) as f:
+            yield f
+
+    # =========================================================================
+    # export
+    # =========================================================================
+
+    def _add_bytes(self, tar: tarfile.TarFile, name: str, data: bytes) -> None:
+        """
+        Add a member with some bytes to a snapshot.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+        # a streamed tar file otherwise remembers every member
+        tar.members.clear()
+
+    def _export_entries(self, tar: tarfile.TarFile) -> None:
+        """
+        Add every Redis entry to a snapshot, in chunks.
+        """
+        batches: Dict[str, Iterable[List[Any]]] = {
+            "url_cache": self.database.scan_url_cache(snapshot_chunk_size),
+            "file_urls": self.database.scan_file_url_keys(snapshot_chunk_size),
+            "file_metadata": self.database.scan_file_metadata(snapshot_chunk_size),
+        }
+
+        for section in SECTIONS:
+            for index, batch in enumerate(batches[section]):
+                if not batch:
+                    continue
+
+                self._add_bytes(
+                    tar,
+                    f"{section}/{index:06d}.jsonl",
+                    b"".join(orjson.dumps(entry) + b"\n" for entry in batch),
+                )
+                self._count(section, len(batch))
+
+    def _locate(self, url: str) -> Optional[str]:
+        """
+        Return the path a stored file is at, or None if it is not known.
+        """
+        try:
+            return self.files_backend.storage_path(url)
+        except Exception:
+            logger.exception(f"Failed to check {url}")
+            self._count("files_failed")
+            return None
+
+    def _spool(self, url: str) -> Tuple[IO[bytes], int, str]:
+        """
+        Copy a stored file to a temporary file, and return it,
+        with its size and sha256 hex digest.
+        """
+        hasher = hashlib.sha256()
+        temp = tempfile.SpooledTemporaryFile(spool_max_size)
+        size = 0
+
+        with self.files_backend.open(url) as f:
+            for chunk in iter(lambda: f.read(copy_chunk_size), b""):
+                hasher.update(chunk)
+                temp.write(chunk)
+                size += len(chunk)
+
+        temp.seek(0)
+        return temp, size, hasher.hexdigest()  # type: ignore
+
+    def _export_files(self, tar: tarfile.TarFile) -> None:
+        """
+        Add every stored file to a snapshot, as found by walking our storage.
+        Content shared by several URLs is added once.
+        """
+        by_path: Dict[str, List[str]] = collections.defaultdict(list)
+        for url in self.files_backend.stored_urls():
+            path = self._locate(url)
+            if path is not None and url not in by_path[path]:
+                by_path[path].append(url)
+
+        logger.info(f"Exporting {len(by_path)} stored files")
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            # files are read in parallel, and written to the snapshot in order
+            pending: Deque[Tuple[str, List[str], concurrent.futures.Future]]
+            pending = collections.deque()
+
+            def write_next() -> None:
+                path, file_urls, future = pending.popleft()
+                try:
+                    temp, size, digest = future.result()
+                except Exception:
+                    logger.exception(f"Failed to read {path}")
+                    self._count("files_failed")
+                    return
+
+                with temp:
+                    info = tarfile.TarInfo(f"files/{path}")
+                    info.size = size
+                    info.mtime = int(time.time())
+                    info.pax_headers = {
+                        URLS_HEADER: orjson.dumps(file_urls).decode("utf-8"),
+                        SHA256_HEADER: digest,
+                    }
+                    tar.addfile(info, temp)
+
+                tar.members.clear()
+                self._count("files")
+                self._count("bytes", size)
+
+            for path, file_urls in by_path.items():
+                pending.append(
+                    (path, file_urls, executor.submit(self._spool, file_urls[0]))
+                )
+                if len(pending) >= self.workers * 2:
+                    write_next()
+
+            while pending:
+                write_next()
+
+    def export(self, path: str) -> int:
+        """
+        Export a snapshot to a path. Returns how many files failed to export.
+        """
+        start = time.monotonic()
+        self._stats = collections.Counter()
+
+        with self._open(path, "wb") as f, tarfile.open(
+            fileobj=f, mode="w|", format=tarfile.PAX_FORMAT
+        ) as tar:
+            self._add_bytes(
+                tar,
+                "snapshot.json",
+                orjson.dumps(
+                    {
+                        "version": snapshot_version,
+                        "package_type": flask_app.config["PACKAGE_TYPE"],
+                        "upstream_url": flask_app.config["UPSTREAM_URL"],
+                        "created": datetime.datetime.now().isoformat(),
+                    }
+                ),
+            )
+
+            self._export_entries(tar)
+
+            if self.include_files:
+                self._export_files(tar)
+
+        self._log("Exported", time.monotonic() - start)
+        return self._stats["files_failed"]
+
+    # =========================================================================
+    # import
+    # =========================================================================
+
+    def _check_header(self, header: Dict[str, Any]) -> None:
+        """
+        Make sure a snapshot can be imported into this mirror.
+        """
+        if header.get("version") != snapshot_version:
+            raise ValueError(f"Unsupported snapshot version: {header.get('version')}")
+
+        if header.get("package_type") != flask_app.config["PACKAGE_TYPE"]:
+            raise ValueError(
+                f"Cannot import a {header.get('package_type')} snapshot "
+                f"in {flask_app.config['PACKAGE_TYPE']} mode"
+            )
+
+        if header.get("upstream_url") != flask_app.config["UPSTREAM_URL"]:
+            # cached pages are only found again for the same upstream
+            logger.warning(
+                f"Snapshot is of {header.get('upstream_url')}, "
+                f"not {flask_app.config['UPSTREAM_URL']}"
+            )
+
+        logger.info(f"Importing snapshot created {header.get('created')}")
+
+    def _import_entries(self, section: str, entries: List[Any]) -> None:
+        """
+        Write a chunk of Redis entries in one pipeline.
+        """
+        try:
+            if section == "url_cache":
+                self.database.bulk_set_url_cache([tuple(e) for e in entries])
+            elif section == "file_urls":
+                self.database.bulk_add_file_url_keys([tuple(e) for e in entries])
+            elif section == "file_metadata":
+                self.database.bulk_set_file_metadata([tuple(e) for e in entries])
+        except Exception:
+            logger.exception(f"Failed to import {len(entries)} {section} entries")
+            self._count("chunks_failed")
+        else:
+            self._count(section, len(entries))
+
+    def _import_file(self, urls: List[str], temp: IO[bytes], size: int) -> None:
+        """
+        Save the content of a file to our storage, for each of its URLs.
+        """
+        with temp:
+            for url in urls:
+                try:
+                    if self.files_backend.check(url):
+                        self._count("files_present")
+                    else:
+                        temp.seek(0)
+                        self.files_backend.store(
+                            url, iter(lambda: temp.read(copy_chunk_size), b"")
+                        )
+
+                    self.files_backend.record(url)
+                except Exception:
+                    logger.exception(f"Failed to import {url}")
+                    self._count("files_failed")
+                    return
+
+        self._count("files")
+        self._count("bytes", size)
+
+    def _read_member(
+        self, tar: tarfile.TarFile, member: tarfile.TarInfo
+    ) -> Tuple[IO[bytes], str]:
+        """
+        Copy a member of a snapshot to a temporary file, and return it,
+        with its sha256 hex digest.
+        """
+        source = tar.extractfile(member)
+        assert source is not None
+
+        hasher = hashlib.sha256()
+        temp = tempfile.SpooledTemporaryFile(spool_max_size)
+        for chunk in iter(lambda: source.read(copy_chunk_size), b""):
+            hasher.update(chunk)
+            temp.write(chunk)
+
+        temp.seek(0)
+        return temp, hasher.hexdigest()  # type: ignore
+
+    def import_(self, path: str) -> int:
+        """
+        Import a snapshot from a path. Redis entries are written in pipelined
+        chunks, and files saved, in parallel, while the snapshot is read.
+        Returns how many files and chunks failed to import.
+        """
+        start = time.monotonic()
+        self._stats = collections.Counter()
+        header: Optional[Dict[str, Any]] = None
+
+        with self._open(path, "rb") as f, tarfile.open(
+            fileobj=f, mode="r|"
+        ) as tar, concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            # each pending task holds a chunk or file, so only a few may wait
+            slots = threading.Semaphore(self.workers * 2)
+
+            def submit(func: Callable[..., None], *args: Any) -> None:
+                slots.acquire()
+                executor.submit(func, *args).add_done_callback(
+                    lambda _: slots.release()
+                )
+
+            for member in tar:
+                # a streamed tar file otherwise remembers every member
+                tar.members.clear()
+
+                if not member.isfile():
+                    continue
+
+                section = member.name.split("/", 1)[0]
+
+                if member.name == "snapshot.json":
+                    source = tar.extractfile(member)
+                    assert source is not None
+                    header = orjson.loads(source.read())
+                    self._check_header(header)  # type: ignore
+                    continue
+
+                if header is None:
+                    raise ValueError("Snapshot has no header")
+
+                if section in SECTIONS:
+                    source = tar.extractfile(member)
+                    assert source is not None
+                    entries = [
+                        orjson.loads(line) for line in source.read().splitlines()
+                    ]
+                    submit(self._import_entries, section, entries)
+
+                elif section == "files":
+                    if not self.include_files:
+                        continue
+
+                    urls = orjson.loads(member.pax_headers[URLS_HEADER])
+                    temp, digest = self._read_member(tar, member)
+
+                    if digest != member.pax_headers[SHA256_HEADER]:
+                        logger.error(
+                            f"sha256 of {member.name} is {digest}, "
+                            f"expected {member.pax_headers[SHA256_HEADER]}"
+                        )
+                        self._count("files_failed")
+                        temp.close()
+                        continue
+
+                    submit(self._import_file, urls, temp, member.size)
+
+        if header is None:
+            raise ValueError("Snapshot has no header")
+
+        self._log("Imported", time.monotonic() - start)
+        return self._stats["files_failed"] + self._stats["chunks_failed"]
+
+    def _log(self, action: str, duration: float) -> None:
+        """
+        Log a summary of an export or import.
+        """
+        stats = self._stats
+        logger.info(
+            f"{action} {stats['url_cache']} cached pages, {stats['file_urls']} "
+            f"file keys and {stats['file_metadata']} file metadata, and "
+            f"{stats['files']} files ({stats['bytes'] / 1024 / 1024:.1f} MB, "
+            f"{stats['files_present']} already present, {stats['files_failed']} "
+            f"failed) in {duration:.1f}s"
+            + (
+                f". {stats['chunks_failed']} chunks failed"
+                if stats["chunks_failed"]
+                else ""
+            )
+        )
@@ -0,0 +1,445 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import hashlib
+import threading
+import time
+import urllib.parse
+import xmlrpc.client
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+import bs4
+import orjson
+import packaging.utils
+import packaging.version
+import requests
+from loguru import logger
+
+import app.libraries.url
+import app.prefetcher
+from app.config import flask_app
+
+if TYPE_CHECKING:
+    from app.database import Database
+    from app.files.base import BaseFiles
+    from app.proxy import Proxy
+    from app.simple_index import SimpleIndex
+
+# how many npm search results to ask for at a time when listing a scope
+npm_search_page_size = 250
+
+
+class Syncer:
+    """
+    Keeps an allowlist of projects fully mirrored, metadata and files, so they
+    can be served without the upstream. Each project is checkpointed once all
+    of its files are stored, so an interrupted sync picks up where it left off,
+    and projects that have not changed upstream since are skipped.
+    """
+
+    def __init__(
+        self,
+        proxy: Proxy,
+        database: Database,
+        files_backend: BaseFiles,
+        simple_index: SimpleIndex,
+    ) -> None:
+        self.proxy = proxy
+        self.database = database
+        self.files_backend = files_backend
+        self.simple_index = simple_index
+
+        self.max_versions: int = flask_app.config["SYNC_VERSIONS"]
+        self.workers: int = flask_app.config["SYNC_WORKERS"]
+        self.tags = app.prefetcher.parse_tags(flask_app.config["SYNC_TAGS"])
+        self.python_versions = app.prefetcher.parse_python_versions(
+            flask_app.config["SYNC_PYTHON_VERSIONS"]
+        )
+
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = collections.Counter()
+
+        logger.debug("Initializing Syncer")
+
+    # =========================================================================
+    # projects
+    # =========================================================================
+
+    def _npm_scope_packages(self, scope: str) -> List[str]:
+        """
+        List every package of an npm scope with the upstream search API.
+        """
+        names: List[str] = []
+
+        while True:
+            query = urllib.parse.urlencode(
+                {
+                    "text": f"scope:{scope.removeprefix('@')}",
+                    "size": npm_search_page_size,
+                    "from": len(names),
+                }
+            )
+            url_cache = self.proxy.refresh(
+                f"{flask_app.config['UPSTREAM_URL']}/-/v1/search?{query}"
+            )
+            if url_cache is None:
+                raise ValueError(f"Failed to list the packages of {scope}")
+
+            objects = orjson.loads(url_cache["content"]).get("objects", [])
+            names.extend(result["package"]["name"] for result in objects)
+
+            if len(objects) < npm_search_page_size:
+                break
+
+        # the search is fuzzy, so only keep packages actually in the scope
+        return [name for name in names if name.startswith(f"{scope}/")]
+
+    def expand(self, patterns: List[str]) -> List[str]:
+        """
+        Expand the allowlist into unique project names. npm scopes
+        are given as `@scope/*`.
+        """
+        projects: Dict[str, None] = {}
+
+        for pattern in patterns:
+            if flask_app.config["PACKAGE_TYPE"] == "pypi":
+                projects[packaging.utils.canonicalize_name(pattern)] = None
+            elif pattern.startswith("@") and pattern.endswith("/*"):
+                scope = pattern.removesuffix("/*")
+                packages = self._npm_scope_packages(scope)
+                logger.info(f"Found {len(packages)} packages in {scope}")
+                projects.update(dict.fromkeys(packages))
+            else:
+                projects[pattern] = None
+
+        return list(projects)
+
+    def changed(self, projects: List[str]) -> Tuple[List[str], Optional[int]]:
+        """
+        Given projects, return the ones that may have changed upstream since the
+        last sync, and the upstream serial to checkpoint once they are synced.
+        If the upstream has no changelog, every project may have changed.
+        """
+        if flask_app.config["PACKAGE_TYPE"] != "pypi":
+            return projects, None
+
+        serial = self.database.get_sync_serial()
+
+        try:
+            if serial is None:
+                # everything is new, we only need to know where to start from
+                return projects, self.simple_index.fetch_last_serial()
+
+            names: Set[str] = set()
+            while True:
+                events = self.simple_index.fetch_changelog(serial)
+                if not events:
+                    break
+
+                for name, _, event_serial in events:
+                    names.add(packaging.utils.canonicalize_name(name))
+                    serial = max(serial, event_serial)
+        except (
+            requests.exceptions.RequestException,
+            xmlrpc.client.Error,
+            ValueError,
+        ) as e:
+            # not every upstream has a changelog
+            logger.warning(f"Could not read the upstream changelog: {e}")
+            return projects, None
+
+        # projects that never finished syncing are always included
+        markers = self.database.get_sync_markers(projects)
+        return [
+            project
+            for project, marker in zip(projects, markers)
+            if project in names or marker is None
+        ], serial
+
+    # =========================================================================
+    # files
+    # =========================================================================
+
+    @staticmethod
+    def _marker(
+        headers: List[Tuple[str, str]], content: str, header: Optional[str] = None
+    ) -> str:
+        """
+        Return a marker of the upstream state of a project, preferring the
+        serial header of the upstream, and falling back to a hash of the page.
+        """
+        if header is not None:
+            for name, value in headers:
+                if name.lower() == header.lower():
+                    return value
+
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def select_pypi(self, files: List[Tuple[str, Optional[str]]]) -> List[str]:
+        """
+        Given the URL and required Python version of every file of a PyPI project,
+        select the URLs of the files to mirror.
+        """
+        versions: Dict[packaging.version.Version, List[str]] = collections.defaultdict(
+            list
+        )
+        unversioned: List[str] = []
+
+        for url, requires_python in files:
+            if not app.prefetcher.python_compatible(
+                requires_python, self.python_versions
+            ):
+                continue
+
+            filename = app.libraries.url.url_filename(url)
+            try:
+                if filename.endswith(".whl"):
+                    _, version, _, tags = packaging.utils.parse_wheel_filename(filename)
+                    if not app.prefetcher.tags_compatible(tags, self.tags):
+                        continue
+                else:
+                    _, version = packaging.utils.parse_sdist_filename(filename)
+            except (
+                packaging.utils.InvalidSdistFilename,
+                packaging.utils.InvalidWheelFilename,
+                packaging.version.InvalidVersion,
+            ):
+                # legacy formats, such as eggs
+                unversioned.append(url)
+                continue
+
+            versions[version].append(url)
+
+        if not self.max_versions:
+            return [url for urls in versions.values() for url in urls] + unversioned
+
+        # newest versions first
+        newest = sorted(versions, reverse=True)[: self.max_versions]
+        return [url for version in newest for url in versions[version]]
+
+    def _pypi_files(self, project: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Refresh the metadata of a PyPI project, and return its marker and
+        the URLs of the files to mirror. Returns None if the upstream failed.
+        """
+        url_cache = self.proxy.refresh(
+            f"{flask_app.config['UPSTREAM_URL']}/simple/{project}"
+        )
+        if url_cache is None:
+            return None
+
+        # the JSON API is optional, not every upstream has it
+        if (
+            self.proxy.refresh(
+                f"{flask_app.config['UPSTREAM_URL']}/pypi/{project}/json"
+            )
+            is None
+        ):
+            logger.warning(f"Failed to refresh the JSON metadata of {project}")
+
+        # record the file keys the same way the simple page does
+        a_tags = bs4.BeautifulSoup(url_cache["content"], "html.parser").find_all("a")
+        self.database.bulk_add_file_url_keys(
+            [
+                (app.libraries.url.url_filename(a_tag["href"], True), a_tag["href"])
+                for a_tag in a_tags
+            ]
+        )
+
+        urls = self.select_pypi(
+            [
+                (a_tag["href"], a_tag.get("data-requires-python", None))
+                for a_tag in a_tags
+            ]
+        )
+        marker = self._marker(
+            url_cache["headers"], url_cache["content"], "X-PyPI-Last-Serial"
+        )
+        return marker, urls
+
+    def _npm_files(self, package: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Refresh the metadata of an npm package, and return its marker and
+        the URLs of the tarballs to mirror. Returns None if the upstream failed.
+        """
+        url = f"{flask_app.config['UPSTREAM_URL']}/{package}"
+
+        # installs ask for the abbreviated document, other tools for the full one
+        abbreviated = self.proxy.refresh(
+            url, accept="application/vnd.npm.install-v1+json"
+        )
+        url_cache = self.proxy.refresh(url)
+        if abbreviated is None or url_cache is None:
+            return None
+
+        package_data = orjson.loads(url_cache["content"])
+
+        # versions are listed oldest to newest
+        versions = list(package_data.get("versions", {}).values())
+        if self.max_versions:
+            versions = versions[-self.max_versions :]
+
+        urls = []
+        for version in versions:
+            name, filename = app.libraries.url.parse_npm_file_url(
+                urllib.parse.unquote(version["dist"]["tarball"])
+            )
+            # the same URL the tarball route stores the file under
+            urls.append(
+                f"{flask_app.config['UPSTREAM_URL']}/{name.strip('/')}/-/{filename}"
+            )
+
+        marker = package_data.get("_rev") or self._marker(
+            url_cache["headers"], url_cache["content"]
+        )
+        return marker, urls
+
+    def _sync_file(self, url: str) -> int:
+        """
+        Download a single file if we don't have it yet.
+        Returns how many bytes were downloaded.
+        """
+        if self.files_backend.check(url):
+            self._count("files_present")
+            return 0
+
+        self.files_backend.save(url)
+        size = self.files_backend.record(url)
+        self._count("files_downloaded")
+        self._count("bytes", size)
+        return size
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        """
+        Add to a statistic of the sync.
+        """
+        with self._lock:
+            self._stats[name] += amount
+
+    def publish(self, project: str) -> None:
+        """
+        Publish the index pages of a PyPI project to the static tree, if enabled,
+        by rendering them with their routes.
+        """
+        if (
+            not flask_app.config["PUBLISH_DIRECTORY"]
+            or flask_app.config["PACKAGE_TYPE"] != "pypi"
+        ):
+            return
+
+        # the routes can only be imported once the application is set up
+        import app.routes.pypi.json
+        import app.routes.pypi.simple
+
+        with flask_app.test_request_context(
+            base_url=flask_app.config["PUBLISH_BASE_URL"]
+        ):
+            app.routes.pypi.simple.project(project)
+            app.routes.pypi.json.project(project)
+
+    def sync_project(
+        self,
+        project: str,
+        marker: Optional[str],
+        files_executor: concurrent.futures.Executor,
+    ) -> bool:
+        """
+        Sync the metadata and files of a project, unless the upstream has not
+        changed since its marker. Returns whether or not it fully succeeded.
+        """
+        if flask_app.config["PACKAGE_TYPE"] == "pypi":
+            result = self._pypi_files(project)
+        else:
+            result = self._npm_files(project)
+
+        if result is None:
+            logger.error(f"Failed to get the metadata of {project}")
+            self.database.set_sync_marker(project, None)
+            return False
+
+        new_marker, urls = result
+        if new_marker == marker:
+            logger.info(f"{project} is unchanged")
+            self.publish(project)
+            self._count("projects_unchanged")
+            return True
+
+        futures = {files_executor.submit(self._sync_file, url): url for url in urls}
+        failed = False
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f"Failed to save {futures[future]}")
+                self._count("files_failed")
+                failed = True
+
+        # only checkpoint the project once every file is stored,
+        # so failed files are retried next time
+        self.database.set_sync_marker(project, None if failed else new_marker)
+        self.publish(project)
+        if not failed:
+            self._count("projects_synced")
+        logger.info(
+            f"{'Failed to sync' if failed else 'Synced'} {project}: {len(urls)} files"
+        )
+        return not failed
+
+    def run(self, patterns: List[str]) -> List[str]:
+        """
+        Mirror every project of the allowlist. Returns the projects that failed.
+        """
+        start = time.monotonic()
+        self._stats = collections.Counter()
+
+        projects = self.expand(patterns)
+        changed, serial = self.changed(projects)
+        logger.info(f"Syncing {len(changed)} of {len(projects)} projects")
+
+        failures: List[str] = []
+        markers = self.database.get_sync_markers(changed)
+
+        # projects and files get their own workers, so a project waiting on its
+        # files never holds up the files themselves
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as projects_executor, concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as files_executor:
+            futures = {
+                projects_executor.submit(
+                    self.sync_project, project, marker, files_executor
+                ): project
+                for project, marker in zip(changed, markers)
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if future.result():
+                        continue
+                except Exception:
+                    logger.exception(f"Failed to sync {futures[future]}")
+                    self.database.set_sync_marker(futures[future], None)
+
+                failures.append(futures[future])
+
+        # failed projects have no marker, so they are retried regardless
+        if serial is not None:
+            self.database.set_sync_serial(serial)
+
+        elapsed = time.monotonic() - start
+        logger.info(
+            f"Synced {len(changed)} projects in {elapsed:.1f}s: "
+            f"{self._stats['projects_synced']} synced, "
+            f"{self._stats['projects_unchanged']} unchanged, {len(failures)} failed. "
+            f"{self._stats['files_downloaded']} files downloaded, "
+            f"{self._stats['files_present']} already present, "
+            f"{self._stats['files_failed']} failed, "
+            f"{self._stats['bytes'] / 1024 / 1024:.1f} MB at "
+            f"{self._stats['bytes'] / max(elapsed, 1e-6) / 1024 / 1024:.1f} MB/s"
+        )
+        for project in failures:
+            logger.error(f"Failed: {project}")
+
+        return failures
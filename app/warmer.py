@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import concurrent.futures
+import threading
+import time
+import urllib.parse
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+import bs4
+from loguru import logger
+
+import app.libraries.lockfile
+import app.libraries.url
+from app.config import flask_app
+
+if TYPE_CHECKING:
+    from app.database import Database
+    from app.files.base import BaseFiles
+    from app.models.lockfile import LockedPackage
+    from app.proxy import Proxy
+
+
+class Warmer:
+    def __init__(
+        self, proxy: Proxy, database: Database, files_backend: BaseFiles
+    ) -> None:
+        self.proxy = proxy
+        self.database = database
+        self.files_backend = files_backend
+
+        self._lock = threading.Lock()
+        self._done = 0
+        self._bytes = 0
+
+        logger.debug("Initializing Warmer")
+
+    def _pypi_project_files(self, project: str) -> List[Tuple[str, str]]:
+        """
+        Given a PyPI project, return the file key and URL of every file,
+        recording the file keys the same way the simple page does.
+        """
+        url_cache = self.proxy.get(
+            f"{flask_app.config['UPSTREAM_URL']}/simple/{project}"
+        )
+        if url_cache["status_code"] != HTTPStatus.OK:
+            logger.error(f"Failed to get project {project}: {url_cache['status_code']}")
+            return []
+
+        soup = bs4.BeautifulSoup(url_cache["content"], "html.parser")
+        filekey_url_pairs = [
+            (app.libraries.url.url_filename(a_tag["href"], True), a_tag["href"])
+            for a_tag in soup.find_all("a")
+        ]
+        self.database.bulk_add_file_url_keys(filekey_url_pairs)
+
+        return filekey_url_pairs
+
+    def _resolve_pypi(self, packages: List[LockedPackage]) -> List[str]:
+        """
+        Given locked PyPI packages, return the URLs of the locked files.
+        """
+        urls = []
+
+        for package in packages:
+            filenames = set(package["filenames"])
+            hashes = set(package["hashes"])
+            found = False
+
+            for filekey, url in self._pypi_project_files(package["name"]):
+                filename, _, anchor = filekey.partition("#")
+
+                try:
+                    _, version = app.libraries.url.parse_pypi_file_url(filename)
+                except ValueError:
+                    continue
+
+                if filenames or hashes:
+                    # match on the locked files
+                    if (
+                        filename not in filenames
+                        and anchor.removeprefix("sha256=") not in hashes
+                    ):
+                        continue
+                elif version != package["version"]:
+                    # otherwise, every file of the version
+                    continue
+
+                urls.append(url)
+                found = True
+
+            if not found:
+                logger.warning(
+                    f"No files found for {package['name']}=={package['version']}"
+                )
+
+        return urls
+
+    def _resolve_npm(self, tarball_urls: List[str]) -> List[str]:
+        """
+        Given locked tarball URLs, return the URLs to fetch them from our upstream.
+        """
+        urls = []
+
+        for tarball_url in tarball_urls:
+            package, filename = app.libraries.url.parse_npm_file_url(
+                urllib.parse.unquote(tarball_url)
+            )
+            urls.append(
+                f"{flask_app.config['UPSTREAM_URL']}/{package.strip('/')}/-/{filename}"
+            )
+
+        return urls
+
+    def resolve(self, paths: List[str]) -> List[str]:
+        """
+        Given lockfile paths, return the unique URLs of all locked files.
+        """
+        urls: Dict[str, None] = {}
+
+        for path in paths:
+            logger.info(f"Reading lockfile {path}")
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+
+            is_npm = app.libraries.lockfile.is_npm_lockfile(path)
+            if is_npm != (flask_app.config["PACKAGE_TYPE"] == "npm"):
+                raise ValueError(
+                    f"Lockfile {path} does not match package type {flask_app.config['PACKAGE_TYPE']}"
+                )
+
+            if is_npm:
+                resolved = self._resolve_npm(
+                    app.libraries.lockfile.parse_package_lock(text)
+                )
+            else:
+                resolved = self._resolve_pypi(
+                    app.libraries.lockfile.parse_pypi_lockfile(path, text)
+                )
+
+            urls.update(dict.fromkeys(resolved))
+
+        return list(urls)
+
+    def _warm(self, url: str, total: int, start: float) -> bool:
+        """
+        Download a single file if we don't have it yet.
+        Returns whether or not it was downloaded.
+        """
+        downloaded = False
+        size = 0
+        if not self.files_backend.check(url):
+            self.files_backend.save(url)
+            size = self.files_backend.record(url)
+            downloaded = True
+
+        with self._lock:
+            self._done += 1
+            self._bytes += size
+            elapsed = time.monotonic() - start
+            logger.info(
+                f"[{self._done}/{total}] {'Downloaded' if downloaded else 'Already have'} "
+                f"{app.libraries.url.url_filename(url)}, "
+                f"{self._bytes / max(elapsed, 1e-6) / 1024 / 1024:.1f} MB/s"
+            )
+
+        return downloaded
+
+    def run(self, paths: List[str]) -> List[str]:
+        """
+        Download every file in the given lockfiles to our storage.
+        Returns the URLs that failed.
+        """
+        urls = self.resolve(paths)
+        logger.info(f"Warming {len(urls)} files")
+
+        self._done = 0
+        self._bytes = 0
+        downloaded = 0
+        failures: List[str] = []
+        start = time.monotonic()
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=flask_app.config["WARM_WORKERS"]
+        ) as executor:
+            futures = {
+                executor.submit(self._warm, url, len(urls), start): url for url in urls
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    downloaded += future.result()
+                except Exception:
+                    logger.exception(f"Failed to save {futures[future]}")
+                    failures.append(futures[future])
+
+        elapsed = time.monotonic() - start
+        logger.info(
+            f"Warmed {len(urls)} files in {elapsed:.1f}s: {downloaded} downloaded, "
+            f"{len(urls) - downloaded - len(failures)} already present, "
+            f"{len(failures)} failed, {self._bytes / 1024 / 1024:.1f} MB at "
+            f"{self._bytes / max(elapsed, 1e-6) / 1024 / 1024:.1f} MB/s"
+        )
+        for url in failures:
+            logger.error(f"Failed: {url}")
+
+        return failures
@@ -0,0 +1,147 @@
+"""
+Offline benchmarks of mypypi.
+
+    python -m benchmarks run --output results.json
+    python -m benchmarks compare old.json new.json
+"""
+import argparse
+import datetime
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+import orjson
+
+CONFIGURATIONS = [
+    ("pypi", "local"),
+    ("pypi", "s3"),
+    ("npm", "local"),
+    ("npm", "s3"),
+]
+
+
+def git_commit() -> str:
+    """
+    Return the current git commit, if known.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(args: argparse.Namespace) -> int:
+    results: List[Dict[str, Any]] = []
+
+    for package_type, storage in CONFIGURATIONS:
+        if args.package_type and package_type not in args.package_type:
+            continue
+        if args.storage and storage not in args.storage:
+            continue
+
+        print(f"Running {package_type} with {storage} storage", file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix=".json") as f:
+            # each configuration needs a fresh process
+            subprocess.check_call(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.run",
+                    f"--package-type={package_type}",
+                    f"--storage={storage}",
+                    f"--iterations={args.iterations}",
+                    f"--output={f.name}",
+                ]
+            )
+            results.extend(orjson.loads(f.read()))
+
+    output = {
+        "commit": git_commit(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "redis": os.environ.get("MYPYPI_REDIS_URL", "fakeredis"),
+        "results": results,
+    }
+
+    with open(args.output, "wb") as f:
+        f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
+
+    for result in results:
+        print(
+            f"{result['package_type']:<5} {result['storage']:<6} {result['name']:<18} "
+            f"median {result['median'] * 1000:9.3f}ms  p95 {result['p95'] * 1000:9.3f}ms"
+            + (
+                f"  {result['bytes_per_s'] / 1024 / 1024:8.1f} MB/s"
+                if "bytes_per_s" in result
+                else ""
+            )
+        )
+
+    return 0
+
+
+def compare(args: argparse.Namespace) -> int:
+    def load(path: str) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+
+        return {
+            (result["package_type"], result["storage"], result["name"]): result
+            for result in data["results"]
+        }
+
+    old = load(args.old)
+    new = load(args.new)
+    regressions = 0
+
+    print(f"{'benchmark':<32} {'old median':>12} {'new median':>12} {'ratio':>7}")
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]["median"] / old[key]["median"]
+        flag = ""
+        if args.fail_above and ratio > args.fail_above:
+            flag = "  slower"
+            regressions += 1
+
+        print(
+            f"{' '.join(key):<32} {old[key]['median'] * 1000:10.3f}ms "
+            f"{new[key]['median'] * 1000:10.3f}ms {ratio:7.2f}{flag}"
+        )
+
+    return 1 if regressions else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument("--package-type", action="append", choices=["pypi", "npm"])
+    run_parser.add_argument("--storage", action="append", choices=["local", "s3"])
+    run_parser.add_argument("--iterations", type=int, default=20)
+    run_parser.add_argument("--output", default="benchmark-results.json")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare the results of two runs."
+    )
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--fail-above",
+        type=float,
+        help="Exit with an error if any median is slower by more than this ratio.",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,12 @@
+"""
+gunicorn server hooks for the startup benchmark, to record when each worker
+is ready to serve requests.
+"""
+import os
+import time
+from typing import Any
+
+
+def post_worker_init(worker: Any) -> None:
+    with open(os.environ["BENCHMARK_READY_PATH"], "a", encoding="utf-8") as f:
+        f.write(f"{os.getpid()} {time.time()}\n")
@@ -0,0 +1,320 @@
+"""
+Replay logged traffic against a running server, at the logged rate or scaled,
+and report latency percentiles, error rates and cache hit ratios over time.
+
+    python -m benchmarks.replay --target http://localhost:8080 server.log
+
+Reads the request log lines of the server, or access logs in the common or
+combined log format. Only GET and HEAD requests are replayed.
+
+Index pages are counted as cache hits unless their Server-Timing header has an
+upstream phase, so set MYPYPI_SERVER_TIMING to true on the server. Files are
+counted as cache misses when they are redirected to an --upstream URL.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+import requests
+
+# 2023-01-01 12:00:00.000 | INFO     | app.main:_log_request:100 - GET /simple/flask/? 200 ...
+SERVER_LOG_PATTERN = re.compile(
+    r"^(?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+) \|.*_log_request.* - "
+    r"(?P<method>[A-Z]+) (?P<path>\S+) (?P<status>\d{3})"
+)
+# 127.0.0.1 - - [01/Jan/2023:12:00:00 +0000] "GET /simple/flask/ HTTP/1.1" 200 ...
+ACCESS_LOG_PATTERN = re.compile(
+    r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+) [^"]*" (?P<status>\d{3})'
+)
+
+REPLAYED_METHODS = ("GET", "HEAD")
+
+
+ACCESS_LOG_TIME_FORMATS = (
+    "%d/%b/%Y:%H:%M:%S %z",  # common log format
+    "%d/%b/%Y %H:%M:%S",  # werkzeug development server
+)
+
+
+def parse_line(line: str, log_format: str) -> Optional[Tuple[float, str, str]]:
+    """
+    Parse a `server` or `access` log line into the time, method and path
+    of a request. Returns None if the line is not a request.
+    """
+    if log_format == "server":
+        match = SERVER_LOG_PATTERN.search(line)
+        if match is None:
+            return None
+
+        timestamp = datetime.datetime.strptime(
+            match["time"], "%Y-%m-%d %H:%M:%S.%f"
+        ).timestamp()
+
+        # flask logs an empty query string as a trailing ?
+        return timestamp, match["method"], match["path"].removesuffix("?")
+
+    match = ACCESS_LOG_PATTERN.search(line)
+    if match is None:
+        return None
+
+    for time_format in ACCESS_LOG_TIME_FORMATS:
+        try:
+            timestamp = datetime.datetime.strptime(
+                match["time"], time_format
+            ).timestamp()
+        except ValueError:
+            continue
+
+        return timestamp, match["method"], match["path"]
+
+    return None
+
+
+def read_requests(paths: List[str], log_format: str) -> List[Tuple[float, str, str]]:
+    """
+    Read the requests from log files, in time order. If the format is `auto`,
+    server log lines are used if a file has any, otherwise access log lines.
+    """
+    parsed = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.readlines()
+
+        formats = [log_format] if log_format != "auto" else ["server", "access"]
+        for line_format in formats:
+            requests_ = [parse_line(line, line_format) for line in lines]
+            found = [
+                request
+                for request in requests_
+                if request is not None and request[1] in REPLAYED_METHODS
+            ]
+            if found:
+                parsed.extend(found)
+                break
+
+    return sorted(parsed)
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """
+    Return a percentile of sorted values.
+    """
+    if not ordered:
+        return 0.0
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Replayer:
+    def __init__(
+        self,
+        target: str,
+        concurrency: int,
+        speed: float,
+        upstreams: List[str],
+        timeout: float,
+    ) -> None:
+        self.target = target.rstrip("/")
+        self.concurrency = concurrency
+        self.speed = speed
+        self.upstreams = upstreams
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (sent at, latency, status, cache hit, lateness)
+        self.results: List[Tuple[float, float, int, Optional[bool], float]] = []
+
+    def _session(self) -> requests.Session:
+        """
+        Return the HTTP session of the current thread, to reuse connections.
+        """
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+
+        return self._local.session
+
+    def is_hit(self, response: requests.Response) -> Optional[bool]:
+        """
+        Return whether or not a response came from our cache, if known.
+        """
+        location = response.headers.get("Location", "")
+        if response.is_redirect and location:
+            return not any(location.startswith(upstream) for upstream in self.upstreams)
+
+        server_timing = response.headers.get("Server-Timing")
+        if server_timing is None:
+            return None
+
+        phases = [entry.split(";")[0].strip() for entry in server_timing.split(",")]
+        return "upstream" not in phases
+
+    def send(self, method: str, path: str, due: float, start: float) -> None:
+        """
+        Send a single request and record the result.
+        """
+        sent = time.monotonic()
+        try:
+            response = self._session().request(
+                method,
+                f"{self.target}{path}",
+                allow_redirects=False,
+                timeout=self.timeout,
+            )
+            # read the whole body, as a client would
+            _ = response.content
+            status = response.status_code
+            hit = self.is_hit(response) if status < 400 else None
+        except requests.exceptions.RequestException:
+            status = 0
+            hit = None
+
+        latency = time.monotonic() - sent
+        with self._lock:
+            self.results.append((sent - start, latency, status, hit, sent - due))
+
+    def run(self, logged: Iterable[Tuple[float, str, str]]) -> float:
+        """
+        Replay requests at their logged times, scaled by the speed.
+        Returns how long the replay took.
+        """
+        start = time.monotonic()
+        first: Optional[float] = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency
+        ) as executor:
+            for timestamp, method, path in logged:
+                if first is None:
+                    first = timestamp
+
+                due = start
+                if self.speed > 0:
+                    due += (timestamp - first) / self.speed
+                    time.sleep(max(0.0, due - time.monotonic()))
+
+                executor.submit(self.send, method, path, due, start)
+
+        return time.monotonic() - start
+
+    def summarize(
+        self, results: List[Tuple[float, float, int, Optional[bool], float]]
+    ) -> Dict[str, Any]:
+        """
+        Summarize the results of a set of requests.
+        """
+        latencies = sorted(result[1] for result in results)
+        known = [result[3] for result in results if result[3] is not None]
+
+        return {
+            "requests": len(results),
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+            "errors": sum(
+                1 for result in results if result[2] == 0 or result[2] >= 500
+            ),
+            "client_errors": sum(1 for result in results if 400 <= result[2] < 500),
+            "hit_ratio": sum(known) / len(known) if known else None,
+            # how far behind schedule requests were sent, if we were saturated
+            "max_lateness": max((result[4] for result in results), default=0.0),
+        }
+
+    def report(self, interval: float) -> Dict[str, Any]:
+        """
+        Summarize the results overall and over time, in windows of an interval.
+        """
+        windows: Dict[int, List[Tuple[float, float, int, Optional[bool], float]]] = {}
+        for result in self.results:
+            windows.setdefault(int(result[0] // interval), []).append(result)
+
+        return {
+            "overall": self.summarize(self.results),
+            "windows": [
+                {"start": index * interval, **self.summarize(windows[index])}
+                for index in sorted(windows)
+            ],
+        }
+
+
+def format_row(label: str, summary: Dict[str, Any], interval: float) -> str:
+    """
+    Format a summary as a row of the report table.
+    """
+    hit_ratio = summary["hit_ratio"]
+    return (
+        f"{label:>9} {summary['requests']:>7} {summary['requests'] / interval:>8.1f} "
+        f"{summary['p50'] * 1000:>8.1f} {summary['p90'] * 1000:>8.1f} "
+        f"{summary['p99'] * 1000:>8.1f} "
+        f"{summary['errors'] / max(summary['requests'], 1):>7.1%} "
+        f"{'-' if hit_ratio is None else f'{hit_ratio:.1%}':>7} "
+        f"{summary['max_lateness'] * 1000:>9.1f}"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.replay",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("logs", nargs="+", help="Log files to replay.")
+    parser.add_argument("--target", required=True, help="Base URL of the server.")
+    parser.add_argument(
+        "--format", choices=["auto", "server", "access"], default="auto"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="How many times faster than logged to replay. 0 sends as fast as possible.",
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--upstream",
+        action="append",
+        default=[],
+        help="URL prefix of the upstream, to count file redirects to it as cache misses.",
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument(
+        "--interval", type=float, default=10, help="Seconds per report window."
+    )
+    parser.add_argument("--limit", type=int, help="Replay at most this many requests.")
+    parser.add_argument("--output", help="Write the report as JSON to this path.")
+    args = parser.parse_args()
+
+    logged = read_requests(args.logs, args.format)[: args.limit]
+    print(f"Replaying {len(logged)} requests against {args.target}", file=sys.stderr)
+
+    replayer = Replayer(
+        args.target, args.concurrency, args.speed, args.upstream, args.timeout
+    )
+    elapsed = replayer.run(logged)
+    report = replayer.report(args.interval)
+    report["elapsed"] = elapsed
+
+    print(
+        f"{'window':>9} {'count':>7} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+        f"{'p99 ms':>8} {'errors':>7} {'hits':>7} {'late ms':>9}"
+    )
+    for window in report["windows"]:
+        print(format_row(f"{window['start']:g}s", window, args.interval))
+    print(format_row("overall", report["overall"], max(elapsed, 1e-6)))
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
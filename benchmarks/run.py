@@ -0,0 +1,331 @@
+"""
+Run the benchmarks of one configuration in this process, and write the results
+as JSON. The application reads its configuration when it is imported, so each
+configuration needs its own process.
+"""
+import argparse
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import orjson
+
+from benchmarks.upstream import FakeUpstream, pypi_files
+
+S3_BUCKET = "benchmarks"
+
+
+def free_port() -> int:
+    """
+    Return a free local TCP port.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_s3() -> str:
+    """
+    Start a local S3 compatible server with an empty bucket, and return its URL.
+    """
+    import boto3
+    from moto.server import ThreadedMotoServer
+
+    # the request log of the server would drown out the results
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    port = free_port()
+    ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False).start()
+    endpoint_url = f"http://127.0.0.1:{port}"
+
+    boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id="benchmarks",
+        aws_secret_access_key="benchmarks",
+        region_name="us-east-1",
+    ).create_bucket(Bucket=S3_BUCKET)
+
+    return endpoint_url
+
+
+def use_fakeredis() -> None:
+    """
+    Make every Redis client an in-process fake sharing one server.
+    """
+    import fakeredis
+    import redis
+
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = classmethod(  # type: ignore
+        lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+    )
+
+
+def summarize(
+    name: str,
+    durations: List[float],
+    unit: str = "s",
+    work: Optional[float] = None,
+    work_unit: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Summarize the durations of the iterations of a benchmark. Optionally,
+    add the throughput of the total work done, such as bytes.
+    """
+    ordered = sorted(durations)
+    result: Dict[str, Any] = {
+        "name": name,
+        "unit": unit,
+        "iterations": len(durations),
+        "mean": statistics.mean(durations),
+        "median": statistics.median(durations),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "min": ordered[0],
+        "max": ordered[-1],
+        "stdev": statistics.stdev(durations) if len(durations) > 1 else 0.0,
+        "ops_per_s": len(durations) / sum(durations),
+    }
+
+    if work is not None and work_unit is not None:
+        result[f"{work_unit}_per_s"] = work / sum(durations)
+
+    return result
+
+
+def measure(
+    func: Callable[[int], Any], iterations: int, warmup: int = 2
+) -> List[float]:
+    """
+    Time a function over a number of iterations, after warming it up.
+    The function is given the iteration number.
+    """
+    for i in range(warmup):
+        func(-1 - i)
+
+    durations = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def run(package_type: str, storage: str, iterations: int) -> List[Dict[str, Any]]:
+    """
+    Run every benchmark of a configuration.
+    """
+    upstream = FakeUpstream(package_type)
+    upstream.start()
+
+    data_directory = tempfile.mkdtemp(prefix="mypypi-benchmarks-")
+    os.environ["MYPYPI_MODE"] = "server"
+    os.environ["MYPYPI_PACKAGE_TYPE"] = package_type
+    os.environ["MYPYPI_UPSTREAM_URL"] = upstream.base_url
+    os.environ["MYPYPI_DATA_DIRECTORY"] = data_directory
+    os.environ["MYPYPI_FILE_STORAGE_DIRECTORY"] = os.path.join(data_directory, "files")
+    os.environ["MYPYPI_FILE_STORAGE_DRIVER"] = storage
+
+    if storage == "s3":
+        os.environ["MYPYPI_S3_ENDPOINT_URL"] = start_s3()
+        os.environ["MYPYPI_S3_BUCKET"] = S3_BUCKET
+        os.environ["MYPYPI_S3_ACCESS_KEY"] = "benchmarks"
+        os.environ["MYPYPI_S3_SECRET_KEY"] = "benchmarks"
+        os.environ["MYPYPI_S3_REGION"] = "us-east-1"
+
+    if "MYPYPI_REDIS_URL" not in os.environ:
+        use_fakeredis()
+
+    # the request log would drown out the results
+    from loguru import logger
+
+    logger.remove()
+
+    from app.backends import database_backend, files_backend, proxy
+    from app.downloader import Downloader
+    from app.main import create_app
+
+    flask_app = create_app()
+    client = flask_app.test_client()
+    results = []
+
+    # =========================================================================
+    # index pages
+    # =========================================================================
+
+    if package_type == "pypi":
+        import app.routes.pypi.json
+        import app.routes.pypi.simple
+
+        index_path = "/simple/{}/"
+        large_url = f"{upstream.base_url}/simple/large/"
+        html = proxy.get(large_url)["content"]
+        json_data = proxy.get(f"{upstream.base_url}/pypi/large/json")["content"]
+
+        # bypass the cache of rewritten pages
+        with flask_app.test_request_context():
+            durations = measure(
+                lambda _: app.routes.pypi.simple.process_html.__wrapped__(html),
+                iterations,
+            )
+            results.append(
+                summarize(
+                    "rewrite_simple",
+                    durations,
+                    work=len(html) * len(durations),
+                    work_unit="bytes",
+                )
+            )
+
+            durations = measure(
+                lambda _: app.routes.pypi.json.process_json.__wrapped__(json_data),
+                iterations,
+            )
+            results.append(
+                summarize(
+                    "rewrite_json",
+                    durations,
+                    work=len(json_data) * len(durations),
+                    work_unit="bytes",
+                )
+            )
+
+    else:
+        import datetime
+
+        import app.routes.npm.packages
+
+        index_path = "/{}"
+        packument = proxy.get(f"{upstream.base_url}/large")["content"]
+
+        with flask_app.test_request_context():
+            base_url = app.routes.npm.packages.tarball_base_url()
+            durations = measure(
+                lambda i: app.routes.npm.packages.save_rewrite(
+                    os.path.join(data_directory, "rewrite"),
+                    datetime.datetime.now(),
+                    packument,
+                    [],
+                    base_url,
+                ),
+                iterations,
+            )
+            results.append(
+                summarize(
+                    "rewrite_packument",
+                    durations,
+                    work=len(packument) * len(durations),
+                    work_unit="bytes",
+                )
+            )
+
+    def get(path: str) -> None:
+        response = client.get(path)
+        # read streamed bodies, as a client would
+        response.get_data()
+        assert response.status_code < 400, f"{path}: {response.status_code}"
+
+    # every iteration asks for a project we haven't seen yet
+    durations = measure(lambda i: get(index_path.format(f"miss{i + 10}")), iterations)
+    results.append(summarize("index_miss", durations))
+
+    durations = measure(lambda _: get(index_path.format("large")), iterations)
+    results.append(summarize("index_hit", durations))
+
+    # =========================================================================
+    # core metadata
+    # =========================================================================
+
+    if package_type == "pypi":
+        wheels = [
+            file["filename"]
+            for file in pypi_files("large")
+            if file["filename"].endswith(".whl")
+        ]
+
+        # every iteration asks for metadata we haven't seen yet
+        durations = measure(
+            lambda i: get(f"/file/{wheels[i + 10]}.metadata"), iterations
+        )
+        results.append(summarize("metadata_miss", durations))
+
+        durations = measure(lambda _: get(f"/file/{wheels[0]}.metadata"), iterations)
+        results.append(summarize("metadata_hit", durations))
+
+    # =========================================================================
+    # files
+    # =========================================================================
+
+    if package_type == "pypi":
+        get(index_path.format("download"))
+        file_urls = [
+            f"{upstream.base_url}/packages/download/{file['filename']}#sha256={file['sha256']}"
+            for file in pypi_files("download")
+        ]
+        hit_path = f"/file/{pypi_files('large')[0]['filename']}"
+        hit_url = f"{upstream.base_url}/packages/large/{pypi_files('large')[0]['filename']}#sha256={pypi_files('large')[0]['sha256']}"
+    else:
+        from benchmarks.upstream import npm_tarball, npm_versions
+
+        get(index_path.format("download"))
+        file_urls = [
+            f"{upstream.base_url}/download/-/download-{version}.tgz"
+            for version in npm_versions("download")
+        ]
+        hit_path = f"/large/-/{npm_tarball('large', npm_versions('large')[0])[0]}"
+        hit_url = f"{upstream.base_url}{hit_path}"
+
+    # whole files are sent locally, S3 is redirected to
+    files_backend.save(hit_url)
+    durations = measure(lambda _: get(hit_path), iterations)
+    results.append(summarize("files_hit", durations))
+
+    # =========================================================================
+    # downloader
+    # =========================================================================
+
+    downloader = Downloader(database_backend, files_backend)
+    for url in file_urls:
+        database_backend.add_file_download_job(url)
+
+    total_bytes = 0
+    durations = []
+    for url in file_urls:
+        start = time.perf_counter()
+        downloader.execute()
+        durations.append(time.perf_counter() - start)
+        total_bytes += files_backend.size(url)
+
+    results.append(
+        summarize("downloader", durations, work=total_bytes, work_unit="bytes")
+    )
+
+    for result in results:
+        result["package_type"] = package_type
+        result["storage"] = storage
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--package-type", choices=["pypi", "npm"], required=True)
+    parser.add_argument("--storage", choices=["local", "s3"], required=True)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    results = run(args.package_type, args.storage, args.iterations)
+
+    with open(args.output, "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+Measure how long the server takes to start, and to restart a worker, and how
+much memory each worker uses, with and without gunicorn's --preload.
+
+    python -m benchmarks.startup --workers 4 --output startup.json
+
+Needs gunicorn, and Linux to read memory use from /proc. No Redis server is
+needed, as backends are only connected to on first use.
+
+PSS (proportional set size) splits memory shared between processes evenly
+between them, so the total PSS of the master and workers is what the server
+really uses. USS is the memory only a worker uses.
+"""
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import orjson
+import requests
+
+from benchmarks.run import free_port
+
+
+def memory(pid: int) -> Dict[str, int]:
+    """
+    Return the RSS, PSS and USS of a process, in bytes.
+    """
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                values[name] = int(value.split()[0]) * 1024
+
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "uss": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def read_ready(path: str) -> List[Tuple[int, float]]:
+    """
+    Read the process ID and time of every worker that became ready.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+    return [(int(pid), float(at)) for pid, at in (line.split() for line in lines)]
+
+
+def wait_ready(path: str, count: int, timeout: float) -> List[Tuple[int, float]]:
+    """
+    Wait until a number of workers became ready.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        ready = read_ready(path)
+        if len(ready) >= count:
+            return ready
+
+        time.sleep(0.005)
+
+    raise TimeoutError(f"Only {len(read_ready(path))} of {count} workers started")
+
+
+def create_app_seconds(env: Dict[str, str], repeat: int = 3) -> float:
+    """
+    Return how long importing and creating the application takes in a new process.
+    """
+    code = (
+        "import time; start = time.perf_counter(); "
+        "from app.main import create_app; create_app(); "
+        "print(time.perf_counter() - start)"
+    )
+    return statistics.median(
+        float(subprocess.check_output([sys.executable, "-c", code], env=env))
+        for _ in range(repeat)
+    )
+
+
+def measure(
+    package_type: str, workers: int, preload: bool, timeout: float
+) -> Dict[str, Any]:
+    """
+    Start the server, and measure its startup, a worker restart and its memory.
+    """
+    data_directory = tempfile.mkdtemp(prefix="mypypi-benchmarks-")
+    ready_path = os.path.join(data_directory, "ready")
+    port = free_port()
+
+    env = {
+        **os.environ,
+        "MYPYPI_MODE": "server",
+        "MYPYPI_PACKAGE_TYPE": package_type,
+        "MYPYPI_DATA_DIRECTORY": data_directory,
+        "MYPYPI_FILE_STORAGE_DIRECTORY": os.path.join(data_directory, "files"),
+        # never connected to
+        "MYPYPI_REDIS_URL": os.environ.get("MYPYPI_REDIS_URL", "redis://127.0.0.1:1"),
+        "BENCHMARK_READY_PATH": ready_path,
+    }
+
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        f"--workers={workers}",
+        f"--bind=127.0.0.1:{port}",
+        "--config=python:benchmarks.gunicorn_hooks",
+        *(["--preload"] if preload else []),
+        "app.main:create_app()",
+    ]
+
+    start = time.time()
+    process = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        ready = wait_ready(ready_path, workers, timeout)
+        startup = max(at for _, at in ready) - start
+
+        # options requests are answered without touching a backend
+        response = requests.options(
+            f"http://127.0.0.1:{port}/_benchmark", timeout=timeout
+        )
+        assert response.status_code < 500, response.status_code
+
+        worker_memory = [memory(pid) for pid, _ in ready]
+        master_memory = memory(process.pid)
+
+        # gunicorn replaces a worker that dies
+        killed = time.time()
+        os.kill(ready[0][0], signal.SIGKILL)
+        restarted = wait_ready(ready_path, workers + 1, timeout)[-1][1]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout)
+
+    return {
+        "package_type": package_type,
+        "workers": workers,
+        "preload": preload,
+        "create_app_s": create_app_seconds(env),
+        "startup_s": startup,
+        "restart_s": restarted - killed,
+        "master": master_memory,
+        "worker_rss": statistics.mean(m["rss"] for m in worker_memory),
+        "worker_pss": statistics.mean(m["pss"] for m in worker_memory),
+        "worker_uss": statistics.mean(m["uss"] for m in worker_memory),
+        "total_pss": master_memory["pss"] + sum(m["pss"] for m in worker_memory),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.startup",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--package-type", choices=["pypi", "npm"], default="pypi")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="Write the results as JSON to this path.")
+    args = parser.parse_args()
+
+    results = [
+        measure(args.package_type, args.workers, preload, args.timeout)
+        for preload in (False, True)
+    ]
+
+    mb = 1024 * 1024
+    print(
+        f"{'preload':<8} {'create ms':>10} {'startup ms':>11} {'restart ms':>11} "
+        f"{'worker RSS':>11} {'worker PSS':>11} {'worker USS':>11} {'total PSS':>10}"
+    )
+    for result in results:
+        print(
+            f"{str(result['preload']).lower():<8} {result['create_app_s'] * 1000:>10.1f} "
+            f"{result['startup_s'] * 1000:>11.1f} {result['restart_s'] * 1000:>11.1f} "
+            f"{result['worker_rss'] / mb:>9.1f}MB {result['worker_pss'] / mb:>9.1f}MB "
+            f"{result['worker_uss'] / mb:>9.1f}MB {result['total_pss'] / mb:>8.1f}MB"
+        )
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+A fake PyPI and npm upstream serving large, deterministic pages and artifacts,
+so benchmarks never touch the network.
+
+Projects are generated on the fly from their name:
+- `large*` projects have many versions and files, like popular projects
+- `download*` projects have a few large files, to measure download speed
+- any other project is a typical small one
+"""
+import base64
+import functools
+import hashlib
+import html
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+import orjson
+
+# wheel tags of each version, like a project with compiled extensions
+WHEEL_TAGS = [
+    "cp310-cp310-manylinux_2_17_x86_64.manylinux2014_x86_64",
+    "cp310-cp310-macosx_11_0_arm64",
+    "cp310-cp310-win_amd64",
+    "cp311-cp311-manylinux_2_17_x86_64.manylinux2014_x86_64",
+    "cp311-cp311-macosx_11_0_arm64",
+    "cp311-cp311-win_amd64",
+    "cp312-cp312-manylinux_2_17_x86_64.manylinux2014_x86_64",
+    "cp312-cp312-macosx_11_0_arm64",
+    "cp312-cp312-win_amd64",
+]
+
+
+def project_shape(project: str) -> Tuple[int, int, int]:
+    """
+    Return the number of versions, wheels per version and artifact size of a project.
+    """
+    if project.startswith("large"):
+        return 400, len(WHEEL_TAGS), 4 * 1024
+    if project.startswith("download"):
+        return 8, 0, 4 * 1024 * 1024
+
+    return 20, 2, 4 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def artifact(filename: str, size: int) -> bytes:
+    """
+    Return the deterministic content of an artifact.
+    """
+    block = hashlib.sha256(filename.encode("utf-8")).digest() * 1024
+    return (block * (size // len(block) + 1))[:size]
+
+
+@functools.lru_cache(maxsize=None)
+def artifact_digest(filename: str, size: int, algorithm: str) -> str:
+    """
+    Return the hex digest of an artifact.
+    """
+    return hashlib.new(algorithm, artifact(filename, size)).hexdigest()
+
+
+def pypi_files(project: str) -> List[Dict[str, Any]]:
+    """
+    Return every file of a PyPI project, oldest version first.
+    """
+    versions, wheels, size = project_shape(project)
+    normalized = project.replace("-", "_")
+
+    files = []
+    for i in range(versions):
+        version = f"{i // 100}.{i // 10 % 10}.{i % 10}"
+        filenames = [f"{project}-{version}.tar.gz"] + [
+            f"{normalized}-{version}-{tag}.whl" for tag in WHEEL_TAGS[:wheels]
+        ]
+        for filename in filenames:
+            files.append(
+                {
+                    "filename": filename,
+                    "version": version,
+                    "size": size,
+                    "sha256": artifact_digest(filename, size, "sha256"),
+                    "requires_python": ">=3.10",
+                }
+            )
+
+    return files
+
+
+@functools.lru_cache(maxsize=None)
+def pypi_simple_page(project: str, base_url: str) -> bytes:
+    """
+    Return the simple page of a PyPI project.
+    """
+    lines = [
+        "<!DOCTYPE html>",
+        "<html>",
+        "  <head>",
+        f"    <title>Links for {project}</title>",
+        "  </head>",
+        "  <body>",
+        f"    <h1>Links for {project}</h1>",
+    ]
+    for file in pypi_files(project):
+        metadata = (
+            ' data-dist-info-metadata="true" data-core-metadata="true"'
+            if file["filename"].endswith(".whl")
+            else ""
+        )
+        lines.append(
+            f'    <a href="{base_url}/packages/{project}/{file["filename"]}#sha256={file["sha256"]}"'
+            f' data-requires-python="{html.escape(file["requires_python"])}"{metadata}>{file["filename"]}</a><br />'
+        )
+    lines += ["  </body>", "</html>"]
+
+    return "\n".join(lines).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def pypi_json_page(project: str, base_url: str) -> bytes:
+    """
+    Return the JSON page of a PyPI project.
+    """
+    releases: Dict[str, List[Dict[str, Any]]] = {}
+    for file in pypi_files(project):
+        releases.setdefault(file["version"], []).append(
+            {
+                "filename": file["filename"],
+                "url": f"{base_url}/packages/{project}/{file['filename']}",
+                "digests": {"sha256": file["sha256"]},
+                "size": file["size"],
+                "requires_python": file["requires_python"],
+                "yanked": False,
+            }
+        )
+
+    latest = list(releases)[-1]
+    return orjson.dumps(
+        {
+            "info": {"name": project, "version": latest, "summary": "x" * 200},
+            "releases": releases,
+            "urls": releases[latest],
+        }
+    )
+
+
+def npm_versions(package: str) -> List[str]:
+    """
+    Return every version of an npm package, oldest first.
+    """
+    versions, _, _ = project_shape(package)
+    return [f"{i // 100}.{i // 10 % 10}.{i % 10}" for i in range(versions)]
+
+
+def npm_tarball(package: str, version: str) -> Tuple[str, int]:
+    """
+    Return the filename and size of an npm tarball.
+    """
+    return f"{package}-{version}.tgz", project_shape(package)[2]
+
+
+def npm_dist(package: str, version: str, base_url: str) -> Dict[str, str]:
+    """
+    Return the dist information of an npm package version.
+    """
+    filename, size = npm_tarball(package, version)
+    integrity = base64.b64encode(
+        bytes.fromhex(artifact_digest(filename, size, "sha512"))
+    ).decode("utf-8")
+
+    return {
+        "tarball": f"{base_url}/{package}/-/{filename}",
+        "shasum": artifact_digest(filename, size, "sha1"),
+        "integrity": f"sha512-{integrity}",
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def npm_packument(package: str, base_url: str, abbreviated: bool) -> bytes:
+    """
+    Return the full or abbreviated packument of an npm package.
+    """
+    versions = {}
+    for version in npm_versions(package):
+        document: Dict[str, Any] = {
+            "name": package,
+            "version": version,
+            "dependencies": {"left-pad": "^1.0.0", "lodash": "^4.17.21"},
+            "dist": npm_dist(package, version, base_url),
+        }
+        if not abbreviated:
+            document["description"] = "x" * 200
+            document["scripts"] = {"test": "node test.js"}
+        versions[version] = document
+
+    packument: Dict[str, Any] = {
+        "name": package,
+        "dist-tags": {"latest": npm_versions(package)[-1]},
+        "versions": versions,
+    }
+    if not abbreviated:
+        packument["readme"] = "x" * 20000
+
+    return orjson.dumps(packument)
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, package_type: str) -> None:
+        super().__init__(("127.0.0.1", 0), FakeUpstreamHandler)
+        self.package_type = package_type
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> None:
+        """
+        Serve requests in a background thread.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    server: FakeUpstream
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def send_body(self, body: bytes, content_type: str) -> None:
+        """
+        Send a complete response.
+        """
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "none")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        base_url = self.server.base_url
+
+        if self.server.package_type == "pypi":
+            if len(parts) == 2 and parts[0] == "simple":
+                return self.send_body(
+                    pypi_simple_page(parts[1], base_url), "text/html; charset=utf-8"
+                )
+            if len(parts) == 3 and parts[0] == "pypi" and parts[2] == "json":
+                return self.send_body(
+                    pypi_json_page(parts[1], base_url), "application/json"
+                )
+            if len(parts) == 3 and parts[0] == "packages":
+                project, filename = parts[1], parts[2]
+                size = project_shape(project)[2]
+                if filename.endswith(".whl.metadata"):
+                    name, version = filename.split("-")[:2]
+                    return self.send_body(
+                        f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\nRequires-Python: >=3.10\n".encode(
+                            "utf-8"
+                        ),
+                        "text/plain",
+                    )
+                return self.send_body(
+                    artifact(filename, size), "application/octet-stream"
+                )
+
+        else:
+            if len(parts) == 3 and parts[1] == "-":
+                package, filename = parts[0], parts[2]
+                return self.send_body(
+                    artifact(filename, project_shape(package)[2]),
+                    "application/octet-stream",
+                )
+            if len(parts) == 2:
+                package, version = parts
+                return self.send_body(
+                    orjson.dumps({"dist": npm_dist(package, version, base_url)}),
+                    "application/json",
+                )
+            if len(parts) == 1:
+                abbreviated = "application/vnd.npm.install-v1+json" in self.headers.get(
+                    "Accept", ""
+                )
+                return self.send_body(
+                    npm_packument(parts[0], base_url, abbreviated),
+                    "application/vnd.npm.install-v1+json"
+                    if abbreviated
+                    else "application/json",
+                )
+
+        self.send_response(HTTPStatus.NOT_FOUND)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
@@ -1,5 +1,7 @@
 import os
 import subprocess
+import sys
+import threading
 
 if os.environ["MYPYPI_MODE"] == "server":
     subprocess.check_call(
@@ -7,14 +9,71 @@ if os.environ["MYPYPI_MODE"] == "server":
             "gunicorn",
             f"--workers={os.environ['WORKERS']}",
             "--bind=0.0.0.0:80",
-            "app.main:flask_app",
+            # set up the application once, and fork it into workers
+            "--preload",
+            "app.main:create_app()",
         ]
     )
 
 elif os.environ["MYPYPI_MODE"] == "worker":
-    from app.main import downloader
+    from app.backends import downloader, evictor, simple_index
+    from app.main import create_app
+
+    flask_app = create_app()
+
+    # evict files in the background if a quota is set
+    if flask_app.config["STORAGE_QUOTA"]:
+        threading.Thread(target=evictor.run, daemon=True).start()
+
+    # keep the simple index current in the background if enabled
+    if flask_app.config["SIMPLE_INDEX"] and flask_app.config["PACKAGE_TYPE"] == "pypi":
+        threading.Thread(target=simple_index.run, daemon=True).start()
 
     downloader.run()
 
+elif os.environ["MYPYPI_MODE"] == "warm":
+    from app.backends import warmer
+    from app.main import create_app
+
+    flask_app = create_app()
+
+    failures = warmer.run(flask_app.config["WARM_LOCKFILES"])
+    sys.exit(1 if failures else 0)
+
+elif os.environ["MYPYPI_MODE"] == "sync":
+    from app.backends import syncer
+    from app.main import create_app
+
+    flask_app = create_app()
+
+    failures = syncer.run(flask_app.config["SYNC_PROJECTS"])
+    sys.exit(1 if failures else 0)
+
+elif os.environ["MYPYPI_MODE"] == "export":
+    from app.backends import snapshot
+    from app.main import create_app
+
+    flask_app = create_app()
+
+    failures = snapshot.export(flask_app.config["SNAPSHOT_PATH"])
+    sys.exit(1 if failures else 0)
+
+elif os.environ["MYPYPI_MODE"] == "import":
+    from app.backends import snapshot
+    from app.main import create_app
+
+    flask_app = create_app()
+
+    failures = snapshot.import_(flask_app.config["SNAPSHOT_PATH"])
+    sys.exit(1 if failures else 0)
+
+elif os.environ["MYPYPI_MODE"] == "rebalance":
+    from app.backends import files_backend
+    from app.main import create_app
+
+    create_app()
+
+    files_backend.rebalance()
+
 else:
     raise ValueError(f"Unknown mode: {os.environ['MYPYPI_MODE']}")
@@ -0,0 +1,44 @@
+import os
+import pathlib
+import tempfile
+from typing import Callable
+
+import fakeredis
+import pytest
+import redis
+
+# the configuration is read once, on import, so it is set up before anything
+# else imports the application
+data_directory = tempfile.mkdtemp(prefix="mypypi-tests-")
+os.environ["MYPYPI_PACKAGE_TYPE"] = "npm"
+os.environ["MYPYPI_DATA_DIRECTORY"] = data_directory
+os.environ["MYPYPI_FILE_STORAGE_DIRECTORY"] = os.path.join(data_directory, "files")
+
+# every Redis client connects to the same in-memory server
+server = fakeredis.FakeServer()
+redis.Redis.from_url = classmethod(  # type: ignore
+    lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+)
+
+# the application is imported once the configuration is set up
+from app.database import Database  # noqa: E402
+from app.files.local import LocalFiles  # noqa: E402
+
+
+@pytest.fixture
+def create_files(tmp_path: pathlib.Path) -> Callable[[str], LocalFiles]:
+    """
+    Return a function to create local file storage in a directory of the
+    temporary directory, with a Redis server of its own, like a separate node.
+    """
+
+    def create(name: str) -> LocalFiles:
+        database = Database(fakeredis.FakeRedis(decode_responses=True))
+        return LocalFiles(database, str(tmp_path / name))
+
+    return create
+
+
+@pytest.fixture
+def files(create_files: Callable[[str], LocalFiles]) -> LocalFiles:
+    return create_files("files")
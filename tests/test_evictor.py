@@ -0,0 +1,74 @@
+import concurrent.futures
+
+from app.config import flask_app
+from app.evictor import Evictor
+from app.files.local import LocalFiles
+
+
+def test_backfill_records_untracked_files(files: LocalFiles) -> None:
+    url = f"{flask_app.config['UPSTREAM_URL']}/@scope/name/-/name-1.0.0.tgz"
+    files.store(url, [b"12345"])
+
+    evictor = Evictor(files.database, files)
+    assert evictor.backfill() == 1
+    assert files.database.get_file_sizes([url]) == [5]
+    assert files.database.get_files_size_total() == 5
+
+    # tracked files are left alone
+    assert evictor.backfill() == 0
+    assert files.database.get_files_size_total() == 5
+
+
+def test_backfill_runs_once(files: LocalFiles) -> None:
+    evictor = Evictor(files.database, files)
+    evictor.backfill_once()
+
+    # stored after the backfill, so never counted by it
+    url = f"{flask_app.config['UPSTREAM_URL']}/name/-/name-1.0.0.tgz"
+    files.store(url, [b"12345"])
+    evictor.backfill_once()
+    assert files.database.get_file_sizes([url]) == [None]
+
+
+def test_shared_content_is_counted_once(files: LocalFiles) -> None:
+    files.content_addressed = True
+    urls = [
+        f"{flask_app.config['UPSTREAM_URL']}/{name}/-/{name}-1.0.0.tgz"
+        for name in ("first", "second")
+    ]
+    for url in urls:
+        files.store(url, [b"12345"])
+        files.record(url)
+
+    assert files.database.get_files_size_total() == 5
+
+    evictor = Evictor(files.database, files)
+    evictor.evict(urls[0])
+    assert files.database.get_files_size_total() == 5
+    assert files.check(urls[1])
+
+    evictor.evict(urls[1])
+    assert files.database.get_files_size_total() == 0
+    assert not files.check(urls[1])
+
+
+def test_concurrent_references_are_counted(files: LocalFiles) -> None:
+    database = files.database
+    digest = "0" * 64
+    urls = [
+        f"{flask_app.config['UPSTREAM_URL']}/name-{i}/-/name-{i}-1.0.0.tgz"
+        for i in range(10)
+    ]
+
+    # every file is recorded and removed several times at once
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(lambda url: database.add_file_blob(url, digest, 5), urls * 5))
+        assert database.get_files_size_total() == 5
+
+        remaining = list(executor.map(database.remove_file_blob, urls * 5))
+
+    # each file dropped its reference once
+    assert sorted(set(remaining)) == list(range(len(urls)))
+    assert len([refs for refs in remaining if refs]) == len(urls) - 1
+    assert database.get_files_size_total() == 0
+    assert not database.redis_client.exists(f"{database._blob_prefix}:{digest}")
@@ -0,0 +1,60 @@
+import base64
+import hashlib
+
+import orjson
+import pytest
+import requests
+
+from app.config import flask_app
+from app.files.local import LocalFiles
+from app.libraries.packument import ABBREVIATED_MIMETYPE, find_version
+from app.proxy import Proxy
+
+
+def test_npm_hash_from_cached_packument(
+    files: LocalFiles, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def no_upstream(*args, **kwargs):
+        raise AssertionError("the upstream was asked for the hash")
+
+    monkeypatch.setattr(requests, "get", no_upstream)
+
+    digest = hashlib.sha512(b"tarball").digest()
+    url = f"{flask_app.config['UPSTREAM_URL']}/@scope/name"
+    files.database.set_url_cache(
+        Proxy.cache_key(url, ABBREVIATED_MIMETYPE),
+        {
+            "status_code": 200,
+            "content": orjson.dumps(
+                {
+                    "versions": {
+                        "1.0.0": {
+                            "dist": {
+                                "integrity": f"sha512-{base64.b64encode(digest).decode()}"
+                            }
+                        }
+                    }
+                }
+            ).decode("utf-8"),
+            "headers": [],
+        },
+    )
+
+    assert files.expected_hash(f"{url}/-/name-1.0.0.tgz") == ("sha512", digest.hex())
+
+
+def test_find_version_in_packument() -> None:
+    content = orjson.dumps(
+        {
+            "dist-tags": {"latest": "1.0.0"},
+            "time": {"1.0.0": "2020-01-01T00:00:00.000Z"},
+            "versions": {
+                "1.0.0": {"version": "1.0.0", "dist": {"shasum": "a"}},
+                "1.0.0-beta": {"version": "1.0.0-beta", "dist": {"shasum": "b"}},
+            },
+        }
+    ).decode("utf-8")
+
+    assert find_version(content, "1.0.0")["dist"] == {"shasum": "a"}  # type: ignore
+    assert find_version(content, "1.0.0-beta")["dist"] == {"shasum": "b"}  # type: ignore
+    assert find_version(content, "2.0.0") is None
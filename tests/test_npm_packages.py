@@ -0,0 +1,36 @@
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from app.routes.npm.packages import abbreviated_mimetype, requested_mimetype
+
+
+def requested(accept: str) -> object:
+    return requested_mimetype(parse_accept_header(accept, MIMEAccept))
+
+
+def test_npm_gets_abbreviated() -> None:
+    assert (
+        requested(
+            "application/vnd.npm.install-v1+json; q=1.0, application/json; q=0.8, */*"
+        )
+        == abbreviated_mimetype
+    )
+
+
+def test_anything_gets_full() -> None:
+    assert requested("*/*") is None
+
+
+def test_browser_gets_full() -> None:
+    assert (
+        requested("text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8")
+        is None
+    )
+
+
+def test_no_accept_gets_full() -> None:
+    assert requested("") is None
+
+
+def test_equal_rank_gets_full() -> None:
+    assert requested(f"{abbreviated_mimetype}, application/json") is None
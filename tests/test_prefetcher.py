@@ -0,0 +1,28 @@
+from typing import List, Optional
+
+from app.models.prefetch import PrefetchCandidate
+from app.prefetcher import Prefetcher
+
+
+def candidate(url: str, size: Optional[int]) -> PrefetchCandidate:
+    return PrefetchCandidate(
+        url=url, filename=url, requires_python=None, yanked=False, size=size
+    )
+
+
+def budget(candidates: List[PrefetchCandidate]) -> List[str]:
+    prefetcher = Prefetcher(None)  # type: ignore
+    prefetcher.max_bytes = 100
+    prefetcher.unknown_bytes = 40
+    return prefetcher._apply_budget(candidates)
+
+
+def test_budget_skips_files_over_it() -> None:
+    assert budget([candidate("a", 60), candidate("b", 60), candidate("c", 40)]) == [
+        "a",
+        "c",
+    ]
+
+
+def test_budget_counts_unknown_sizes() -> None:
+    assert budget([candidate(url, None) for url in "abcd"]) == ["a", "b"]
@@ -0,0 +1,43 @@
+from typing import Any, Dict
+
+from app.database.connections import Replicas
+
+
+class Node:
+    """
+    A Redis server that only reports its replication info.
+    """
+
+    def __init__(self, **info: Any) -> None:
+        self.replication = info
+
+    def info(self, section: str) -> Dict[str, Any]:
+        return self.replication
+
+
+def replica(offset: int) -> Node:
+    return Node(role="slave", master_link_status="up", slave_repl_offset=offset)
+
+
+def test_replicas_behind_the_primary_are_not_read() -> None:
+    primary = Node(role="master", master_repl_offset=100)
+    current, behind = replica(100), replica(50)
+    replicas = Replicas(primary, lambda: [current, behind], 10)  # type: ignore
+
+    replicas._check()
+    assert replicas._healthy == [current]
+
+    # the primary had no more than 100 at the last check
+    primary.replication["master_repl_offset"] = 200
+    behind.replication["slave_repl_offset"] = 100
+    replicas._check()
+    assert replicas._healthy == [current, behind]
+
+
+def test_disconnected_replicas_are_not_read() -> None:
+    primary = Node(role="master", master_repl_offset=100)
+    disconnected = Node(role="slave", master_link_status="down", slave_repl_offset=100)
+    replicas = Replicas(primary, lambda: [disconnected], 10)  # type: ignore
+
+    replicas._check()
+    assert replicas._healthy == []
@@ -0,0 +1,105 @@
+import time
+from typing import Dict, List, Tuple
+
+import pytest
+
+from app.files.local import LocalFiles
+from app.files.sharded import ShardedFiles
+
+
+@pytest.fixture
+def sharded(files: LocalFiles) -> ShardedFiles:
+    return ShardedFiles(
+        files.database,
+        files,
+        ["http://node-1", "http://node-2"],
+        "http://node-1",
+        "secret",
+    )
+
+
+def test_signed_url_is_authorized(sharded: ShardedFiles) -> None:
+    expires = int(time.time()) + 60
+    signature = sharded.sign("name/name-1.0.0.tgz", expires)
+
+    assert sharded.authorized_url("name/name-1.0.0.tgz", str(expires), signature)
+    assert not sharded.authorized_url("name/name-2.0.0.tgz", str(expires), signature)
+    assert not sharded.authorized_url(
+        "name/name-1.0.0.tgz", str(expires + 1), signature
+    )
+    assert not sharded.authorized_url("name/name-1.0.0.tgz", "", "")
+
+
+def test_expired_signed_url_is_not_authorized(sharded: ShardedFiles) -> None:
+    expires = int(time.time()) - 1
+    signature = sharded.sign("name/name-1.0.0.tgz", expires)
+
+    assert not sharded.authorized_url("name/name-1.0.0.tgz", str(expires), signature)
+
+
+def rebalanced(
+    monkeypatch: pytest.MonkeyPatch, files: LocalFiles, nodes: List[str], node: str
+) -> Tuple[ShardedFiles, Dict[str, str]]:
+    """
+    Rebalance files stored on a node, recording where each was pushed.
+    """
+    paths = [f"name-{i}/name-{i}-1.0.0.tgz" for i in range(20)]
+    for path in paths:
+        files._commit(files._write_temp([path.encode()]), path)
+
+    sharded = ShardedFiles(
+        files.database, files, nodes, node, "secret", draining=node not in nodes
+    )
+
+    pushed = {}
+    monkeypatch.setattr(
+        sharded,
+        "_push",
+        lambda owner, path, file_path: pushed.__setitem__(path, owner),
+    )
+
+    assert sharded.rebalance() == len(pushed)
+    return sharded, pushed
+
+
+def test_rebalance_after_adding_a_node(
+    monkeypatch: pytest.MonkeyPatch, files: LocalFiles
+) -> None:
+    sharded, pushed = rebalanced(
+        monkeypatch,
+        files,
+        ["http://node-1", "http://node-2", "http://node-3"],
+        "http://node-1",
+    )
+
+    assert pushed
+    for path, owner in pushed.items():
+        assert owner == sharded.owner(path) != "http://node-1"
+        assert not files._exists(path)
+
+    # the files it still owns are kept
+    assert any(files._exists(f"name-{i}/name-{i}-1.0.0.tgz") for i in range(20))
+
+
+def test_rebalance_after_removing_a_node(
+    monkeypatch: pytest.MonkeyPatch, files: LocalFiles
+) -> None:
+    _, pushed = rebalanced(
+        monkeypatch, files, ["http://node-1", "http://node-2"], "http://node-3"
+    )
+
+    # a node outside the ring moves everything it holds away
+    assert len(pushed) == 20
+    assert set(pushed.values()) == {"http://node-1", "http://node-2"}
+    assert not any(files._exists(path) for path in pushed)
+
+
+def test_node_outside_the_ring_must_be_draining(files: LocalFiles) -> None:
+    with pytest.raises(ValueError):
+        ShardedFiles(
+            files.database,
+            files,
+            ["http://node-1", "http://node-2"],
+            "http://node-3",
+            "secret",
+        )
@@ -0,0 +1,37 @@
+import pathlib
+from typing import Callable
+
+from app.config import flask_app
+from app.files.local import LocalFiles
+from app.proxy import Proxy
+from app.snapshot import Snapshot
+
+
+def test_npm_export_import(
+    tmp_path: pathlib.Path, create_files: Callable[[str], LocalFiles]
+) -> None:
+    source_files = create_files("source")
+    target_files = create_files("target")
+    source = Snapshot(source_files.database, source_files)
+    target = Snapshot(target_files.database, target_files)
+
+    package_url = f"{flask_app.config['UPSTREAM_URL']}/@scope/name"
+    tarball_url = f"{package_url}/-/name-1.0.0.tgz"
+    source.database.set_url_cache(
+        Proxy.cache_key(package_url, None),
+        {"status_code": 200, "content": "{}", "headers": []},
+    )
+    # saved without a record of it, as if by an earlier version
+    source.files_backend.store(tarball_url, [b"tarball"])
+
+    path = str(tmp_path / "snapshot.tar")
+    assert source.export(path) == 0
+    assert target.import_(path) == 0
+
+    assert target.files_backend.check(tarball_url)
+    with target.files_backend.open(tarball_url) as f:
+        assert f.read() == b"tarball"
+    assert target.database.get_file_sizes([tarball_url]) == [7]
+
+    _, url_cache = target.database.get_url_cache(Proxy.cache_key(package_url, None))
+    assert url_cache is not None and url_cache["content"] == "{}"